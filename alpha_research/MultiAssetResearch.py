@@ -59,6 +59,8 @@ class MultiAssetResearch(AlphaResearch):
         self.alpha_func = None
         self.alpha_func_paras = None
         self.alpha_position_func = calculate_position
+        # factors and intermediate results of the dash app, only the keys are saved in the front end
+        self.result_cache = ResultCache()
 
         if benchmark is not None:
             # make sure the benchmark contains the date in the first level of the index
@@ -72,6 +74,11 @@ class MultiAssetResearch(AlphaResearch):
         self.factor_bin_num = None
 
     def set_from_alpha_to_position_func(self, func):
+        """
+        func takes the factor series, and returns the position as multi index series or (date x asset) panel
+        :param func:
+        :return:
+        """
         # todo check whether this function is valid
 
         self.alpha_position_func = func
@@ -133,6 +140,106 @@ class MultiAssetResearch(AlphaResearch):
             raise ValueError('Sample data start from {} to {}, but benchmark starts from {} to {}.'
                              .format(start, end, benchmark.index[0], benchmark.index[-1]))
 
+    # ---------------------------------------------------------------
+    # server side results of the dash app
+    # ---------------------------------------------------------------
+    @staticmethod
+    def _factor_key(sample: str, paras: dict) -> str:
+        """
+        The factor is saved in the result cache, and this key is saved in the dash front end.
+        :param sample: 'In sample' or 'Out ot the sample'
+        :param paras: alpha function parameters
+        :return:
+        """
+        return json.dumps({'sample': sample, 'paras': paras}, sort_keys=True)
+
+    @staticmethod
+    def _universe_key(universe) -> tuple:
+        return tuple(sorted(universe)) if universe is not None else None
+
+    def _get_sample_data(self, sample: str, universe=None) -> pd.DataFrame:
+        data = self.in_sample if sample == 'In sample' else self.out_of_sample
+        if universe is None:
+            return data
+        return self.result_cache.get_or_compute(('data', sample, self._universe_key(universe)),
+                                                lambda: data.loc[(slice(None), universe), :])
+
+    def _compute_factor(self, factor_key: str) -> pd.Series:
+        key = json.loads(factor_key)
+        factor = self.alpha_func(self._get_sample_data(key['sample']), **key['paras'])  # type: pd.Series
+        factor.name = self.factor_name
+        return factor
+
+    def _get_factor(self, factor_key: str, universe=None) -> pd.Series:
+        """
+        Get the factor from the result cache, it is recalculated if it is evicted.
+        :param factor_key:
+        :param universe: list of asset code
+        :return:
+        """
+        factor = self.result_cache.get_or_compute(('factor', factor_key), self._compute_factor, factor_key)
+        if universe is None:
+            return factor
+        return self.result_cache.get_or_compute(('factor', factor_key, self._universe_key(universe)),
+                                                lambda: factor.loc[(slice(None), universe)])
+
+    def _get_forward_returns(self, sample: str, universe, periods: list) -> pd.DataFrame:
+        # memoized by calculate_forward_returns on the fingerprint of the data
+        return calculate_forward_returns(self._get_sample_data(sample, universe), periods)
+
+    def _get_merged_data(self, factor_key: str, universe, periods: list) -> pd.DataFrame:
+        """
+        factor, group and forward returns, memoized per (factor key, universe, periods).
+        Do not modify the returned DataFrame in place.
+        :param factor_key:
+        :param universe:
+        :param periods:
+        :return:
+        """
+
+        def _merge():
+            factor = self._get_factor(factor_key, universe)
+            merged_data = pd.DataFrame(index=factor.index)
+            merged_data['factor'] = factor
+            if self.asset_group is not None:
+                ss = pd.Series(self.asset_group)
+                merged_data['group'] = pd.Series(index=factor.index,
+                                                 data=ss[factor.index.get_level_values(level=1)].values) \
+                    .astype('category')
+            sample = json.loads(factor_key)['sample']
+            return merged_data.join(self._get_forward_returns(sample, universe, periods))
+
+        return self.result_cache.get_or_compute(
+            ('merged', factor_key, self._universe_key(universe), tuple(periods)), _merge)
+
+    def _get_general_result(self, factor_key: str, universe, periods: list) -> dict:
+        """
+        Tables and time series of the general page, memoized per (factor key, universe, periods).
+        :param factor_key:
+        :param universe:
+        :param periods:
+        :return:
+        """
+
+        def _calculate():
+            sample = json.loads(factor_key)['sample']
+            factor = self._get_factor(factor_key, universe)
+            returns = self._get_forward_returns(sample, universe, periods)
+            position = self.alpha_position_func(factor)
+            factor_returns = calculate_cross_section_factor_returns(self._get_sample_data(sample, universe),
+                                                                    position)
+            return {'factor': factor,
+                    'position': position,
+                    'factor_returns': factor_returns,
+                    'cumulative_returns': calculate_cumulative_returns(factor_returns, 1),
+                    'turnover': position_turnover(position),
+                    'summary': factor_summary(factor),
+                    'ic': calculate_ts_information_coefficient(factor, returns),
+                    'ols': factor_ols_regression(factor, returns)}
+
+        return self.result_cache.get_or_compute(
+            ('general', factor_key, self._universe_key(universe), tuple(periods)), _calculate)
+
     def evaluate_alpha(self, forward_return_lag: list = None):
         """
         After the alpha calculation to evaluate the alpha.
@@ -260,6 +367,10 @@ class MultiAssetResearch(AlphaResearch):
 
         ], style={'margin': '20px'})
 
+        # the factor is kept in the result cache, the front end only saves its key
+        in_sample_key = self._factor_key('In sample', self.alpha_func_paras)
+        self.result_cache.put(('factor', in_sample_key), self.factor)
+
         para_dcc_list = []
         for k, v in self.alpha_func_paras.items():
             para_dcc_list.append(html.Div(children=k))
@@ -352,11 +463,8 @@ class MultiAssetResearch(AlphaResearch):
                       dcc.Graph(id='turnover-ts')],
                      style={'width': '100%', 'display': 'inline-block', 'margin-bottom': '50px'}),
 
-            # save data in the front end
-            html.Div(children=json.dumps(list(self.factor.index.names)),
-                     id='factor_index_name_saved',
-                     style={'display': 'none'}),
-            html.Div(children=self.factor.reset_index().to_json(), id='in_sample_factor',
+            # save the result cache keys in the front end
+            html.Div(children=in_sample_key, id='in_sample_factor',
                      style={'display': 'none'}),
             html.Div(id='out_sample_factor', style={'display': 'none'}),
             html.Div(children=json.dumps([1, 2, 5, 10]), id='forward_returns_period_saved',
@@ -430,10 +538,7 @@ class MultiAssetResearch(AlphaResearch):
                 style={'width': '100%', 'display': 'inline-block', 'margin-bottom': '50px'}),
 
             #  hidden data
-            html.Div(children=json.dumps(list(self.factor.index.names)),
-                     id='factor_index_name_saved_1',
-                     style={'display': 'none'}),
-            html.Div(children=self.factor.reset_index().to_json(), id='in_sample_factor_1',
+            html.Div(children=in_sample_key, id='in_sample_factor_1',
                      style={'display': 'none'}),
             html.Div(id='out_sample_factor_1', style={'display': 'none'}),
             html.Div(children=json.dumps([1, 2, 5, 10]), id='forward_returns_period_saved_1',
@@ -506,10 +611,7 @@ class MultiAssetResearch(AlphaResearch):
             dcc.Graph(id='group-quantile'),
 
             #  hidden data
-            html.Div(children=json.dumps(list(self.factor.index.names)),
-                     id='factor_index_name_saved_2',
-                     style={'display': 'none'}),
-            html.Div(children=self.factor.reset_index().to_json(), id='in_sample_factor_2',
+            html.Div(children=in_sample_key, id='in_sample_factor_2',
                      style={'display': 'none'}),
             html.Div(id='out_sample_factor_2', style={'display': 'none'}),
             html.Div(children=json.dumps([1, 2, 5, 10]), id='forward_returns_period_saved_2',
@@ -556,6 +658,43 @@ class MultiAssetResearch(AlphaResearch):
                     paras[k] = v
             return paras
 
+        def _update_alpha_insample(alpha_paras) -> str:
+            paras = _get_alpha_parameter_from_div(alpha_paras)
+            factor_key = self._factor_key('In sample', paras)
+            if ('factor', factor_key) in self.result_cache:
+                self.alpha_func_paras = paras
+                self.factor = self._get_factor(factor_key)
+            else:
+                self.calculate_factor(self.alpha_func, **paras)
+                self.result_cache.put(('factor', factor_key), self.factor)
+            return factor_key
+
+        def _update_alpha_out_of_sample(alpha_paras) -> str:
+            # the out of sample factor is calculated when it is first used
+            paras = _get_alpha_parameter_from_div(alpha_paras)
+            return self._factor_key('Out ot the sample', paras)
+
+        def _update_forward_return(value):
+            fr = list(set([int(p) for p in value.split(',')]))
+            fr.sort()
+            forward_str = str(fr).replace('[', '').replace(']', '')
+            return json.dumps(fr), 'Forward return list: ' + forward_str
+
+        def _update_quantile(quantile_str, bin):
+            if quantile_str != 'None':
+                quantile_list = [float(q) for q in quantile_str.split(',')]
+            else:
+                quantile_list = None
+            return json.dumps(quantile_list), bin
+
+        def _get_quantile_result(merged_data, factor_quantile_list, factor_bin_num):
+            # only the bucketing is recalculated when the quantile or the bin changes
+            merged_data = merged_data.copy(deep=False)
+            merged_data['factor_quantile'] = quantize_factor(merged_data, factor_quantile_list, factor_bin_num)
+            quantile_ret_ts, mean_ret, std_error_ret = mean_return_by_quantile(merged_data)
+            cum_ret_by_qt = calculate_cumulative_returns_by_group(quantile_ret_ts)
+            return quantile_ret_ts, mean_ret, cum_ret_by_qt
+
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
         # ++++++++++++++++++ for general page  ++++++++++++++++++++++++
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -565,38 +704,22 @@ class MultiAssetResearch(AlphaResearch):
                           Input('AlphaButton', 'n_clicks'),
                           Input('alpha_paras', 'children')])
         def update_alpha_insample(n_clicks, alpha_paras):
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-            in_sample_factor = self.factor  # type: pd.Series
-            # pickle solution unsuccessful
-            return in_sample_factor.reset_index().to_json()
+            return _update_alpha_insample(alpha_paras)
 
         @app.callback(Output('out_sample_factor', 'children'),
                       [
                           Input('AlphaButton', 'n_clicks'),
                           Input('alpha_paras', 'children')])
         def update_alpha_out_of_sample(n_clicks, alpha_paras):
-
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-
-            out_of_sample_factor = self.alpha_func(self.out_of_sample, **paras)  # type: pd.Series
-            out_of_sample_factor.name = self.factor_name
-            # more generally, this line would be
-            # json.dumps(cleaned_df)
-            return out_of_sample_factor.reset_index().to_json()
+            return _update_alpha_out_of_sample(alpha_paras)
 
         @app.callback([Output('forward_returns_period_saved', 'children'),
                        Output("forward-returns-period", "children")],
                       [Input("UpdateButton", "n_clicks")],
                       [State("forwards-periods-input", "value")])
         def update_forward_return(n_clicks, value):
-            fr = list(set([int(p) for p in value.split(',')]))
-            fr.sort()
-            forward_str = str(fr).replace('[', '').replace(']', '')
-            return json.dumps(fr), 'Forward return list: ' + forward_str
+            return _update_forward_return(value)
 
-        # todo maybe table could move out to get faster table calculation?
         @app.callback([
             Output('distribution', 'figure'),
             Output('qqplot', 'figure'),
@@ -612,114 +735,49 @@ class MultiAssetResearch(AlphaResearch):
             Input('forward_returns_period_saved', 'children'),
             Input('in_sample_factor', 'children'),
             Input('out_sample_factor', 'children'),
-            Input('factor_index_name_saved', 'children'),
             Input('alpha-universe', 'value')
             ])
         def update_forward_returns(n_clicks,
                                    value,
                                    forward_period,
-                                   in_alpha_json,
-                                   out_alpha_json,
-                                   factor_index_name_saved,
+                                   in_factor_key,
+                                   out_factor_key,
                                    universe
                                    ):
             forward_returns_period = json.loads(forward_period)
-            factor_index_ = json.loads(factor_index_name_saved)
-            factor = pd.read_json(in_alpha_json)
-            factor.set_index(factor_index_, inplace=True)
-
-            factor = factor.loc[(slice(None), universe), :]
-            factor = factor[self.factor_name]
-            insample = self.in_sample.loc[(slice(None), universe), :]
             if value == 'In sample':
-                # --------- calculation first ---------
-                returns = calculate_forward_returns(insample, forward_returns_period)
-                position = self.alpha_position_func(factor)
-                merged_data = pd.DataFrame(index=factor.index)
-                merged_data['factor'] = factor
-
-                factor_returns = calculate_cross_section_factor_returns(insample, position)
-                cumulative_returns = calculate_cumulative_returns(factor_returns, 1)
-
+                result = self._get_general_result(in_factor_key, universe, forward_returns_period)
                 # ------- factor distribution study ---------
-                update_distribution_figure = factor_distribution_plot(factor)
-                update_qqplot_figure = qq_plot(factor)
-
-                # --------- factor returns ---------
-                update_factor_plot_figure1 = returns_plot(factor_returns, self.factor_name)
-
-                update_factor_plot_figure2 = cumulative_return_plot(cumulative_returns, benchmark=self.benchmark,
-                                                                    factor_name=self.factor_name)
-
-                # --------- turnover analysis ---------
-                turnover = position_turnover(position)
-                # display(turnover_analysis(turnover))
-                # position graph
-                pos_graph = position_plot(position)
-                # turnover time series graph
-                turnover_ts = turnover_plot(turnover)
-
-                # ic_heatmap = get_monthly_ic(returns, factor, forward_returns_period)
-                # update_heatmap_figure = monthly_ic_heatmap_plot(ic_heatmap)
-
-                # -------- tables --------
-                factor_table = pd_to_dash_table(factor_summary(factor), 'summary')
-
-                ic = calculate_cs_information_coefficient(merged_data)
-                # display(information_analysis(ic))
-
-                ic_table = pd_to_dash_table(pd.DataFrame(calculate_ts_information_coefficient(factor, returns),
-                                                         columns=[self.factor_name]), 'ic')
-                ols_table = pd_to_dash_table(factor_ols_regression(factor, returns), 'ols')
-
-                return update_distribution_figure, update_qqplot_figure, \
-                       update_factor_plot_figure1, update_factor_plot_figure2, \
-                       factor_table, ic_table, ols_table, turnover_ts, pos_graph
+                update_distribution_figure = factor_distribution_plot(result['factor'])
+                update_qqplot_figure = qq_plot(result['factor'])
             else:
-                out_factor = pd.read_json(out_alpha_json)
-                out_factor.set_index(factor_index_, inplace=True)
-                # next two line cannot change position
-                out_factor = out_factor.loc[(slice(None), universe), :]
-                out_factor = out_factor[self.factor_name]
-                # print(out_factor)
-                # print(self.out_of_sample)
-                out_of_sample = self.out_of_sample.loc[(slice(None), universe), :]
-                returns = calculate_forward_returns(out_of_sample, forward_returns_period)
-                position = self.alpha_position_func(out_factor)
-                merged_data = pd.DataFrame(index=factor.index)
-                merged_data['factor'] = factor
-
-                factor_returns = calculate_cross_section_factor_returns(out_of_sample, position)
-                cumulative_returns = calculate_cumulative_returns(factor_returns, 1)
-
-                # update_distribution_figure = factor_distribution_plot(out_factor)
-
-                # for out of sample data onlye
-                in_out_distplot = overlaid_factor_distribution_plot(factor, out_factor)
-                inout_qqplot = observed_qq_plot(factor, out_factor)
-
-                # --------- factor returns ---------
-                update_factor_plot_figure1 = returns_plot(factor_returns, self.factor_name)
-
-                update_factor_plot_figure2 = cumulative_return_plot(cumulative_returns, benchmark=self.benchmark,
-                                                                    factor_name=self.factor_name)
-
-                # --------- turnover analysis ---------
-                turnover = position_turnover(position)
-                # display(turnover_analysis(turnover))
-                # position graph
-                pos_graph = position_plot(position)
-                # turnover time series graph
-                turnover_ts = turnover_plot(turnover)
-
-                factor_table = pd_to_dash_table(factor_summary(out_factor), 'table')
-                ic_table = pd_to_dash_table(pd.DataFrame(calculate_ts_information_coefficient(out_factor, returns),
-                                                         columns=[self.factor_name]), 'ic')
-                ols_table = pd_to_dash_table(factor_ols_regression(out_factor, returns), 'ols')
-
-                return in_out_distplot, inout_qqplot, \
-                       update_factor_plot_figure1, update_factor_plot_figure2, \
-                       factor_table, ic_table, ols_table, turnover_ts, pos_graph
+                factor = self._get_factor(in_factor_key, universe)
+                result = self._get_general_result(out_factor_key, universe, forward_returns_period)
+                # for out of sample data only
+                update_distribution_figure = overlaid_factor_distribution_plot(factor, result['factor'])
+                update_qqplot_figure = observed_qq_plot(factor, result['factor'])
+
+            # --------- factor returns ---------
+            update_factor_plot_figure1 = returns_plot(result['factor_returns'], self.factor_name)
+
+            update_factor_plot_figure2 = cumulative_return_plot(result['cumulative_returns'],
+                                                                benchmark=self.benchmark,
+                                                                factor_name=self.factor_name)
+
+            # --------- turnover analysis ---------
+            # position graph
+            pos_graph = position_plot(result['position'])
+            # turnover time series graph
+            turnover_ts = turnover_plot(result['turnover'])
+
+            # -------- tables --------
+            factor_table = pd_to_dash_table(result['summary'], 'summary')
+            ic_table = pd_to_dash_table(pd.DataFrame(result['ic'], columns=[self.factor_name]), 'ic')
+            ols_table = pd_to_dash_table(result['ols'], 'ols')
+
+            return update_distribution_figure, update_qqplot_figure, \
+                   update_factor_plot_figure1, update_factor_plot_figure2, \
+                   factor_table, ic_table, ols_table, turnover_ts, pos_graph
 
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
         # ++++++++++++++++++ for factor quantile analysis page  ++++++++++++++++++++++++
@@ -730,46 +788,28 @@ class MultiAssetResearch(AlphaResearch):
                           Input('AlphaButton_1', 'n_clicks'),
                           Input('alpha_paras_1', 'children')])
         def update_alpha_insample_1(n_clicks, alpha_paras):
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-            in_sample_factor = self.factor  # type: pd.Series
-            return in_sample_factor.reset_index().to_json()
+            return _update_alpha_insample(alpha_paras)
 
         @app.callback(Output('out_sample_factor_1', 'children'),
                       [
                           Input('AlphaButton_1', 'n_clicks'),
                           Input('alpha_paras_1', 'children')])
         def update_alpha_out_of_sample_1(n_clicks, alpha_paras):
-
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-
-            out_of_sample_factor = self.alpha_func(self.out_of_sample, **paras)  # type: pd.Series
-            out_of_sample_factor.name = self.factor_name
-            # more generally, this line would be
-            # json.dumps(cleaned_df)
-            return out_of_sample_factor.reset_index().to_json()
+            return _update_alpha_out_of_sample(alpha_paras)
 
         @app.callback([Output('forward_returns_period_saved_1', 'children'),
                        Output("forward-returns-period_1", "children")],
                       [Input("UpdateButton_1", "n_clicks")],
                       [State("forwards-periods-input_1", "value")])
         def update_forward_return_1(n_clicks, value):
-            fr = list(set([int(p) for p in value.split(',')]))
-            fr.sort()
-            forward_str = str(fr).replace('[', '').replace(']', '')
-            return json.dumps(fr), 'Forward return list: ' + forward_str
+            return _update_forward_return(value)
 
         @app.callback([Output('quantile_list_1', 'children'),
                        Output('bin_1', 'children')],
                       [Input('quantile', 'value'),
                        Input('bin', 'value')])
         def update_quantile(quantile_str, bin):
-            if quantile_str != 'None':
-                quantile_list = [float(q) for q in quantile_str.split(',')]
-            else:
-                quantile_list = None
-            return json.dumps(quantile_list), bin
+            return _update_quantile(quantile_str, bin)
 
         @app.callback([
             Output('quantile-bar', 'figure'),
@@ -781,7 +821,6 @@ class MultiAssetResearch(AlphaResearch):
             Input('forward_returns_period_saved_1', 'children'),
             Input('in_sample_factor_1', 'children'),
             Input('out_sample_factor_1', 'children'),
-            Input('factor_index_name_saved_1', 'children'),
             Input('quantile_list_1', 'children'),
             Input('bin_1', 'children'),
             Input('alpha-universe_1', 'value')
@@ -789,72 +828,27 @@ class MultiAssetResearch(AlphaResearch):
         def update_quantile_page(n_clicks,
                                  in_out_sample,
                                  forward_period,
-                                 in_alpha_json,
-                                 out_of_sample_factor,
-                                 factor_index_name_saved,
+                                 in_factor_key,
+                                 out_factor_key,
                                  quantile,
                                  bin,
                                  universe
                                  ):
             forward_returns_period = json.loads(forward_period)
-            factor_index_ = json.loads(factor_index_name_saved)
-            factor = pd.read_json(in_alpha_json)
-            factor.set_index(factor_index_, inplace=True)
-            factor = factor.loc[(slice(None), universe), :]
-            factor = factor[self.factor_name]
-
             factor_quantile_list = get_valid_quantile(quantile)
             factor_bin_num = int(bin)
-            insample = self.in_sample.loc[(slice(None), universe), :]
-            if in_out_sample == 'In sample':
-                # --------- calculation first ---------
-                returns = calculate_forward_returns(insample, forward_returns_period)
-                # position = self.alpha_position_func(factor)
-                merged_data = pd.DataFrame(index=factor.index)
-                merged_data['factor'] = factor
-                merged_data = merged_data.join(returns)
-
-                factor_quantile = quantize_factor(merged_data, factor_quantile_list,
-                                                  factor_bin_num)
-                merged_data['factor_quantile'] = factor_quantile
-                quantile_ret_ts, mean_ret, std_error_ret = mean_return_by_quantile(merged_data)
-                cum_ret_by_qt = calculate_cumulative_returns_by_group(quantile_ret_ts)
-
-                # todo table to show
-                # display(mean_ret)
-                qt_bar = returns_by_group_bar_plot(mean_ret)
-                qt_heatmap = returns_by_group_heatmap_plot(mean_ret)
-                qt_displot = returns_by_group_distplot(quantile_ret_ts)
-                qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
-                return qt_bar, qt_heatmap, qt_displot, qt_cum
-            else:
-                # todo out of sample
-                # todo currently it is same with in the sample.
-                # --------- calculation first ---------
-                # factor_index_ = json.loads(factor_index_name_saved)
-                out_factor = pd.read_json(out_of_sample_factor)
-                out_factor.set_index(factor_index_, inplace=True)
-                out_factor = out_factor.loc[(slice(None), universe), :]
-                # print(out_of_sample)
-                out_of_sample = self.out_of_sample.loc[(slice(None), universe), :]
-                returns = calculate_forward_returns(out_of_sample, forward_returns_period)
-                # position = self.alpha_position_func(out_factor)
-                merged_data = pd.DataFrame(index=out_of_sample.index)
-                merged_data['factor'] = out_factor
-                merged_data = merged_data.join(returns)
-                factor_quantile = quantize_factor(merged_data, factor_quantile_list,
-                                                  factor_bin_num)
-                merged_data['factor_quantile'] = factor_quantile
-                quantile_ret_ts, mean_ret, std_error_ret = mean_return_by_quantile(merged_data)
-                cum_ret_by_qt = calculate_cumulative_returns_by_group(quantile_ret_ts)
-
-                # todo table to show
-                # display(mean_ret)
-                qt_bar = returns_by_group_bar_plot(mean_ret)
-                qt_heatmap = returns_by_group_heatmap_plot(mean_ret)
-                qt_displot = returns_by_group_distplot(quantile_ret_ts)
-                qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
-                return qt_bar, qt_heatmap, qt_displot, qt_cum
+            factor_key = in_factor_key if in_out_sample == 'In sample' else out_factor_key
+
+            merged_data = self._get_merged_data(factor_key, universe, forward_returns_period)
+            quantile_ret_ts, mean_ret, cum_ret_by_qt = _get_quantile_result(merged_data, factor_quantile_list,
+                                                                            factor_bin_num)
+            # todo table to show
+            # display(mean_ret)
+            qt_bar = returns_by_group_bar_plot(mean_ret)
+            qt_heatmap = returns_by_group_heatmap_plot(mean_ret)
+            qt_displot = returns_by_group_distplot(quantile_ret_ts)
+            qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
+            return qt_bar, qt_heatmap, qt_displot, qt_cum
 
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
         # ++++++++++++++++++ for factor group analysis page  ++++++++++++++++++++++++
@@ -865,35 +859,21 @@ class MultiAssetResearch(AlphaResearch):
                           Input('AlphaButton_2', 'n_clicks'),
                           Input('alpha_paras_2', 'children')])
         def update_alpha_insample_2(n_clicks, alpha_paras):
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-            in_sample_factor = self.factor  # type: pd.Series
-            return in_sample_factor.reset_index().to_json()
+            return _update_alpha_insample(alpha_paras)
 
         @app.callback(Output('out_sample_factor_2', 'children'),
                       [
                           Input('AlphaButton_2', 'n_clicks'),
                           Input('alpha_paras_2', 'children')])
         def update_alpha_out_of_sample_2(n_clicks, alpha_paras):
-
-            paras = _get_alpha_parameter_from_div(alpha_paras)
-            self.calculate_factor(self.alpha_func, **paras)
-
-            out_of_sample_factor = self.alpha_func(self.out_of_sample, **paras)  # type: pd.Series
-            out_of_sample_factor.name = self.factor_name
-            # more generally, this line would be
-            # json.dumps(cleaned_df)
-            return out_of_sample_factor.reset_index().to_json()
+            return _update_alpha_out_of_sample(alpha_paras)
 
         @app.callback([Output('forward_returns_period_saved_2', 'children'),
                        Output("forward-returns-period_2", "children")],
                       [Input("UpdateButton_2", "n_clicks")],
                       [State("forwards-periods-input_2", "value")])
         def update_forward_return_2(n_clicks, value):
-            fr = list(set([int(p) for p in value.split(',')]))
-            fr.sort()
-            forward_str = str(fr).replace('[', '').replace(']', '')
-            return json.dumps(fr), 'Forward return list: ' + forward_str
+            return _update_forward_return(value)
 
         @app.callback([
             Output('group-ic-bar', 'figure'),
@@ -905,92 +885,43 @@ class MultiAssetResearch(AlphaResearch):
             Input('forward_returns_period_saved_2', 'children'),
             Input('in_sample_factor_2', 'children'),
             Input('out_sample_factor_2', 'children'),
-            Input('factor_index_name_saved_2', 'children'),
-
             ])
         def update_group_page(n_clicks,
                               in_out_sample,
                               forward_period,
-                              in_alpha_json,
-                              out_of_sample_factor,
-                              factor_index_name_saved,
+                              in_factor_key,
+                              out_factor_key,
                               ):
+            if self.asset_group is None:
+                return go.Figure(), go.Figure(), go.Figure(), go.Figure()
 
             forward_returns_period = json.loads(forward_period)
-            factor_index_ = json.loads(factor_index_name_saved)
-            factor = pd.read_json(in_alpha_json)
-            factor.set_index(factor_index_, inplace=True)
-            factor = factor[self.factor_name]
-            insample = self.in_sample
-            if in_out_sample == 'In sample':
-                returns = calculate_forward_returns(insample, forward_returns_period)
-                # todo position calculation selection
-                # position = self.alpha_position_func(factor)
-                merged_data = pd.DataFrame(index=factor.index)
-                merged_data['factor'] = factor
-                if self.asset_group is not None:
-                    ss = pd.Series(self.asset_group)
-                    groupby = pd.Series(index=self.factor.index,
-                                        data=ss[self.factor.index.get_level_values(level=1)].values)
-                    merged_data['group'] = groupby.astype('category')
-                else:
-                    return go.Figure(), go.Figure(), go.Figure(), go.Figure()
-
-                merged_data = merged_data.join(returns)
+            factor_key = in_factor_key if in_out_sample == 'In sample' else out_factor_key
 
+            def _group_result():
+                merged_data = self._get_merged_data(factor_key, None, forward_returns_period)
                 grouped_ic = calculate_cs_information_coefficient(merged_data, True)
-                group_ic_bar = grouped_ic_bar(grouped_ic)
-
                 group_ret_ts, mean_ret, std_error_ret = mean_return_by_group(merged_data)
-                group_ret_bar = returns_by_group_bar_plot(mean_ret)
-                group_displot = returns_by_group_distplot(group_ret_ts)
                 cum_ret_by_group = calculate_cumulative_returns_by_group(group_ret_ts)
-                # todo should add 1 period to it, in case user didn't select
-                group_backtesting = cumulative_returns_by_group_plot(cum_ret_by_group['1_period_return'])
+                return grouped_ic, group_ret_ts, mean_ret, cum_ret_by_group
 
-                return group_ic_bar, group_ret_bar, group_displot, group_backtesting
-            else:
-                # todo out of sample
-                out_factor = pd.read_json(out_of_sample_factor)
-                out_factor.set_index(factor_index_, inplace=True)
-                out_factor = out_factor[self.factor_name]
-
-                out_of_sample = self.out_of_sample
-
-                returns = calculate_forward_returns(out_of_sample, forward_returns_period)
-                merged_data = pd.DataFrame(index=out_of_sample.index)
-                merged_data['factor'] = out_factor
-                if self.asset_group is not None:
-                    ss = pd.Series(self.asset_group)
-                    groupby = pd.Series(index=out_factor.index,
-                                        data=ss[out_factor.index.get_level_values(level=1)].values)
-                    merged_data['group'] = groupby.astype('category')
-                else:
-                    return go.Figure(), go.Figure(), go.Figure(), go.Figure()
-
-                merged_data = merged_data.join(returns)
-                grouped_ic = calculate_cs_information_coefficient(merged_data, True)
-                group_ic_bar = grouped_ic_bar(grouped_ic)
+            grouped_ic, group_ret_ts, mean_ret, cum_ret_by_group = self.result_cache.get_or_compute(
+                ('group', factor_key, tuple(forward_returns_period)), _group_result)
 
-                group_ret_ts, mean_ret, std_error_ret = mean_return_by_group(merged_data)
-                group_ret_bar = returns_by_group_bar_plot(mean_ret)
-                group_displot = returns_by_group_distplot(group_ret_ts)
-                cum_ret_by_group = calculate_cumulative_returns_by_group(group_ret_ts)
-                # todo should add 1 period to it, in case user didn't select
-                group_backtesting = cumulative_returns_by_group_plot(cum_ret_by_group['1_period_return'])
+            group_ic_bar = grouped_ic_bar(grouped_ic)
+            group_ret_bar = returns_by_group_bar_plot(mean_ret)
+            group_displot = returns_by_group_distplot(group_ret_ts)
+            # todo should add 1 period to it, in case user didn't select
+            group_backtesting = cumulative_returns_by_group_plot(cum_ret_by_group['1_period_return'])
 
-                return group_ic_bar, group_ret_bar, group_displot, group_backtesting
+            return group_ic_bar, group_ret_bar, group_displot, group_backtesting
 
         @app.callback([Output('quantile_list_2', 'children'),
                        Output('bin_2', 'children')],
                       [Input('quantile2', 'value'),
                        Input('bin2', 'value')])
-        def update_quantile(quantile_str, bin):
-            if quantile_str != 'None':
-                quantile_list = [float(q) for q in quantile_str.split(',')]
-            else:
-                quantile_list = None
-            return json.dumps(quantile_list), bin
+        def update_quantile_2(quantile_str, bin):
+            return _update_quantile(quantile_str, bin)
 
         @app.callback([
             Output('within-group-backtesting', 'figure'),
@@ -1001,82 +932,32 @@ class MultiAssetResearch(AlphaResearch):
             Input('in_sample_factor_2', 'children'),
             Input('out_sample_factor_2', 'children'),
             Input('group', 'value'),
-            Input('factor_index_name_saved_2', 'children'),
             Input('quantile2', 'value'),
             Input('bin2', 'value')
         ])
         def update_group_selection(in_out_sample,
                                    forward_period,
-                                   in_alpha_json,
-                                   out_of_sample_factor,
+                                   in_factor_key,
+                                   out_factor_key,
                                    group,
-                                   factor_index_name_saved,
                                    quantile,
                                    bin):
+            if self.asset_group is None:
+                return go.Figure(), go.Figure()
+
             factor_quantile_list = get_valid_quantile(quantile)
             factor_bin_num = int(bin)
             forward_returns_period = json.loads(forward_period)
-            factor_index_ = json.loads(factor_index_name_saved)
-            factor = pd.read_json(in_alpha_json)
-            factor.set_index(factor_index_, inplace=True)
+            factor_key = in_factor_key if in_out_sample == 'In sample' else out_factor_key
 
-            # factor = factor.loc[(slice(None), universe), :]
-            # print(factor)
-            factor = factor[self.factor_name]
+            merged_data = self._get_merged_data(factor_key, None, forward_returns_period)
+            merged_data_ = merged_data[merged_data['group'] == group].drop(columns=['group'])
+            quantile_ret_ts, mean_ret, cum_ret_by_qt = _get_quantile_result(merged_data_, factor_quantile_list,
+                                                                            factor_bin_num)
+            qt_bar = returns_by_group_bar_plot(mean_ret)
+            qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
 
-            factor_quantile_list = get_valid_quantile(quantile)
-            factor_bin_num = int(bin)
-            insample = self.in_sample
-            if in_out_sample == 'In sample':
-                returns = calculate_forward_returns(insample, forward_returns_period)
-                # position = self.alpha_position_func(factor)
-                merged_data = pd.DataFrame(index=factor.index)
-                merged_data['factor'] = factor
-                if self.asset_group is not None:
-                    ss = pd.Series(self.asset_group)
-                    groupby = pd.Series(index=factor.index,
-                                        data=ss[factor.index.get_level_values(level=1)].values)
-                    merged_data['group'] = groupby.astype('category')
-                else:
-                    return go.Figure(), go.Figure()
-                merged_data = merged_data.join(returns)
-                merged_data_ = merged_data[merged_data['group'] == group].drop(columns=['group'])
-                factor_quantile = quantize_factor(merged_data_, factor_quantile_list,
-                                                  factor_bin_num)
-                merged_data_['factor_quantile'] = factor_quantile
-                quantile_ret_ts, mean_ret, std_error_ret = mean_return_by_quantile(merged_data_)
-                cum_ret_by_qt = calculate_cumulative_returns_by_group(quantile_ret_ts)
-                qt_bar = returns_by_group_bar_plot(mean_ret)
-                qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
-
-                return qt_bar, qt_cum
-            else:
-                out_factor = pd.read_json(out_of_sample_factor)
-                out_factor.set_index(factor_index_, inplace=True)
-                out_factor = out_factor[self.factor_name]
-                out_of_sample = self.out_of_sample
-                returns = calculate_forward_returns(out_of_sample, forward_returns_period)
-                # position = self.alpha_position_func(factor)
-                merged_data = pd.DataFrame(index=out_factor.index)
-                merged_data['factor'] = out_factor
-                if self.asset_group is not None:
-                    ss = pd.Series(self.asset_group)
-                    groupby = pd.Series(index=out_factor.index,
-                                        data=ss[out_factor.index.get_level_values(level=1)].values)
-                    merged_data['group'] = groupby.astype('category')
-                else:
-                    return go.Figure(), go.Figure()
-                merged_data = merged_data.join(returns)
-                merged_data_ = merged_data[merged_data['group'] == group].drop(columns=['group'])
-                factor_quantile = quantize_factor(merged_data_, factor_quantile_list,
-                                                  factor_bin_num)
-                merged_data_['factor_quantile'] = factor_quantile
-                quantile_ret_ts, mean_ret, std_error_ret = mean_return_by_quantile(merged_data_)
-                cum_ret_by_qt = calculate_cumulative_returns_by_group(quantile_ret_ts)
-                qt_bar = returns_by_group_bar_plot(mean_ret)
-                qt_cum = cumulative_returns_by_group_plot(cum_ret_by_qt['1_period_return'])
-
-                return qt_bar, qt_cum
+            return qt_bar, qt_cum
 
         return app
 
@@ -1,41 +1,177 @@
+import warnings
 import pandas as pd
 import numpy as np
 import os
 import json
 
 from alpha_research.factor_zoo.utils import load_jointquant_fundamental, load_ret_parquet, next_trading_date_dict, \
-    no_trading_date_to_next, combine_market_with_fundamental, returns, combine_fundamental_with_fundamental
+    no_trading_date_to_next, combine_market_with_fundamental, returns, point_in_time_join, \
+    get_first_trading_date_by_month, TradingCalendar, UniverseMembership
 
+"""
+Portfolio sorts on the (date, code) panel.
+The breakpoints are the cross section quantiles of each rebalance date, the portfolios are held until the next
+rebalance date, and the return of date t is earned by the portfolio formed on or before t - 1 with the weight of t - 1,
+which is the buy and hold return of a cap weighted portfolio.
 
-def small_minus_big_groupby_function(df: pd.DataFrame, col: str, q: float, long: bool, short: bool):
-    tmp = pd.DataFrame()
-    if long:
-        small = df[df[col] <= df[col].quantile(q)]
-        tmp = tmp.append(small)
+detail definition see https://mba.tuck.dartmouth.edu/pages/faculty/ken.french/Data_Library/f-f_5_factors_2x3.html
+"""
 
-    if short:
-        big = df[df[col] >= df[col].quantile(1 - q)]
-        big['ret'] = - big['ret']
-        tmp = tmp.append(big)
-    return np.average(tmp['ret'], weights=tmp['weight'])
 
+def rebalance_mask(dates: pd.DatetimeIndex, rebalance_time: None or int or list = None) -> np.ndarray:
+    """
+    Whether each date is a rebalance date
+    :param dates: sorted dates of the panel
+    :param rebalance_time: None for every date,
+                           int or list of int for the first date of the month(s) in every year, 6 is every June,
+                           list of dates for these dates, rolled to the next date in dates
+    :return: bool array
+    """
+    dates = pd.DatetimeIndex(dates)
+    if rebalance_time is None:
+        return np.ones(len(dates), dtype=bool)
+    if isinstance(rebalance_time, (int, np.integer)) or \
+            (len(rebalance_time) > 0 and all(isinstance(month, (int, np.integer)) for month in rebalance_time)):
+        return dates.isin(get_first_trading_date_by_month(dates, rebalance_time))
+    rebalance = np.zeros(len(dates), dtype=bool)
+    position = TradingCalendar(dates).next_on_or_after(pd.to_datetime(list(rebalance_time)).values)
+    rebalance[np.searchsorted(dates.values, position.dropna().values)] = True
+    return rebalance
+
+
+def sort_labels(panel: np.ndarray, quantiles: list, rebalance: np.ndarray) -> np.ndarray:
+    """
+    Sort each rebalance date of the panel by the quantile breakpoints of that date and carry the labels forward.
+    Label k means the value is above k breakpoints, so with quantiles [0.3, 0.7] the labels are 0 (<= 30%),
+    1 (30% - 70%) and 2 (> 70%). -1 means not in any portfolio.
+    :param panel: date x code
+    :param quantiles: list of the quantile breakpoints
+    :param rebalance: bool array of the rebalance dates
+    :return: int array, date x code
+    """
+    sample = panel[rebalance]
+    with warnings.catch_warnings():
+        # the dates without any value
+        warnings.simplefilter('ignore', RuntimeWarning)
+        breakpoints = np.nanquantile(sample, quantiles, axis=1)
+    labels = (sample[np.newaxis] > breakpoints[:, :, np.newaxis]).sum(axis=0)
+    labels[np.isnan(sample)] = -1
+
+    # the last rebalance date on or before each date
+    last = np.maximum.accumulate(np.where(rebalance, np.arange(len(rebalance)), -1))
+    carried = np.full(panel.shape, -1, dtype=np.int64)
+    held = last >= 0
+    carried[held] = labels[np.cumsum(rebalance)[held] - 1]
+    return carried
+
+
+def portfolio_returns(labels: np.ndarray, ret: np.ndarray, weight: np.ndarray, n_portfolio: int) -> np.ndarray:
+    """
+    Weighted returns of the sorted portfolios, the portfolio of t - 1 earns the return of t
+    :param labels: int array, date x code, -1 is not in any portfolio
+    :param ret: date x code
+    :param weight: date x code
+    :param n_portfolio: number of the labels
+    :return: date x portfolio, nan if the portfolio is empty
+    """
+    n_dates = labels.shape[0]
+    held_labels = np.full(labels.shape, -1, dtype=np.int64)
+    held_labels[1:] = labels[:-1]
+    held_weight = np.full(weight.shape, np.nan)
+    held_weight[1:] = weight[:-1]
+
+    valid = (held_labels >= 0) & np.isfinite(ret) & np.isfinite(held_weight) & (held_weight > 0)
+    key = (np.arange(n_dates)[:, np.newaxis] * n_portfolio + held_labels)[valid]
+    total_weight = np.bincount(key, weights=held_weight[valid], minlength=n_dates * n_portfolio)
+    total_return = np.bincount(key, weights=(held_weight * ret)[valid], minlength=n_dates * n_portfolio)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.where(total_weight > 0, total_return / total_weight, np.nan)
+    return result.reshape(n_dates, n_portfolio)
+
+
+def double_sort_returns(size: np.ndarray, characteristic: np.ndarray, ret: np.ndarray, weight: np.ndarray,
+                        rebalance: np.ndarray, size_quantiles: tuple = (0.5,),
+                        characteristic_quantiles: tuple = (0.3, 0.7)) -> np.ndarray:
+    """
+    Independent 2x3 (by default) sort on size and the characteristic
+    :param size: date x code
+    :param characteristic: date x code
+    :param ret: date x code
+    :param weight: date x code
+    :param rebalance: bool array of the rebalance dates
+    :param size_quantiles:
+    :param characteristic_quantiles:
+    :return: date x size portfolio x characteristic portfolio
+    """
+    size_labels = sort_labels(size, size_quantiles, rebalance)
+    characteristic_labels = sort_labels(characteristic, characteristic_quantiles, rebalance)
+    n_size = len(size_quantiles) + 1
+    n_characteristic = len(characteristic_quantiles) + 1
+    labels = np.where((size_labels >= 0) & (characteristic_labels >= 0),
+                      size_labels * n_characteristic + characteristic_labels, -1)
+    result = portfolio_returns(labels, ret, weight, n_size * n_characteristic)
+    return result.reshape(len(result), n_size, n_characteristic)
+
+
+def _merge_panel(market_data: pd.DataFrame or pd.Series, fundamental_data: list,
+                 start=None, end=None,
+                 trading_date: None or list = None,
+                 suspend_data: None or pd.Series = None,
+                 universe: pd.Series or pd.DataFrame or UniverseMembership = None,
+                 weight: pd.Series or str = 'cap', total_shares_name: str = None) -> pd.DataFrame:
+    """
+    One point in time merge of the market data and all the fundamental data, then unstack to date x (column, code)
+    """
+    merge_df = combine_market_with_fundamental(market_data, fundamental_data, start, end, trading_date,
+                                               suspend_data, universe)
+    if 'ret' not in merge_df.columns:
+        merge_df['ret'] = returns(merge_df['close'])
+    merge_df['total_capital'] = merge_df['close'] * merge_df[total_shares_name]
+    if isinstance(weight, pd.Series):
+        merge_df['weight'] = weight.reindex(merge_df.index)
+    elif weight == 'cap':
+        merge_df['weight'] = merge_df['total_capital']
+    elif weight == 'equal':
+        merge_df['weight'] = 1.
+    return merge_df.unstack(level=1).sort_index()
 
-def high_minus_low_groupby_function(df: pd.DataFrame, col: str, q: float, long: bool, short: bool):
-    tmp = pd.DataFrame()
-    if long:
-        high = df[df[col] >= df[col].quantile(1 - q)]
-        tmp = tmp.append(high)
 
+def _asset_growth(panel: pd.DataFrame, total_assets: pd.Series, trading_date: None or list = None) -> np.ndarray:
+    """
+    total assets / total assets known one year earlier - 1
+    """
+    total_assets = total_assets.rename('total_assets')
+    current = panel['total_assets']
+    # row major (date, code) pairs of the panel
+    year_ago = pd.MultiIndex.from_arrays([np.repeat(current.index - pd.Timedelta(days=365), current.shape[1]),
+                                          np.tile(current.columns.values, current.shape[0])])
+    lagged = point_in_time_join(pd.DataFrame(index=year_ago), total_assets, trading_date)['total_assets'].values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        growth = current.values.ravel() / np.where(lagged > 0, lagged, np.nan) - 1
+    return growth.reshape(current.shape)
+
+
+def _single_sort_factor(panel: pd.DataFrame, characteristic: np.ndarray, rebalance_time, long_high: bool,
+                        long: bool, short: bool, quantile: float, name: str) -> pd.DataFrame:
+    """
+    Long the top quantile and short the bottom quantile of the characteristic, or the opposite if long_high is False
+    """
+    rebalance = rebalance_mask(panel.index, rebalance_time)
+    labels = sort_labels(characteristic, [quantile, 1 - quantile], rebalance)
+    result = portfolio_returns(labels, panel['ret'].values, panel['weight'].values, 3)
+    long_leg, short_leg = (result[:, 2], result[:, 0]) if long_high else (result[:, 0], result[:, 2])
+    factor = np.zeros(len(result))
+    if long:
+        factor = factor + long_leg
     if short:
-        low = df[df[col] <= df[col].quantile(q)]
-        low['ret'] = - low['ret']
-        tmp = tmp.append(low)
-    return np.average(tmp['ret'], weights=tmp['weight'])
+        factor = factor - short_leg
+    factor = pd.Series(factor, index=panel.index, name=name).dropna()
+    return factor.to_frame()
 
 
 def smb(market_data: pd.DataFrame or pd.Series,
         total_shares: pd.Series,
-        start=None, end=None, rebalance_time: int or list = 6,
+        start=None, end=None, rebalance_time: None or int or list = None,
         trading_date: None or list = None,
         suspend_data: None or pd.Series = None,
         universe: pd.Series or pd.DataFrame = None,
@@ -44,28 +180,26 @@ def smb(market_data: pd.DataFrame or pd.Series,
         quantile: float = 0.2,
         weight: pd.Series or str = 'cap'
         ) -> pd.DataFrame:
-    total_shares_name = total_shares.name
-    merge_df = combine_market_with_fundamental(market_data, total_shares, start, end, trading_date, suspend_data,
-                                               universe)
-    if 'ret' not in merge_df.columns:
-        merge_df['ret'] = returns(merge_df['close'])
-    merge_df['total_capital'] = merge_df['close'] * merge_df[total_shares_name]
-    merge_df = merge_df[['ret', 'total_capital']]
-    if isinstance(weight, pd.Series):
-        weight.name = 'weight'
-        merge_df = merge_df.join(weight)
-    elif isinstance(weight, str):
-        if weight == 'cap':
-            merge_df['weight'] = merge_df['total_capital']
-        elif weight == 'equal':
-            merge_df['weight'] = 1
-    merge_df.dropna(inplace=True)
-    # todo double sort should be applied in specific date
-
-    factor = merge_df.groupby(level=0).apply(
-        lambda x: small_minus_big_groupby_function(x, 'total_capital', quantile, long, short))
-    factor.name = 'SMB'
-    return factor.to_frame()
+    """
+    Small minus big, single sort on the total capital
+    :param market_data: index is (date, code), has close or ret
+    :param total_shares:
+    :param start:
+    :param end:
+    :param rebalance_time: see rebalance_mask, every date by default, 6 for the yearly sort of June in Fama French
+    :param trading_date:
+    :param suspend_data:
+    :param universe:
+    :param long: long the small
+    :param short: short the big
+    :param quantile: the small is below quantile, the big is above 1 - quantile
+    :param weight: 'cap', 'equal' or the weight series
+    :return:
+    """
+    panel = _merge_panel(market_data, [total_shares], start, end, trading_date, suspend_data, universe,
+                         weight, total_shares.name)
+    return _single_sort_factor(panel, panel['total_capital'].values, rebalance_time, False,
+                               long, short, quantile, 'SMB')
 
 
 def hml(market_data: pd.DataFrame or pd.Series,
@@ -78,40 +212,182 @@ def hml(market_data: pd.DataFrame or pd.Series,
         long: bool = True,
         short: bool = True,
         quantile: float = 0.2,
-        weight: pd.Series or str = 'cap'):
-    total_shares_name = total_shares.name
-    net_book_name = net_book.name
-    facotrs = combine_fundamental_with_fundamental(net_book, total_shares, start,
-                                                   end, universe)
-
-    merge_df = combine_market_with_fundamental(market_data, facotrs, start, end, trading_date, suspend_data,
-                                               universe)
-    if 'ret' not in merge_df.columns:
-        merge_df['ret'] = returns(merge_df['close'])
-    merge_df['total_capital'] = merge_df['close'] * merge_df[total_shares_name]
-    merge_df = merge_df[['ret', 'total_capital', net_book_name]]
-    if isinstance(weight, pd.Series):
-        weight.name = 'weight'
-        merge_df = merge_df.join(weight)
-    elif isinstance(weight, str):
-        if weight == 'cap':
-            merge_df['weight'] = merge_df['total_capital']
-        elif weight == 'equal':
-            merge_df['weight'] = 1
-    merge_df['market_to_book'] = merge_df['total_capital'] / merge_df[net_book_name]
-    merge_df.dropna(inplace=True)
-    factor = merge_df.groupby(level=0).apply(
-        lambda x: high_minus_low_groupby_function(x, 'market_to_book', quantile, long, short))
-    factor.name = 'HML'
-    return factor.to_frame()
+        weight: pd.Series or str = 'cap',
+        rebalance_time: None or int or list = None) -> pd.DataFrame:
+    """
+    High minus low, single sort on the book to market
+    :param market_data: index is (date, code), has close or ret
+    :param net_book:
+    :param total_shares:
+    :param start:
+    :param end:
+    :param trading_date:
+    :param suspend_data:
+    :param universe:
+    :param long: long the high book to market
+    :param short: short the low book to market
+    :param quantile:
+    :param weight: 'cap', 'equal' or the weight series
+    :param rebalance_time: see rebalance_mask, every date by default, 6 for the yearly sort of June in Fama French
+    :return:
+    """
+    panel = _merge_panel(market_data, [net_book, total_shares], start, end, trading_date, suspend_data, universe,
+                         weight, total_shares.name)
+    book_to_market = panel[net_book.name].values / panel['total_capital'].values
+    return _single_sort_factor(panel, book_to_market, rebalance_time, True, long, short, quantile, 'HML')
+
+
+def rmw(market_data: pd.DataFrame or pd.Series,
+        operating_profit: pd.Series,
+        net_book: pd.Series,
+        total_shares: pd.Series,
+        start=None, end=None, rebalance_time: None or int or list = None,
+        trading_date: None or list = None,
+        suspend_data: None or pd.Series = None,
+        universe: pd.Series or pd.DataFrame = None,
+        long: bool = True,
+        short: bool = True,
+        quantile: float = 0.2,
+        weight: pd.Series or str = 'cap') -> pd.DataFrame:
+    """
+    Robust minus weak, single sort on the operating profitability (operating profit / net book)
+    :param market_data: index is (date, code), has close or ret
+    :param operating_profit:
+    :param net_book:
+    :param total_shares:
+    :param start:
+    :param end:
+    :param rebalance_time: see rebalance_mask, every date by default, 6 for the yearly sort of June in Fama French
+    :param trading_date:
+    :param suspend_data:
+    :param universe:
+    :param long: long the robust
+    :param short: short the weak
+    :param quantile:
+    :param weight: 'cap', 'equal' or the weight series
+    :return:
+    """
+    panel = _merge_panel(market_data, [operating_profit, net_book, total_shares], start, end, trading_date,
+                         suspend_data, universe, weight, total_shares.name)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profitability = panel[operating_profit.name].values / np.where(panel[net_book.name].values > 0,
+                                                                       panel[net_book.name].values, np.nan)
+    return _single_sort_factor(panel, profitability, rebalance_time, True, long, short, quantile, 'RMW')
+
+
+def cma(market_data: pd.DataFrame or pd.Series,
+        total_assets: pd.Series,
+        total_shares: pd.Series,
+        start=None, end=None, rebalance_time: None or int or list = None,
+        trading_date: None or list = None,
+        suspend_data: None or pd.Series = None,
+        universe: pd.Series or pd.DataFrame = None,
+        long: bool = True,
+        short: bool = True,
+        quantile: float = 0.2,
+        weight: pd.Series or str = 'cap') -> pd.DataFrame:
+    """
+    Conservative minus aggressive, single sort on the total assets growth of one year
+    :param market_data: index is (date, code), has close or ret
+    :param total_assets:
+    :param total_shares:
+    :param start:
+    :param end:
+    :param rebalance_time: see rebalance_mask, every date by default, 6 for the yearly sort of June in Fama French
+    :param trading_date:
+    :param suspend_data:
+    :param universe:
+    :param long: long the conservative
+    :param short: short the aggressive
+    :param quantile:
+    :param weight: 'cap', 'equal' or the weight series
+    :return:
+    """
+    panel = _merge_panel(market_data, [total_assets.rename('total_assets'), total_shares], start, end, trading_date,
+                         suspend_data, universe, weight, total_shares.name)
+    growth = _asset_growth(panel, total_assets, trading_date)
+    return _single_sort_factor(panel, growth, rebalance_time, False, long, short, quantile, 'CMA')
+
+
+def fama_french_factors(market_data: pd.DataFrame or pd.Series,
+                        total_shares: pd.Series,
+                        net_book: pd.Series = None,
+                        operating_profit: pd.Series = None,
+                        total_assets: pd.Series = None,
+                        start=None, end=None, rebalance_time: None or int or list = None,
+                        trading_date: None or list = None,
+                        suspend_data: None or pd.Series = None,
+                        universe: pd.Series or pd.DataFrame = None,
+                        weight: pd.Series or str = 'cap',
+                        size_quantiles: tuple = (0.5,),
+                        characteristic_quantiles: tuple = (0.3, 0.7)) -> pd.DataFrame:
+    """
+    SMB, HML, RMW and CMA by the 2x3 double sorts of Fama French (2015), in one merge of all the data.
+    HML, RMW and CMA are the average of the two size portfolios of the long side minus the short side,
+    SMB is the average of the small minus big of every double sort. Without the fundamental data of a factor,
+    it is skipped, and SMB is the small minus big of the size sort only.
+    :param market_data: index is (date, code), has close or ret
+    :param total_shares:
+    :param net_book: for HML and RMW
+    :param operating_profit: for RMW
+    :param total_assets: for CMA
+    :param start:
+    :param end:
+    :param rebalance_time: see rebalance_mask, every date by default, 6 for the yearly sort of June in Fama French
+    :param trading_date:
+    :param suspend_data:
+    :param universe:
+    :param weight: 'cap', 'equal' or the weight series
+    :param size_quantiles:
+    :param characteristic_quantiles:
+    :return: date x factor
+    """
+    fundamental_data = [total_shares]
+    if net_book is not None:
+        fundamental_data.append(net_book.rename('net_book'))
+    if operating_profit is not None and net_book is not None:
+        fundamental_data.append(operating_profit.rename('operating_profit'))
+    if total_assets is not None:
+        fundamental_data.append(total_assets.rename('total_assets'))
+    panel = _merge_panel(market_data, fundamental_data, start, end, trading_date, suspend_data, universe,
+                         weight, total_shares.name)
 
+    size = panel['total_capital'].values
+    ret = panel['ret'].values
+    weight = panel['weight'].values
+    rebalance = rebalance_mask(panel.index, rebalance_time)
 
-def rmw():
-    pass
+    characteristics = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if net_book is not None:
+            characteristics['HML'] = (panel['net_book'].values / size, True)
+            if operating_profit is not None:
+                book = panel['net_book'].values
+                characteristics['RMW'] = (panel['operating_profit'].values / np.where(book > 0, book, np.nan), True)
+        if total_assets is not None:
+            characteristics['CMA'] = (_asset_growth(panel, total_assets, trading_date), False)
 
+    factors = {}
+    small_minus_big = []
+    for name, (characteristic, long_high) in characteristics.items():
+        result = double_sort_returns(size, characteristic, ret, weight, rebalance,
+                                     size_quantiles, characteristic_quantiles)
+        long_leg, short_leg = (result[:, :, -1], result[:, :, 0]) if long_high else (result[:, :, 0], result[:, :, -1])
+        # the mean of the non empty portfolios, nan only if all of them are empty
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            factors[name] = np.nanmean(long_leg, axis=1) - np.nanmean(short_leg, axis=1)
+            small_minus_big.append(np.nanmean(result[:, 0, :], axis=1) - np.nanmean(result[:, -1, :], axis=1))
 
-def cma():
-    pass
+    if small_minus_big:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            smb_factor = np.nanmean(small_minus_big, axis=0)
+    else:
+        result = portfolio_returns(sort_labels(size, size_quantiles, rebalance), ret, weight, len(size_quantiles) + 1)
+        smb_factor = result[:, 0] - result[:, -1]
+    factors = dict(SMB=smb_factor, **factors)
+    return pd.DataFrame(factors, index=panel.index).dropna(how='all')
 
 
 if __name__ == '__main__':
@@ -133,12 +409,8 @@ if __name__ == '__main__':
     end = '2020-01-01'
     total_shares = df['share_total']
     net_book = fundamental_data2['total_owner_equities']
-    # merge_df = combine_market_fundamental(market_data, total_shares, start, end, trading_date, universe=universe)
-    #
-    # total_shares_name = total_shares.name
-    # if 'ret' not in merge_df.columns:
-    #     merge_df['ret'] = returns(merge_df['close'])
-    # merge_df['total_capital'] = merge_df['close'] * merge_df[total_shares_name]
-    # merge_df.dropna(inplace=True)
-    smb_factor = smb(market_data, total_shares, start, end, trading_date, universe=universe)
-    hml_factor = hml(market_data, net_book, total_shares, start, end, trading_date, universe=universe)
+    smb_factor = smb(market_data, total_shares, start, end, trading_date=trading_date, universe=universe)
+    hml_factor = hml(market_data, net_book, total_shares, start, end, trading_date=trading_date, universe=universe)
+    # sorted on the first trading date of June as Fama French
+    factors = fama_french_factors(market_data, total_shares, net_book, start=start, end=end, rebalance_time=6,
+                                  trading_date=trading_date, universe=universe)
@@ -4,7 +4,6 @@ import datetime
 import math
 import pandas as pd
 import numpy as np
-import tqdm
 
 """
 detail definition see https://arxiv.org/pdf/1601.00991.pdf
@@ -437,6 +436,106 @@ def load_ret_parquet(path: str) -> pd.Series:
     return ret
 
 
+class TradingCalendar:
+    """
+    Trading calendar backed by a sorted datetime64 array.
+    The lookups are vectorized by np.searchsorted, so each date costs O(log n).
+    A scalar date returns pd.Timestamp, and an array of dates returns pd.DatetimeIndex.
+    The date out of the calendar is NaT.
+    """
+
+    def __init__(self, trading_date):
+        dates = pd.to_datetime(pd.Index(trading_date)).values
+        self.dates = np.unique(dates[~np.isnat(dates)])  # type: np.ndarray
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, date):
+        return bool(self.is_trading_date(date))
+
+    @staticmethod
+    def _to_datetime64(dates):
+        if np.ndim(dates) == 0:
+            return np.array([pd.Timestamp(dates).to_datetime64()], dtype='datetime64[ns]'), True
+        return pd.to_datetime(pd.Index(dates)).values, False
+
+    def _take(self, position: np.ndarray, scalar: bool):
+        valid = (position >= 0) & (position < len(self.dates))
+        result = np.full(len(position), np.datetime64('NaT'), dtype='datetime64[ns]')
+        result[valid] = self.dates[position[valid]]
+        if scalar:
+            return pd.Timestamp(result[0])
+        return pd.DatetimeIndex(result)
+
+    def is_trading_date(self, dates):
+        """
+        :param dates: scalar or array of dates
+        :return: bool or bool array
+        """
+        values, scalar = self._to_datetime64(dates)
+        position = np.searchsorted(self.dates, values, side='left')
+        found = position < len(self.dates)
+        found[found] = self.dates[position[found]] == values[found]
+        return found[0] if scalar else found
+
+    def next_on_or_after(self, dates):
+        """
+        The date itself if it is trading date, otherwise the next trading date
+        :param dates:
+        :return:
+        """
+        values, scalar = self._to_datetime64(dates)
+        return self._take(np.searchsorted(self.dates, values, side='left'), scalar)
+
+    def next(self, dates):
+        """
+        The first trading date strictly after the date
+        :param dates:
+        :return:
+        """
+        values, scalar = self._to_datetime64(dates)
+        return self._take(np.searchsorted(self.dates, values, side='right'), scalar)
+
+    def prev(self, dates):
+        """
+        The last trading date strictly before the date
+        :param dates:
+        :return:
+        """
+        values, scalar = self._to_datetime64(dates)
+        return self._take(np.searchsorted(self.dates, values, side='left') - 1, scalar)
+
+    def offset(self, dates, n: int):
+        """
+        Move n trading dates. A non trading date is rolled forward for n > 0 and rolled backward for n < 0 first,
+        e.g. offset(saturday, 1) is the next monday and offset(saturday, -1) is the last friday.
+        :param dates:
+        :param n:
+        :return:
+        """
+        values, scalar = self._to_datetime64(dates)
+        if n > 0:
+            position = np.searchsorted(self.dates, values, side='right') + n - 1
+        elif n < 0:
+            position = np.searchsorted(self.dates, values, side='left') + n
+        else:
+            position = np.searchsorted(self.dates, values, side='left')
+        return self._take(position, scalar)
+
+    def range(self, start=None, end=None) -> pd.DatetimeIndex:
+        """
+        Trading dates between start and end, both inclusive
+        :param start:
+        :param end:
+        :return:
+        """
+        left = 0 if start is None else np.searchsorted(self.dates, pd.Timestamp(start).to_datetime64(), side='left')
+        right = len(self.dates) if end is None else \
+            np.searchsorted(self.dates, pd.Timestamp(end).to_datetime64(), side='right')
+        return pd.DatetimeIndex(self.dates[left:right])
+
+
 def next_trading_date_dict(trading_date: list):
     start = trading_date[0]
     end = trading_date[-1]
@@ -455,13 +554,14 @@ def no_trading_date_to_next(date, trading_date: list, next_trading_date: dict):
         return next_trading_date[date]
 
 
-def get_nth_weekday_of_month(year: int, month: int, weekday: int, n: int):
+def get_nth_weekday_of_month(year: int, month: int, weekday: int, n: int, calendar: TradingCalendar = None):
     """
     Answer the question like what is the date of the first Monthday in May 2020.
     :param year: int
     :param month: int
     :param weekday: int (0-6)
     :param n:
+    :param calendar: if given, roll the date forward to the trading date
     :return:
     """
     first_day = datetime.datetime(year, month, 1)
@@ -470,7 +570,148 @@ def get_nth_weekday_of_month(year: int, month: int, weekday: int, n: int):
     if day_count < 0:
         day_count += 7
     day_count += (n - 1) * 7
-    return first_day + datetime.timedelta(days=day_count)
+    date = first_day + datetime.timedelta(days=day_count)
+    if calendar is not None:
+        return calendar.next_on_or_after(date)
+    return date
+
+
+def asof_index(left_codes, left_time, right_codes, right_time) -> np.ndarray:
+    """
+    As of lookup: for each left (code, time), the position of the last right row of the same code
+    whose time is on or before it, -1 if there is no such row.
+    Among the right rows with the same (code, time), the last one in the original order wins.
+    Both sides are packed into one sorted int64 key, so it is a single np.searchsorted instead of a per code loop.
+    :param left_codes: array
+    :param left_time: datetime64 array, same length as left_codes
+    :param right_codes: array
+    :param right_time: datetime64 array, same length as right_codes, the right rows need not be sorted
+    :return: int array of positions into the right rows
+    """
+    left_codes = np.asarray(left_codes)
+    right_codes = np.asarray(right_codes)
+    left_time = np.asarray(left_time)
+    right_time = np.asarray(right_time).astype(left_time.dtype)
+    position = np.full(len(left_codes), -1, dtype=np.int64)
+    if len(right_codes) == 0 or len(left_codes) == 0:
+        return position
+
+    codes, right_id = np.unique(right_codes, return_inverse=True)
+    left_id = np.searchsorted(codes, left_codes)
+    known = left_id < len(codes)
+    known[known] = codes[left_id[known]] == left_codes[known]
+
+    # dense rank of the time, then code_id * span + rank is ordered as (code, time)
+    times = np.unique(np.concatenate([left_time, right_time]))
+    span = len(times) + 1
+    right_key = right_id.astype(np.int64) * span + np.searchsorted(times, right_time)
+    order = np.argsort(right_key, kind='stable')
+    right_key = right_key[order]
+    left_key = left_id[known].astype(np.int64) * span + np.searchsorted(times, left_time[known])
+
+    found = np.searchsorted(right_key, left_key, side='right') - 1
+    valid = found >= 0
+    found = np.maximum(found, 0)
+    valid &= right_id[order[found]] == left_id[known]
+    position[known] = np.where(valid, order[found], -1)
+    return position
+
+
+class UniverseMembership:
+    """
+    Universe membership kept as sorted (code, in_time, out_time) intervals, both ends inclusive.
+    NaT out_time means the code is still in the universe.
+    The queries are vectorized by np.searchsorted, and it is only expanded to the (date, code) mask on demand.
+    """
+
+    def __init__(self, component_df: pd.DataFrame):
+        """
+        component_df：
+        code,in_time,out_time
+        000001,2005-04-08,
+        000002,2005-04-08,
+        000008,2016-12-12,2018-06-11
+        :param component_df: index is code
+        """
+        intervals = pd.DataFrame({'code': component_df.index.values,
+                                  'in_time': pd.to_datetime(component_df['in_time']).values,
+                                  'out_time': pd.to_datetime(component_df['out_time']).values})
+        intervals = intervals.sort_values(['code', 'in_time'], kind='mergesort').reset_index(drop=True)
+        # merge the overlapped intervals of the same code, then the intervals of one code are disjoint
+        out_time = intervals['out_time'].fillna(pd.Timestamp.max)
+        running_out = out_time.groupby(intervals['code']).cummax().groupby(intervals['code']).shift(1)
+        new_interval = running_out.isna() | (intervals['in_time'] > running_out)
+        intervals = intervals.assign(out_time=out_time).groupby(new_interval.cumsum()).agg(
+            {'code': 'first', 'in_time': 'min', 'out_time': 'max'})
+
+        self.codes, code_id = np.unique(intervals['code'].values, return_inverse=True)
+        self.code_id = code_id
+        self.in_time = intervals['in_time'].values.astype('datetime64[s]')
+        self.out_time = intervals['out_time'].values.astype('datetime64[s]')
+        self.out_time[intervals['out_time'] == pd.Timestamp.max] = np.datetime64('NaT')
+
+    def __len__(self):
+        return len(self.code_id)
+
+    def is_member(self, dates, codes) -> np.ndarray:
+        """
+        Whether each (date, code) pair is in the universe
+        :param dates: array of dates
+        :param codes: array of codes, same length as dates
+        :return: bool array
+        """
+        time = pd.to_datetime(pd.Index(dates)).values.astype('datetime64[s]')
+        # the last interval of the code starts on or before the date
+        interval = asof_index(codes, time, self.codes[self.code_id], self.in_time)
+        member = interval >= 0
+        out_time = self.out_time[interval[member]]
+        member[member] = np.isnat(out_time) | (out_time >= time[member])
+        return member
+
+    def members_at(self, date) -> np.ndarray:
+        """
+        Codes in the universe at the date
+        :param date:
+        :return:
+        """
+        time = np.datetime64(pd.Timestamp(date).to_datetime64(), 's')
+        inside = (self.in_time <= time) & (np.isnat(self.out_time) | (self.out_time >= time))
+        return np.unique(self.codes[self.code_id[inside]])
+
+    def to_mask(self, trading_date=None, start=None, end=None, universe_name='universe') -> pd.DataFrame:
+        """
+        Expand to the (date, code) mask, only on the trading date if it is given, otherwise every calendar day.
+        :param trading_date: list or TradingCalendar
+        :param start:
+        :param end:
+        :param universe_name:
+        :return:
+        """
+        out_time = np.where(np.isnat(self.out_time),
+                            np.datetime64(pd.Timestamp.now().normalize().to_datetime64(), 's'), self.out_time)
+        if start is None:
+            start = pd.Timestamp(self.in_time.min())
+        if end is None:
+            end = pd.Timestamp(out_time.max())
+        if trading_date is None:
+            calendar = TradingCalendar(pd.date_range(start, end, freq='D'))
+        elif isinstance(trading_date, TradingCalendar):
+            calendar = trading_date
+        else:
+            calendar = TradingCalendar(trading_date)
+        dates = calendar.range(start, end).values
+
+        # each interval covers dates[first: last]
+        first = np.searchsorted(dates, self.in_time.astype(dates.dtype), side='left')
+        last = np.searchsorted(dates, out_time.astype(dates.dtype), side='right')
+        length = np.maximum(last - first, 0)
+        interval = np.repeat(np.arange(len(self)), length)
+        position = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length) + first[interval]
+
+        index = pd.MultiIndex.from_arrays([dates[position], self.codes[self.code_id[interval]]],
+                                          names=['date', 'code'])
+        universe = pd.DataFrame({universe_name: True}, index=index)
+        return universe[~universe.index.duplicated()].sort_index()
 
 
 def component_to_universe(component_df: pd.DataFrame, start=None, end=None, trading_date: None or list = None,
@@ -492,6 +733,7 @@ def component_to_universe(component_df: pd.DataFrame, start=None, end=None, trad
     2010-01-04,000027,True
     2010-01-04,000031,True
 
+    Use UniverseMembership directly if the expanded mask is not necessary.
     :param component_df:
     :param start:
     :param end:
@@ -499,41 +741,11 @@ def component_to_universe(component_df: pd.DataFrame, start=None, end=None, trad
     :param universe_name:
     :return:
     """
-    component_df.fillna(pd.to_datetime(datetime.datetime.now()).strftime('%Y-%m-%d'), inplace=True)
-    if start is None:
-        start = component_df['in_time'].min()
-    if end is None:
-        end = component_df['out_time'].max()
-    if isinstance(start, pd.Timestamp) is False:
+    if start is not None:
         start = pd.to_datetime(start)
-    if isinstance(end, pd.Timestamp) is False:
+    if end is not None:
         end = pd.to_datetime(end)
-
-    # date_index = pd.date_range(start, end, freq='D')
-
-    # pd.MultiIndex.from_product((date_index, component_df.index))
-
-    # slow...
-    #
-
-    universe = pd.DataFrame()
-
-    for idx, row in tqdm.tqdm(component_df.iterrows()):
-        index = pd.date_range(row['in_time'], row['out_time'], freq='D')
-        index.name = 'date'
-        df = pd.DataFrame(index=index)
-        df['code'] = row.name
-        universe = universe.append(df)
-    universe = universe.sort_index()
-    universe = universe.loc[start: end]
-    if trading_date is not None:
-        trade = pd.DataFrame(index=trading_date)
-        universe = trade.join(universe).dropna()
-        universe.index.name = 'date'
-
-    universe[universe_name] = True
-    universe = universe.reset_index().set_index(['date', 'code']).sort_index()
-    return universe
+    return UniverseMembership(component_df).to_mask(trading_date, start, end, universe_name)
 
 
 def get_latest_info_by_date(df: pd.DataFrame, start_pd: pd.Timestamp):
@@ -550,44 +762,104 @@ def get_latest_info_by_date(df: pd.DataFrame, start_pd: pd.Timestamp):
     df = df.drop_duplicates(subset=names, keep='last')
     return df.set_index(names).sort_index()
 
-def get_first_trading_date_by_month(trading_date, month):
-    pass
+def get_first_trading_date_by_month(trading_date, month: int or list) -> pd.DatetimeIndex:
+    """
+    The first trading date of the month(s) in every year, e.g. month=6 gives the first trading date of each June
+    :param trading_date: list or TradingCalendar
+    :param month: int (1-12) or list of int
+    :return:
+    """
+    dates = trading_date.dates if isinstance(trading_date, TradingCalendar) else TradingCalendar(trading_date).dates
+    dates = pd.DatetimeIndex(dates)
+    months = [month] if isinstance(month, int) else list(month)
+    period = dates.year * 12 + dates.month
+    first = np.r_[True, period[1:] != period[:-1]]
+    return dates[first & dates.month.isin(months)]
 
 
 
 
 
+def point_in_time_join(data: pd.DataFrame or pd.Series,
+                        fundamental_data: pd.DataFrame or pd.Series or list,
+                        trading_date: None or list or TradingCalendar = None) -> pd.DataFrame:
+    """
+    As of join of the fundamental tables onto the (date, code) rows of data.
+    Every row gets the latest fundamental row of the same code whose effective date is on or before its date,
+    so there is no look ahead, and an announcement on a date missing in data is still carried to the next row.
+    The effective date is the announcement date, moved to the next trading date if trading_date is given.
+    Several tables are joined in one pass, the columns are in the order of the tables.
+    :param data: index is (date, code)
+    :param fundamental_data: one table or a list of tables, index is (announcement date, code)
+    :param trading_date: list or TradingCalendar
+    :return: data joined with the fundamental columns, nan if nothing is announced yet
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    if not isinstance(fundamental_data, list):
+        fundamental_data = [fundamental_data]
+    calendar = None
+    if trading_date is not None:
+        calendar = trading_date if isinstance(trading_date, TradingCalendar) else TradingCalendar(trading_date)
+
+    dates = pd.to_datetime(data.index.get_level_values(0)).values
+    codes = data.index.get_level_values(1).values
+    joined = [data]
+    for table in fundamental_data:
+        assert isinstance(table.index, pd.MultiIndex)
+        if isinstance(table, pd.Series):
+            table = table.to_frame()
+        effective_date = pd.to_datetime(table.index.get_level_values(0)).values
+        if calendar is not None:
+            effective_date = calendar.next_on_or_after(effective_date).values
+        # announced after the last trading date
+        known = ~np.isnat(effective_date)
+        table = table[known]
+        position = asof_index(codes, dates, table.index.get_level_values(1).values, effective_date[known])
+        # -1 is not in the RangeIndex, so reindex gives nan
+        values = table.reset_index(drop=True).reindex(position)
+        values.index = data.index
+        joined.append(values)
+    return pd.concat(joined, axis=1)
+
+
 def combine_market_with_fundamental(market_data: pd.DataFrame or pd.Series,
-                                    fundamental_data: pd.DataFrame or pd.Series,
+                                    fundamental_data: pd.DataFrame or pd.Series or list,
                                     start=None, end=None,
-                                    trading_date: None or list = None,
+                                    trading_date: None or list or TradingCalendar = None,
                                     suspend_data: None or pd.Series = None,
-                                    universe: pd.Series or pd.DataFrame = None,
+                                    universe: pd.Series or pd.DataFrame or UniverseMembership = None,
                                     ) -> pd.DataFrame:
+    """
+    Point in time merge of the market data and the fundamental data, see point_in_time_join.
+    :param market_data: index is (date, code)
+    :param fundamental_data: one table or a list of tables, index is (announcement date, code)
+    :param start:
+    :param end:
+    :param trading_date: list or TradingCalendar
+    :param suspend_data:
+    :param universe:
+    :return:
+    """
     assert isinstance(market_data.index, pd.MultiIndex)
-    assert isinstance(fundamental_data.index, pd.MultiIndex)
-    if isinstance(fundamental_data, pd.Series):
-        fundamental_data = fundamental_data.to_frame()
+    if not isinstance(fundamental_data, list):
+        fundamental_data = [fundamental_data]
 
     if isinstance(market_data, pd.Series):
         market_data = market_data.to_frame()
 
-    names = fundamental_data.index.names
+    # the fundamental data before start is kept, it is what should have been known at the start date
     if start is not None:
         start_pd = pd.to_datetime(start)
-
         market_data = market_data.loc[start_pd:]
-
-        # transform the fundamental_data that contains data it should have know at the start date
-        fundamental_data = get_latest_info_by_date(fundamental_data, start_pd)
-        if universe is not None:
+        if universe is not None and not isinstance(universe, UniverseMembership):
             universe = universe.loc[start_pd:]
 
     if end is not None:
         end_pd = pd.to_datetime(end)
         market_data = market_data.loc[:end_pd]
-        fundamental_data = fundamental_data.loc[:end_pd]
-        if universe is not None:
+        fundamental_data = [data.loc[:end_pd] for data in fundamental_data]
+        if universe is not None and not isinstance(universe, UniverseMembership):
             universe = universe.loc[:end_pd]
 
     # filter out the universe if necessary
@@ -600,36 +872,33 @@ def combine_market_with_fundamental(market_data: pd.DataFrame or pd.Series,
     #     2010-01-04,000024,True
     #     2010-01-04,000027,True
     #     2010-01-04,000031,True
-    if universe is not None:
+    if isinstance(universe, UniverseMembership):
+        market_data = market_data[universe.is_member(market_data.index.get_level_values(0),
+                                                     market_data.index.get_level_values(1))]
+    elif universe is not None:
         market_data = market_data.loc[universe.index, :]
-        fundamental_data = fundamental_data.loc[(slice(None), universe.index.get_level_values(1).unique()), :]
 
     if suspend_data is not None:
         market_data = market_data.loc[suspend_data.index, :]
 
-    # change announcement date to trading date if necessary
-    if trading_date is not None:
-        fundamental_data = fundamental_data.reset_index()
-        next_trading_dict = next_trading_date_dict(trading_date)
-        fundamental_data[names[0]] = fundamental_data[names[0]].apply(
-            lambda x: no_trading_date_to_next(x, trading_date, next_trading_dict))
-        fundamental_data = fundamental_data.set_index(names)
-
-    # join the data
-    fundamental_data.index.names = market_data.index.names
-
-    merge_df = market_data.join(fundamental_data)
-    ## this is to make sure no future information is in the joined df
-    merge_df = merge_df.groupby(level=1).fillna(method='ffill')
-    ## if the raw_factor data is not included the data, could be nan
-    return merge_df
+    return point_in_time_join(market_data, fundamental_data, trading_date)
 
 
 def combine_fundamental_with_fundamental(fundamental_data1: pd.DataFrame or pd.Series,
                                          fundamental_data2: pd.DataFrame or pd.Series,
                                          start=None, end=None,
-                                         universe: pd.Series or pd.DataFrame = None,
+                                         universe: pd.Series or pd.DataFrame or UniverseMembership = None,
                                          ) -> pd.DataFrame:
+    """
+    Point in time merge of two fundamental tables on the union of their (date, code).
+    If start is given, every code also gets a row at start with what should have been known at that date.
+    :param fundamental_data1:
+    :param fundamental_data2:
+    :param start:
+    :param end:
+    :param universe:
+    :return:
+    """
     assert isinstance(fundamental_data1.index, pd.MultiIndex)
     assert isinstance(fundamental_data2.index, pd.MultiIndex)
     if isinstance(fundamental_data1, pd.Series):
@@ -638,32 +907,35 @@ def combine_fundamental_with_fundamental(fundamental_data1: pd.DataFrame or pd.S
     if isinstance(fundamental_data2, pd.Series):
         fundamental_data2 = fundamental_data2.to_frame()
 
-    if start is not None:
-        start_pd = pd.to_datetime(start)
-
-        # transform the fundamental_data that contains data it should have know at the start date
-
-        fundamental_data1 = get_latest_info_by_date(fundamental_data1, start_pd)
-        fundamental_data2 = get_latest_info_by_date(fundamental_data2, start_pd)
-        if universe is not None:
-            universe = universe.loc[start_pd:]
-
     if end is not None:
         end_pd = pd.to_datetime(end)
         fundamental_data1 = fundamental_data1.loc[:end_pd]
         fundamental_data2 = fundamental_data2.loc[:end_pd]
-        if universe is not None:
-            universe = universe.loc[:end_pd]
 
     if universe is not None:
-        fundamental_data1 = fundamental_data1.loc[(slice(None), universe.index.get_level_values(1).unique()), :]
-        fundamental_data2 = fundamental_data2.loc[(slice(None), universe.index.get_level_values(1).unique()), :]
-
-    merge_df = fundamental_data1.join(fundamental_data2, how='outer', lsuffix='l_')
-    merge_df = merge_df.groupby(level=1).fillna(method='ffill')
-    return merge_df
-
-
+        if isinstance(universe, UniverseMembership):
+            codes = universe.codes
+        else:
+            if start is not None:
+                universe = universe.loc[pd.to_datetime(start):]
+            if end is not None:
+                universe = universe.loc[:pd.to_datetime(end)]
+            codes = universe.index.get_level_values(1).unique()
+        fundamental_data1 = fundamental_data1[fundamental_data1.index.get_level_values(1).isin(codes)]
+        fundamental_data2 = fundamental_data2[fundamental_data2.index.get_level_values(1).isin(codes)]
+
+    names = fundamental_data1.index.names
+    index = fundamental_data1.index.union(fundamental_data2.index)
+    if start is not None:
+        start_pd = pd.to_datetime(start)
+        start_index = pd.MultiIndex.from_product([[start_pd], index.get_level_values(1).unique()])
+        index = index[index.get_level_values(0) > start_pd].union(start_index)
+    index.names = names
+
+    # the same suffix as joining with lsuffix='l_'
+    overlap = fundamental_data1.columns.intersection(fundamental_data2.columns)
+    fundamental_data1 = fundamental_data1.rename(columns={col: col + 'l_' for col in overlap})
+    return point_in_time_join(pd.DataFrame(index=index), [fundamental_data1, fundamental_data2])
 
 
 def filter_suspend(ret, suspend: dict):
@@ -36,6 +36,44 @@ def factor_summary(factor: pd.Series, name='factor') -> pd.DataFrame:
     return summary
 
 
+def masked_pearson_correlation(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation along the last axis, ignoring the NaN entries.
+    x and y should have the same shape and the same NaN mask.
+    :param x:
+    :param y:
+    :return: array with the last axis reduced
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.sum(~np.isnan(x), axis=-1)
+        x_demean = x - (np.nansum(x, axis=-1) / n)[..., np.newaxis]
+        y_demean = y - (np.nansum(y, axis=-1) / n)[..., np.newaxis]
+        cov = np.nansum(x_demean * y_demean, axis=-1)
+        var_x = np.nansum(x_demean ** 2, axis=-1)
+        var_y = np.nansum(y_demean ** 2, axis=-1)
+        corr = cov / np.sqrt(var_x * var_y)
+    return np.where(n > 1, corr, np.nan)
+
+
+def rank_information_coefficient(factor: np.ndarray, returns: np.ndarray) -> np.ndarray:
+    """
+    Spearman information coefficient along the last axis, computed as the pearson correlation of the ranks.
+    factor is broadcast against returns, so a (date x asset) factor panel can be evaluated against a
+    (horizon x date x asset) returns panel in one call.
+    A pair is only used if both factor and return are not NaN, which is the same as spearmanr with nan_policy='omit'.
+    :param factor: np.ndarray
+    :param returns: np.ndarray
+    :return: np.ndarray, with the last axis reduced
+    """
+    factor, returns = np.broadcast_arrays(np.asarray(factor, dtype=float), np.asarray(returns, dtype=float))
+    shape = factor.shape
+    mask = np.isnan(factor) | np.isnan(returns)
+    # rank each row (average method for ties, NaN is kept as NaN) in a single vectorized call
+    factor_rank = pd.DataFrame(np.where(mask, np.nan, factor).reshape(-1, shape[-1])).rank(axis=1)
+    returns_rank = pd.DataFrame(np.where(mask, np.nan, returns).reshape(-1, shape[-1])).rank(axis=1)
+    return masked_pearson_correlation(factor_rank.values.reshape(shape), returns_rank.values.reshape(shape))
+
+
 def calculate_ts_information_coefficient(factor, returns, suffix='ic') -> pd.Series:
     """
     :param factor:
@@ -43,9 +81,8 @@ def calculate_ts_information_coefficient(factor, returns, suffix='ic') -> pd.Ser
     :param suffix:
     :return:
     """
-
-    _ic = returns \
-        .apply(lambda x: stats.spearmanr(x, factor, nan_policy='omit')[0])
+    # (horizon x time) returns against the time series factor
+    _ic = pd.Series(rank_information_coefficient(np.asarray(factor), returns.values.T), index=returns.columns)
     _ic.rename(index={idx: idx + '_' + suffix for idx in _ic.index}, inplace=True)
 
     return _ic
@@ -53,18 +90,26 @@ def calculate_ts_information_coefficient(factor, returns, suffix='ic') -> pd.Ser
 
 def calculate_cs_information_coefficient(merged_data: pd.DataFrame, by_group=False,
                                          suffix='ic') -> pd.DataFrame:
-    merged_data = merged_data.dropna().copy()
-    grouper = [merged_data.index.get_level_values(level=0)]
+    """
+    Cross sectional information coefficient of each date (and each group if by_group is True).
+    The factor and returns are unstacked into dense (date x asset) panels, and the IC of all dates and all
+    horizons are computed at once.
+    :param merged_data:
+    :param by_group:
+    :param suffix:
+    :return:
+    """
+    merged_data = merged_data.dropna()
+    returns_columns = get_returns_columns(merged_data)
     if 'group' in merged_data.columns and by_group:
-        grouper.append('group')
-
-    def src_ic(group):
-        f = group['factor']
-        _ic = group[get_returns_columns(group)] \
-            .apply(lambda x: stats.spearmanr(x, f)[0])
-        return _ic
-    ic = merged_data.groupby(grouper).apply(src_ic)  # type: pd.DataFrame
-    ic.rename(columns={idx: idx + '_' + suffix for idx in ic.columns}, inplace=True)
+        # the row of panel becomes (date, group)
+        merged_data = merged_data.set_index('group', append=True)
+    panel = merged_data[['factor'] + returns_columns].unstack(level=1)  # type: pd.DataFrame
+
+    factor_panel = panel['factor'].values
+    returns_panel = np.stack([panel[col].values for col in returns_columns])
+    ic = rank_information_coefficient(factor_panel, returns_panel)
+    ic = pd.DataFrame(ic.T, index=panel.index, columns=[col + '_' + suffix for col in returns_columns])
     return ic
 
 
@@ -107,15 +152,18 @@ def factor_ols_regression(factor, returns: pd.DataFrame) -> pd.DataFrame:
     return pd.DataFrame(result_dic)
 
 
-def position_turnover(positions: pd.Series):
+def position_turnover(positions) -> pd.Series:
     """
-
-    :param positions:
+    Turnover of each date is the sum of the absolute position change of all assets.
+    :param positions: multi index series or (date x asset) panel
     :return:
     """
     # daily turnover
-    diff = positions.groupby(level=1).diff(1)  # type: pd.Series
-    turnover_ts = diff.groupby(level=0).apply(lambda x: x.abs().sum())  # type: pd.Series
+    position_panel = to_panel(positions)
+    diff = np.abs(np.diff(position_panel.values, axis=0))
+    turnover = np.zeros(len(position_panel))
+    turnover[1:] = np.nansum(diff, axis=1)
+    turnover_ts = pd.Series(turnover, index=position_panel.index)
     turnover_ts.name = 'Turnover'
     return turnover_ts
 
@@ -137,17 +185,16 @@ def mean_return_by_quantile(merged_data: pd.DataFrame) -> tuple:
     :param merged_data:
     :return:
     """
-    grouper = ['factor_quantile', merged_data.index.get_level_values(level=0)]
-    # this computes the mean, std, count for each forwards return
-    # will generate multi columns output
-    #                            1_period_return            ... 10_period_return
-    #                                       mean       std  ...              std count
-    # factor_quantile  Date
-    # 1               2010-06-17        0.002230  0.023423  ...         0.060427    19
-    #                 2010-06-18        0.036203  0.026616  ...         0.053852    20
-    #                 2010-06-21       -0.004873  0.011273  ...         0.039988    19
-    group_stats = merged_data.groupby(grouper)[get_returns_columns(merged_data)] \
-        .agg(['mean', 'std', 'count'])
+    returns_columns = get_returns_columns(merged_data)
+    factor_quantile = merged_data['factor_quantile'].values.astype(float)
+    valid = ~np.isnan(factor_quantile)
+    quantile_codes, quantile_values = pd.factorize(factor_quantile[valid], sort=True)
+    dates = merged_data.index.get_level_values(level=0)
+    date_codes, date_values = pd.factorize(dates[valid], sort=True)
+    # one key for each (quantile, date) pair, the mean of each pair is reduced by bincount
+    keys = quantile_codes * len(date_values) + date_codes
+    observed = np.unique(keys)
+    returns = merged_data[returns_columns].values[valid]
 
     # quantile_ret_ts
     #   1_period_return  5_period_return  10_period_return
@@ -156,7 +203,18 @@ def mean_return_by_quantile(merged_data: pd.DataFrame) -> tuple:
     #                 2010-06-18         0.036203         0.017436         -0.016843
     #                 2010-06-21        -0.004873        -0.017346         -0.035416
     #                 2010-06-22        -0.000315        -0.036443         -0.046313
-    quantile_ret_ts = group_stats.T.xs('mean', level=1).T # type: pd.DataFrame
+    quantile_ret = {}
+    for i, col in enumerate(returns_columns):
+        has_return = ~np.isnan(returns[:, i])
+        total = np.bincount(keys[has_return], weights=returns[has_return, i],
+                            minlength=len(quantile_values) * len(date_values))
+        count = np.bincount(keys[has_return], minlength=len(quantile_values) * len(date_values))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            quantile_ret[col] = (total / count)[observed]
+    index = pd.MultiIndex.from_arrays([quantile_values[observed // len(date_values)],
+                                       date_values[observed % len(date_values)]],
+                                      names=['factor_quantile', dates.name])
+    quantile_ret_ts = pd.DataFrame(quantile_ret, index=index, columns=returns_columns)  # type: pd.DataFrame
     # quantile_ret_ts.dropna(inplace=True)
     # quantile_ret_ts.sort_index(level=1, inplace=True)
     #              1_period_return            ... 10_period_return
@@ -133,10 +133,9 @@ def overlaid_factor_distribution_plot(in_sample_factor: pd.Series, out_sample_fa
 
 
 def observed_qq_plot(in_sample_factor: pd.Series, out_sample_factor: pd.Series):
-    x = in_sample_factor.values
-    y = out_sample_factor.values
-    x.sort()
-    y.sort()
+    # sort a copy, the factor may be shared by the result cache
+    x = np.sort(in_sample_factor.values)
+    y = np.sort(out_sample_factor.values)
 
     fig = go.Figure()
     pts = go.Scatter(x=x,
@@ -156,13 +155,15 @@ def observed_qq_plot(in_sample_factor: pd.Series, out_sample_factor: pd.Series):
     return fig
 
 
-def position_plot(position: pd.Series) -> go.Figure:
+def position_plot(position) -> go.Figure:
     """
 
     :param position:
     :return:
     """
     # todo so many lines here, need to support selection functionality.
+    if isinstance(position, pd.DataFrame):
+        position = position.stack()
     fig = go.Figure()
     strftime_format = generate_strftime_format(position.index.get_level_values(0))
     for asset_ts in position.groupby(level=1):
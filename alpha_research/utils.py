@@ -2,27 +2,134 @@ import pandas as pd
 from scipy import stats
 import numpy as np
 import inspect
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Server side LRU cache for factors and intermediate results.
+    It is keyed by any hashable object, e.g. (factor key, universe, forward return periods).
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        # the Dash server calls from several threads, a lookup and its move_to_end must not interleave with an eviction
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """
+        Return the cached value of key, or call func(*args, **kwargs) and cache the result.
+        func runs outside the lock, so two threads missing the same key may both compute it.
+        :param key:
+        :param func:
+        :return:
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        value = func(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# memoized forward returns, keyed by (data fingerprint, periods, price_key)
+forward_returns_cache = ResultCache()
+
+
+def data_fingerprint(data) -> str:
+    """
+    Fingerprint of the values and the index of a pandas object, used as the cache key
+    :param data:
+    :return:
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=True).values).hexdigest()
+
+
+def forward_returns_array(price: np.ndarray, asset_codes: np.ndarray, periods: list) -> np.ndarray:
+    """
+    Forward returns of all periods at once by shifting the price array.
+    Same as pct_change(periods=period).shift(-period) in each asset, the price is forward filled in each asset first.
+    :param price: float array
+    :param asset_codes: int array, the asset of each row
+    :param periods: list of int
+    :return: (rows x periods) array
+    """
+    n = len(price)
+    # rows of the same asset are contiguous after the stable sort, in their original order
+    order = np.argsort(asset_codes, kind='stable')
+    sorted_price = price[order]
+    sorted_codes = asset_codes[order]
+    position = np.arange(n)
+
+    new_asset = np.ones(n, dtype=bool)
+    new_asset[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    fill_index = np.maximum.accumulate(np.where(new_asset | ~np.isnan(sorted_price), position, 0))
+    sorted_price = sorted_price[fill_index]
+
+    target = position[:, np.newaxis] + np.asarray(periods, dtype=int)[np.newaxis, :]
+    valid = target < n
+    target = np.where(valid, target, 0)
+    valid &= sorted_codes[target] == sorted_codes[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        forward = sorted_price[target] / sorted_price[:, np.newaxis] - 1
+    forward[~valid] = np.nan
+
+    returns = np.empty_like(forward)
+    returns[order] = forward
+    return returns
 
 
 def calculate_forward_returns(data: pd.DataFrame, periods: list, price_key='close') -> pd.DataFrame:
     """
     Calculate the different steps forward return
+    All periods are calculated in one shot, and the result is memoized on (data fingerprint, periods, price_key)
     :param data:
     :param periods: list of int
     :param price_key:
     :return:
     """
-    returns = pd.DataFrame(index=data.index)
-    for period in periods:
-        if type(data.index) == pd.MultiIndex:
-            def multi_index_forward_returns(df: pd.DataFrame):
-                return df[price_key].pct_change(periods=period).shift(-period)
+    periods = list(dict.fromkeys(int(period) for period in periods))
+    key = (data_fingerprint(data[price_key]), tuple(periods), price_key)
 
-            tmp = data.groupby(level=1).apply(multi_index_forward_returns).droplevel(0)
-            returns[str(period) + '_period_return'] = tmp
+    def _calculate():
+        if type(data.index) == pd.MultiIndex:
+            asset_codes = pd.factorize(data.index.get_level_values(level=1))[0]
         else:
-            returns[str(period) + '_period_return'] = data[price_key].pct_change(periods=period).shift(-period)
-    return returns
+            asset_codes = np.zeros(len(data), dtype=int)
+        return pd.DataFrame(forward_returns_array(data[price_key].values.astype(float), asset_codes, periods),
+                            index=data.index, columns=[str(period) + '_period_return' for period in periods])
+
+    return forward_returns_cache.get_or_compute(key, _calculate).copy()
 
 
 def calculate_cumulative_returns(returns, starting_value=0, out=None):
@@ -86,7 +193,19 @@ def calculate_cumulative_returns_by_group(quantile_ret_ts: pd.DataFrame):
     return cumulative_ret_by_group
 
 
-def calculate_position(factor: pd.Series):
+def to_panel(data) -> pd.DataFrame:
+    """
+    Transform the multi index (date, asset) series into the dense (date x asset) panel.
+    A DataFrame is regarded as a panel already and is returned as it is.
+    :param data:
+    :return:
+    """
+    if isinstance(data, pd.DataFrame):
+        return data
+    return data.unstack(level=1)
+
+
+def calculate_position(factor):
     """
     The position of cross sectional alpha is calculated by
     alpha / (sum(abs(alpha)))
@@ -101,10 +220,18 @@ def calculate_position(factor: pd.Series):
                 2318.HK  -3
     summation = |2| + |5| + |-10| + |-7| + |-7| + |-3|= 34
 
+    factor could be multi index series or (date x asset) panel, the position is returned in the same form.
     :param factor:
     :return:
     """
-    return factor.groupby(level=0).apply(lambda x: x / x.abs().sum())
+    if isinstance(factor, pd.DataFrame):
+        return factor.div(factor.abs().sum(axis=1), axis=0)
+    date_codes = pd.factorize(factor.index.get_level_values(level=0))[0]
+    values = factor.values.astype(float)
+    gross = np.bincount(date_codes, weights=np.nan_to_num(np.abs(values)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = values / gross[date_codes]
+    return pd.Series(position, index=factor.index, name=factor.name)
 
 
 def trading_basket(last_position, alpha):
@@ -131,57 +258,148 @@ def calculate_quantile_returns(factor, quantile_lower, quantile_upper) -> pd.Ser
     return factor_df['quantile_factor']
 
 
+def sort_within_key(keys: np.ndarray, values: np.ndarray) -> tuple:
+    """
+    Sort the rows by (key, value) once, NaN values are placed at the end of each key.
+    :param keys: non negative int array, e.g. the codes of the date
+    :param values: float array
+    :return: order, sorted keys, sorted values, valid count of each key, first position of each key
+    """
+    order = np.lexsort((values, keys))
+    sorted_keys = keys[order]
+    sorted_values = values[order]
+    valid = ~np.isnan(values)
+    count = np.bincount(keys[valid], minlength=keys.max() + 1 if len(keys) > 0 else 0)
+    start = np.searchsorted(sorted_keys, np.arange(len(count)))
+    return order, sorted_keys, sorted_values, count, start
+
+
+def quantile_bucket(keys: np.ndarray, values: np.ndarray, quantiles) -> np.ndarray:
+    """
+    Same as calling pd.qcut(x, quantiles, labels=False) + 1 for each key, without the groupby.
+    The min rank of each row inside its key is mapped to the quantile edges arithmetically,
+    which is the position of the linear interpolation used by pd.qcut.
+    :param keys:
+    :param values:
+    :param quantiles: int or list of quantiles in [0, 1]
+    :return: float array, NaN if out of range
+    """
+    if isinstance(quantiles, int):
+        quantiles = np.linspace(0, 1, quantiles + 1)
+    quantiles = np.asarray(quantiles, dtype=float)
+    order, sorted_keys, sorted_values, count, start = sort_within_key(keys, values)
+
+    # a tie covers the rank from its first row to its last row
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    run_id = np.cumsum(new_run) - 1
+    run_start = np.flatnonzero(new_run)
+    run_end = np.append(run_start[1:], len(order)) - 1
+    rank = run_start[run_id] - start[sorted_keys]
+    last_rank = run_end[run_id] - start[sorted_keys]
+
+    last = (count[sorted_keys] - 1).astype(float)
+    edge_count = np.zeros(len(order), dtype=int)
+    for q in quantiles:
+        edge_count += q * last < rank
+    bucket = np.maximum(edge_count, 1).astype(float)
+    out_of_range = (last_rank < quantiles[0] * last) | (edge_count == len(quantiles)) | \
+                   np.isnan(sorted_values) | (last < 1)
+    bucket[out_of_range] = np.nan
+
+    result = np.empty(len(order))
+    result[order] = bucket
+    return result
+
+
+def equal_width_bucket(keys: np.ndarray, values: np.ndarray, bins: int) -> np.ndarray:
+    """
+    Same as calling pd.cut(x, bins, labels=False) + 1 for each key, without the groupby.
+    The bins are equal width between the min and the max of each key.
+    :param keys:
+    :param values:
+    :param bins: int
+    :return: float array
+    """
+    order, sorted_keys, sorted_values, count, start = sort_within_key(keys, values)
+    has_value = count > 0
+    mn = np.full(len(count), np.nan)
+    mx = np.full(len(count), np.nan)
+    mn[has_value] = sorted_values[start[has_value]]
+    mx[has_value] = sorted_values[start[has_value] + count[has_value] - 1]
+
+    # pd.cut adjusts the end points if all values are the same
+    same = mn == mx
+    mn = np.where(same, mn - np.where(mn != 0, 0.001 * np.abs(mn), 0.001), mn)
+    mx = np.where(same, mx + np.where(mx != 0, 0.001 * np.abs(mx), 0.001), mx)
+    step = (mx - mn) / bins
+
+    bucket = np.ones(len(order))
+    for k in range(1, bins):
+        bucket += (k * step + mn)[sorted_keys] < sorted_values
+    bucket[np.isnan(sorted_values)] = np.nan
+
+    result = np.empty(len(order))
+    result[order] = bucket
+    return result
+
+
 def quantize_factor(merged_data: pd.DataFrame, quantiles: list = None, bins: int = None, grouped=False):
     """
     merged_data multi index, level 0 is pd.Timestamp, level 1 is asset code.
     two column, factor and 'group'
+    quantiles follows pd.qcut, bins follows pd.cut (equal width in each date).
     :param grouped:
     :param merged_data:
     :param quantiles:
     :param bins:
     :return:
     """
-    merged_data = merged_data.copy().drop_duplicates()
     if not ((quantiles is not None and bins is None) or
             (quantiles is None and bins is not None)):
         raise ValueError('Either quantiles or bins should be provided')
 
-    grouper = [merged_data.index.get_level_values(level=0)]
+    factor = merged_data['factor'].values.astype(float)
+    keys = pd.factorize(merged_data.index.get_level_values(level=0))[0]
     if 'group' in merged_data.columns and grouped is True:
-        grouper.append('group')
-
-    def quantile_calc(x, _quantiles, _bins):
-        if _quantiles is not None and _bins is None:
-            return pd.qcut(x, _quantiles, labels=False) + 1
-        elif _bins is not None and _quantiles is None:
-            return pd.cut(x, _bins, labels=False, duplicates='drop') + 1
+        group_codes = pd.factorize(merged_data['group'])[0]
+        # row without group is not quantized
+        factor = np.where(group_codes < 0, np.nan, factor)
+        keys = keys * (group_codes.max() + 1) + np.maximum(group_codes, 0)
 
-    factor_quantile = merged_data.groupby(grouper)['factor'] \
-        .apply(quantile_calc, quantiles, bins)
+    if quantiles is not None:
+        factor_quantile = quantile_bucket(keys, factor, quantiles)
+    else:
+        factor_quantile = equal_width_bucket(keys, factor, bins)
+    factor_quantile = pd.Series(factor_quantile, index=merged_data.index)
     factor_quantile.name = 'factor_quantile'
     return factor_quantile
 
 
-def calculate_cross_section_factor_returns(data: pd.DataFrame, position: pd.Series, price_key='close',
+def calculate_cross_section_factor_returns(data: pd.DataFrame, position, price_key='close',
                                            factor_name='cross_sectional_factor') -> pd.DataFrame:
     """
-
+    The factor return of each date is the dot product of the last position and the return of each asset.
     :param data:
-    :param position:
+    :param position: multi index series or (date x asset) panel
     :param price_key:
     :param factor_name:
     :return:
     """
 
     # todo returns with different holding period
+    price_panel = to_panel(data[price_key])
     # first shift the factor by date, because the factor can only decide future return
-    shifted_position = position.groupby(level=1).shift(1)
-    rate_of_return = data[price_key].groupby(level=1).pct_change()
-    # do multiple elementwise
-    factor_returns = pd.DataFrame(shifted_position.values * rate_of_return.values, index=rate_of_return.index)
-    # sum up the return in the same date.
-    factor_returns = factor_returns.groupby(level=0).sum()
-    factor_returns.rename({0: factor_name}, axis=1, inplace=True)
+    position_panel = to_panel(position).reindex(index=price_panel.index, columns=price_panel.columns)
+    shifted_position = np.roll(position_panel.values, 1, axis=0)
+    shifted_position[0] = np.nan
+    price = price_panel.ffill().values
+    rate_of_return = np.full_like(price, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate_of_return[1:] = price[1:] / price[:-1] - 1
+    # row wise dot product, sum up the return in the same date.
+    factor_returns = np.einsum('ij,ij->i', np.nan_to_num(shifted_position), np.nan_to_num(rate_of_return))
+    factor_returns = pd.DataFrame({factor_name: factor_returns}, index=price_panel.index)
     return factor_returns
 
 
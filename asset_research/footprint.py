@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from asset_research.orderbook import tick_decimals
+
+"""
+Footprint of the tick stream
+
+The buy and sell volume of the ticks are summed in a (time bucket x price level) matrix on the fixed-tick price axis,
+in one vectorized pass per batch of ticks. The matrix grows with slack in both directions, so the live updates only
+cost the new ticks, and the matrix of the buckets and prices seen is a view of the storage.
+"""
+
+
+class Footprint:
+
+    def __init__(self, tick_size: float, freq: str = '1T', time_key='time', price_key='price', volume_key='volume',
+                 direction_key='ticker_direction'):
+        """
+        :param tick_size: price step of the price levels
+        :param freq: time bucket
+        :param time_key: columns of the ticks
+        :param price_key:
+        :param volume_key:
+        :param direction_key: BUY, SELL or NEUTRAL, the neutral ticks only update the last price
+        """
+        self.tick_size = tick_size
+        self.freq = pd.Timedelta(freq).value
+        self.time_key = time_key
+        self.price_key = price_key
+        self.volume_key = volume_key
+        self.direction_key = direction_key
+
+        # storage row 0 is bucket _r0 and column 0 is price level _c0, levels are price / tick_size
+        self._r0, self._c0 = 0, 0
+        self.buy = np.zeros((0, 0))
+        self.sell = np.zeros((0, 0))
+        self.flow = np.zeros(0)  # signed turnover of each bucket
+        self.last_price = np.full(0, np.nan)
+        self.last_time = np.full(0, np.iinfo(np.int64).min)
+        # buckets and price levels seen, inclusive
+        self.bucket_range = None
+        self.level_range = None
+
+    def _ensure(self, bucket_lo, bucket_hi, level_lo, level_hi):
+        if self.bucket_range is not None:
+            bucket_lo, bucket_hi = min(bucket_lo, self.bucket_range[0]), max(bucket_hi, self.bucket_range[1])
+            level_lo, level_hi = min(level_lo, self.level_range[0]), max(level_hi, self.level_range[1])
+        n_row, n_col = self.buy.shape
+        fits = self._r0 <= bucket_lo and bucket_hi < self._r0 + n_row and \
+            self._c0 <= level_lo and level_hi < self._c0 + n_col
+        if not fits:
+            # slack after the last bucket for the live buckets and around the price levels
+            need_row, need_col = bucket_hi - bucket_lo + 1, level_hi - level_lo + 1
+            r0, c0 = bucket_lo, level_lo - need_col // 4
+            shape = (need_row + max(need_row // 2, 16), need_col + 2 * (need_col // 4))
+            buy, sell = np.zeros(shape), np.zeros(shape)
+            flow = np.zeros(shape[0])
+            last_price = np.full(shape[0], np.nan)
+            last_time = np.full(shape[0], np.iinfo(np.int64).min)
+            if self.bucket_range is not None:
+                old_rows = slice(self.bucket_range[0] - self._r0, self.bucket_range[1] - self._r0 + 1)
+                old_cols = slice(self.level_range[0] - self._c0, self.level_range[1] - self._c0 + 1)
+                rows = slice(self.bucket_range[0] - r0, self.bucket_range[1] - r0 + 1)
+                cols = slice(self.level_range[0] - c0, self.level_range[1] - c0 + 1)
+                buy[rows, cols] = self.buy[old_rows, old_cols]
+                sell[rows, cols] = self.sell[old_rows, old_cols]
+                flow[rows] = self.flow[old_rows]
+                last_price[rows] = self.last_price[old_rows]
+                last_time[rows] = self.last_time[old_rows]
+            self._r0, self._c0 = r0, c0
+            self.buy, self.sell, self.flow, self.last_price, self.last_time = buy, sell, flow, last_price, last_time
+        self.bucket_range = (bucket_lo, bucket_hi)
+        self.level_range = (level_lo, level_hi)
+
+    def update(self, tick_df: pd.DataFrame):
+        """
+        Add the ticks, in any order and across the buckets already seen
+        """
+        if len(tick_df) == 0:
+            return
+        time = pd.to_datetime(tick_df[self.time_key]).values.astype(np.int64)
+        price = tick_df[self.price_key].values.astype(np.float64)
+        volume = tick_df[self.volume_key].values.astype(np.float64)
+        direction = tick_df[self.direction_key].values
+        sign = np.where(direction == 'BUY', 1., np.where(direction == 'SELL', -1., 0.))
+
+        bucket = time // self.freq
+        level = np.rint(price / self.tick_size).astype(np.int64)
+        self._ensure(bucket.min(), bucket.max(), level.min(), level.max())
+
+        # sum of the sub matrix covered by the batch
+        row = bucket - bucket.min()
+        col = level - level.min()
+        width = col.max() + 1
+        shape = (row.max() + 1, width)
+        rows = slice(bucket.min() - self._r0, bucket.max() - self._r0 + 1)
+        cols = slice(level.min() - self._c0, level.max() - self._c0 + 1)
+        key = row * width + col
+        for side, mask in [(self.buy, sign > 0), (self.sell, sign < 0)]:
+            side[rows, cols] += np.bincount(key[mask], weights=volume[mask], minlength=shape[0] * width) \
+                .reshape(shape)
+        self.flow[rows] += np.bincount(row, weights=sign * price * volume, minlength=shape[0])
+
+        # last price of each bucket, the latest tick of the batch replaces the stored one if it is not earlier
+        order = np.argsort(time, kind='mergesort')
+        reverse_first = np.unique(row[order][::-1], return_index=True)[1]
+        last = order[len(order) - 1 - reverse_first]
+        target = bucket[last] - self._r0
+        newer = time[last] >= self.last_time[target]
+        self.last_price[target[newer]] = price[last[newer]]
+        self.last_time[target[newer]] = time[last[newer]]
+
+    def _view(self, x):
+        rows = slice(self.bucket_range[0] - self._r0, self.bucket_range[1] - self._r0 + 1)
+        if x.ndim == 1:
+            return x[rows]
+        return x[rows, self.level_range[0] - self._c0: self.level_range[1] - self._c0 + 1]
+
+    def matrix(self) -> dict:
+        """
+        Views of the buckets and price levels seen
+        :return: time, price, buy, sell (time x price), flow, last_price
+        """
+        if self.bucket_range is None:
+            return {'time': pd.DatetimeIndex([]), 'price': np.zeros(0), 'buy': self.buy, 'sell': self.sell,
+                    'flow': self.flow, 'last_price': self.last_price}
+        time = pd.to_datetime(np.arange(self.bucket_range[0], self.bucket_range[1] + 1) * self.freq)
+        price = np.round(np.arange(self.level_range[0], self.level_range[1] + 1) * self.tick_size,
+                         tick_decimals(self.tick_size))
+        return {'time': time, 'price': price, 'buy': self._view(self.buy), 'sell': self._view(self.sell),
+                'flow': self._view(self.flow), 'last_price': self._view(self.last_price)}
+
+    def signed_volume(self) -> pd.DataFrame:
+        """
+        Buy volume - sell volume, time bucket x price level
+        """
+        m = self.matrix()
+        return pd.DataFrame(m['buy'] - m['sell'], index=m['time'], columns=m['price'])
+
+    def table(self) -> pd.DataFrame:
+        """
+        Footprint table, price levels in descending order x (time bucket, SELL / BUY), the sell volume is negative.
+        The cells of a column between its first and last traded prices are 0 if not traded, the others are NaN.
+        """
+        m = self.matrix()
+        n_time = len(m['time'])
+        # columns: SELL then BUY of each bucket
+        values = np.empty((2 * n_time, len(m['price'])))
+        values[0::2] = -m['sell']
+        values[1::2] = m['buy']
+        traded = values != 0
+        position = np.arange(values.shape[1])
+        first = np.argmax(traded, axis=1)
+        last = values.shape[1] - 1 - np.argmax(traded[:, ::-1], axis=1)
+        inside = (position >= first[:, None]) & (position <= last[:, None]) & traded.any(axis=1)[:, None]
+        values = np.where(inside, values, np.nan)
+        columns = pd.MultiIndex.from_arrays([np.repeat(m['time'], 2), np.tile(['SELL', 'BUY'], n_time)],
+                                            names=['time', 'ticker_direction'])
+        return pd.DataFrame(values.T[::-1], index=pd.Index(m['price'][::-1], name='price'), columns=columns)
+
+    def order_flow(self) -> pd.DataFrame:
+        """
+        Signed turnover and last price of each bucket
+        """
+        m = self.matrix()
+        return pd.DataFrame({'order_flow': m['flow'], 'price': m['last_price']}, index=m['time'])
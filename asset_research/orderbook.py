@@ -0,0 +1,437 @@
+import os
+import json
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+"""
+Columnar orderbook storage and incremental orderbook grid
+
+The orderbook recordings (json lines of code, svr_recv_time_bid, svr_recv_time_ask, Bid and Ask) are converted once
+to fixed-width columns, a row per price level sorted by time: time, snapshot, code, side, level, price, volume and
+order_count, a snapshot without bid and ask levels keeps a row of side and level EMPTY and nan price. They are saved
+as a folder of .npy files read memory-mapped by OrderbookStore, so a time range is sliced without loading the day, or
+as a parquet file of which only the row groups overlapping the time range are decoded.
+
+The depth of the orderbook snapshots is kept in a (time x price) matrix on a fixed-tick price axis, in a ring buffer
+of the last capacity rows. A snapshot is written in O(levels) and the last rows are a view of the buffer: each row is
+written twice, at slot and slot + capacity, so any window of the last rows is contiguous in the buffer.
+"""
+
+
+def orderbook_time(orderbook_df: pd.DataFrame) -> pd.Series:
+    """
+    Time of the snapshots, the later receive time of bid and ask
+    """
+    bid_time = pd.to_datetime(orderbook_df['svr_recv_time_bid'])
+    ask_time = pd.to_datetime(orderbook_df['svr_recv_time_ask'])
+    return bid_time.where(bid_time > ask_time, ask_time)
+
+
+COLUMNS = ['time', 'snapshot', 'code', 'side', 'level', 'price', 'volume', 'order_count']
+BID, ASK = 0, 1
+# side and level of the row of a snapshot without bid and ask levels, its price and volume are nan
+EMPTY = -1
+# rows of a parquet row group, the unit OrderbookStore decodes
+ROW_GROUP_SIZE = 100000
+
+
+def orderbook_columns(records: list, code_names: list = None) -> dict:
+    """
+    Fixed-width columns of the orderbook records, the records without time are dropped
+    :param records: orderbook records of read_orderbook_json
+    :param code_names: the codes are numbered in the order of the list, the new codes are appended to it
+    :return: dict of the columns, code_names
+    """
+    code_names = [] if code_names is None else code_names
+    code_id = {code: i for i, code in enumerate(code_names)}
+    codes = np.array([code_id.setdefault(r.get('code'), len(code_id)) for r in records], dtype=np.int32)
+    code_names.extend(list(code_id)[len(code_names):])
+    time = orderbook_time(pd.DataFrame({'svr_recv_time_bid': [r.get('svr_recv_time_bid') for r in records],
+                                        'svr_recv_time_ask': [r.get('svr_recv_time_ask') for r in records]})).values
+
+    # snapshots numbered in time order
+    order = np.argsort(time, kind='mergesort')
+    order = order[~np.isnat(time[order])]
+    rank = np.full(len(records), -1, dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    sides = []
+    n_levels = np.zeros(len(records), dtype=np.int64)
+    for side, key in [(BID, 'Bid'), (ASK, 'Ask')]:
+        levels = [r.get(key) or [] for r in records]
+        count = np.fromiter(map(len, levels), dtype=np.int64, count=len(levels))
+        n_levels += count
+        values = np.array([(lv[0], lv[1], lv[2] if len(lv) > 2 else np.nan) for lv in chain.from_iterable(levels)],
+                          dtype=np.float64).reshape(-1, 3)
+        record = np.repeat(np.arange(len(records)), count)
+        level = np.arange(len(record)) - np.repeat(np.cumsum(count) - count, count)
+        sides.append((record, np.full(len(record), side, dtype=np.int8), level, values))
+    # a snapshot without any level keeps a row of side and level EMPTY, so the snapshots are all kept
+    record = np.flatnonzero(n_levels == 0)
+    sides.append((record, np.full(len(record), EMPTY, dtype=np.int8), np.full(len(record), EMPTY),
+                  np.full((len(record), 3), np.nan)))
+    record, side, level, values = [np.concatenate(c) for c in zip(*sides)]
+
+    valid = rank[record] >= 0
+    record, side, level, values = record[valid], side[valid], level[valid], values[valid]
+    order = np.lexsort((level, side, rank[record]))
+    record = record[order]
+    columns = {'time': time[record], 'snapshot': rank[record], 'code': codes[record], 'side': side[order],
+               'level': level[order].astype(np.int16), 'price': values[order, 0], 'volume': values[order, 1],
+               'order_count': values[order, 2]}
+    return columns, code_names
+
+
+def convert_orderbook_json(path: str, save_path: str, chunksize: int = 100000):
+    """
+    Convert the json lines recording to the columnar storage read by OrderbookStore
+    :param path: json lines file of the orderbook records
+    :param save_path: folder of .npy files, or a .parquet file
+    :param chunksize: number of records parsed at once
+    :return:
+    """
+    chunks, code_names, n_snapshot = [], [], 0
+    with open(path, 'r') as file:
+        while True:
+            lines = [line for _, line in zip(range(chunksize), file)]
+            if len(lines) == 0:
+                break
+            columns, code_names = orderbook_columns([json.loads(line) for line in lines if line.strip()], code_names)
+            columns['snapshot'] += n_snapshot
+            n_snapshot += len(np.unique(columns['snapshot']))
+            chunks.append(columns)
+    columns = {name: np.concatenate([c[name] for c in chunks]) for name in COLUMNS}
+    # the chunks are sorted by time, sort across the chunks and number the snapshots again
+    order = np.lexsort((columns['level'], columns['side'], columns['snapshot'], columns['time']))
+    columns = {name: c[order] for name, c in columns.items()}
+    first = np.r_[True, columns['snapshot'][1:] != columns['snapshot'][:-1]]
+    columns['snapshot'] = np.cumsum(first) - 1
+    save_orderbook(columns, code_names, save_path)
+
+
+def save_orderbook(columns: dict, code_names: list, save_path: str):
+    if os.path.splitext(save_path)[1] == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = [pa.array(columns[name]) for name in COLUMNS]
+        arrays[COLUMNS.index('code')] = pa.DictionaryArray.from_arrays(pa.array(columns['code']),
+                                                                        pa.array(code_names, type=pa.string()))
+        table = pa.Table.from_arrays(arrays, names=COLUMNS).replace_schema_metadata(
+            {'code_names': json.dumps(list(code_names))})
+        pq.write_table(table, save_path, row_group_size=ROW_GROUP_SIZE)
+    else:
+        if os.path.exists(save_path) is False:
+            os.makedirs(save_path)
+        for name in COLUMNS:
+            np.save(os.path.join(save_path, name + '.npy'), columns[name])
+        np.save(os.path.join(save_path, 'code_names.npy'), np.array(code_names, dtype=str))
+
+
+class OrderbookStore:
+    """
+    Reader of the columnar orderbook storage, the .npy folder is memory-mapped and sliced without copy,
+    the parquet file is read by the row groups overlapping the time range
+    """
+
+    def __init__(self, path: str):
+        if os.path.splitext(path)[1] == '.parquet':
+            import pyarrow.parquet as pq
+            self._parquet = pq.ParquetFile(path, memory_map=True)
+            metadata = self._parquet.schema_arrow.metadata or {}
+            if b'code_names' in metadata:
+                self.code_names = json.loads(metadata[b'code_names'])
+            else:
+                self.code_names = self._parquet.read_row_group(0, columns=['code']).column('code').chunk(0) \
+                    .dictionary.to_pylist()
+            self._group_time = self._row_group_time()
+            self.columns = None
+        else:
+            self._parquet = None
+            self.code_names = np.load(os.path.join(path, 'code_names.npy')).tolist()
+            self.columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+
+    def _row_group_time(self) -> np.ndarray or None:
+        # (min, max) time of each row group from the statistics, None if any is missing
+        metadata = self._parquet.metadata
+        position = self._parquet.schema_arrow.get_field_index('time')
+        bounds = []
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(position).statistics
+            if statistics is None or not statistics.has_min_max:
+                return None
+            # the statistics may be datetime of microseconds, widen the max by 1 microsecond
+            bounds.append((pd.Timestamp(statistics.min).to_datetime64(),
+                           (pd.Timestamp(statistics.max) + pd.Timedelta(microseconds=1)).to_datetime64()))
+        return np.array(bounds, dtype='datetime64[ns]').reshape(-1, 2)
+
+    def _read_parquet(self, start, end) -> dict:
+        groups = np.arange(self._parquet.metadata.num_row_groups)
+        if self._group_time is not None:
+            keep = np.ones(len(groups), dtype=bool)
+            if start is not None:
+                keep &= self._group_time[:, 1] >= start
+            if end is not None:
+                keep &= self._group_time[:, 0] < end
+            groups = groups[keep]
+        table = self._parquet.read_row_groups(groups.tolist(), columns=COLUMNS)
+        columns = {name: table.column(name).to_numpy() for name in COLUMNS if name != 'code'}
+        # the dictionary of each chunk mapped to the positions of code_names
+        codes = []
+        for chunk in table.column('code').chunks:
+            indices = chunk.indices.to_numpy(zero_copy_only=False)
+            lookup = np.array([self.code_names.index(c) for c in chunk.dictionary.to_pylist()] + [-1],
+                              dtype=indices.dtype)
+            codes.append(lookup[indices])
+        columns['code'] = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int32)
+        return columns
+
+    def __len__(self):
+        if self._parquet is not None:
+            return self._parquet.metadata.num_rows
+        return len(self.columns['time'])
+
+    def slice(self, start=None, end=None, code: str = None) -> dict:
+        """
+        Columns of the levels with start <= time < end,
+        views of the .npy storage unless code is given, the decoded row groups of the parquet file
+        """
+        start = None if start is None else pd.Timestamp(start).to_datetime64()
+        end = None if end is None else pd.Timestamp(end).to_datetime64()
+        columns = self.columns if self._parquet is None else self._read_parquet(start, end)
+        time = columns['time']
+        i = 0 if start is None else np.searchsorted(time, start)
+        j = len(time) if end is None else np.searchsorted(time, end)
+        columns = {name: c[i:j] for name, c in columns.items()}
+        if code is not None:
+            mask = columns['code'] == self.code_names.index(code)
+            columns = {name: c[mask] for name, c in columns.items()}
+        return columns
+
+    def to_pandas(self, start=None, end=None, code: str = None) -> pd.DataFrame:
+        df = pd.DataFrame(self.slice(start, end, code))
+        df['code'] = pd.Categorical.from_codes(df['code'], self.code_names)
+        return df
+
+
+def infer_tick_size(prices: np.ndarray) -> float:
+    """
+    Smallest price difference, rounded to 6 significant digits, 100.03 - 100.02 is 0.009999999999990905 in float
+    """
+    prices = np.unique(prices[np.isfinite(prices)])
+    diff = np.diff(prices)
+    diff = diff[diff > 1e-12]
+    if len(diff) == 0:
+        return 1.
+    tick_size = float(diff.min())
+    return round(tick_size, 5 - int(np.floor(np.log10(tick_size))))
+
+
+def tick_decimals(tick_size: float) -> int:
+    """
+    Decimals of the tick size, the prices on the tick axis are rounded to them
+    """
+    for decimals in range(12):
+        if abs(round(tick_size, decimals) - tick_size) <= 1e-9 * tick_size:
+            return decimals
+    return 12
+
+
+class OrderbookGrid:
+
+    def __init__(self, tick_size: float, price_min: float = None, price_max: float = None, n_ticks: int = 200,
+                 capacity: int = 3600, freq: str = None):
+        """
+        :param tick_size: price step of the axis
+        :param price_min: lowest price of the axis, the axis is centered at the first mid price if None
+        :param price_max: highest price of the axis
+        :param n_ticks: number of prices of the axis if the axis is centered at the first mid price
+        :param capacity: number of the rows kept
+        :param freq: the snapshots of the same time bucket are averaged into a row, a row per snapshot if None
+        """
+        self.tick_size = tick_size
+        self.capacity = capacity
+        self.freq = None if freq is None else pd.Timedelta(freq).value
+        self.n_ticks = n_ticks
+        self.prices = None
+        if price_min is not None and price_max is not None:
+            self._set_axis(price_min, int(round((price_max - price_min) / tick_size)) + 1)
+
+        self.n = 0  # number of the rows written
+        self.time = np.empty(2 * capacity, dtype='datetime64[ns]')
+        self.best_bid = np.full(2 * capacity, np.nan)
+        self.best_ask = np.full(2 * capacity, np.nan)
+        self._bucket = None
+        self._touched = [[None, None] for _ in range(capacity)]  # columns written in each slot, bid and ask
+
+    def _set_axis(self, price_min, n_price):
+        decimals = tick_decimals(self.tick_size)
+        self.price_min = round(price_min, decimals)
+        self.prices = np.round(self.price_min + self.tick_size * np.arange(n_price), decimals)
+        self.bid = np.full((2 * self.capacity, n_price), np.nan)
+        self.ask = np.full((2 * self.capacity, n_price), np.nan)
+        # snapshots of the current row at each price, for the mean of the bucket
+        self._bid_count = np.zeros(n_price, dtype=np.int64)
+        self._ask_count = np.zeros(n_price, dtype=np.int64)
+
+    def _new_row(self, bucket):
+        slot = self.n % self.capacity
+        for side, depth, count in [(0, self.bid, self._bid_count), (1, self.ask, self._ask_count)]:
+            # counts of the last row and the depth of the overwritten row, only the columns written
+            last = self._touched[(self.n - 1) % self.capacity][side]
+            if last is not None:
+                count[last] = 0
+            old = self._touched[slot][side]
+            if old is not None:
+                depth[slot, old] = np.nan
+                depth[slot + self.capacity, old] = np.nan
+            self._touched[slot][side] = None
+        self.time[slot] = self.time[slot + self.capacity] = bucket
+        # the best prices of the overwritten row, a side without levels has none
+        self.best_bid[slot] = self.best_bid[slot + self.capacity] = np.nan
+        self.best_ask[slot] = self.best_ask[slot + self.capacity] = np.nan
+        self._bucket = bucket
+        self.n += 1
+        return slot
+
+    def _write(self, slot, side, depth, count, levels):
+        if len(levels) == 0:
+            return
+        cols = np.rint((levels[:, 0] - self.price_min) / self.tick_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < len(self.prices))
+        cols, volume = cols[inside], levels[inside, 1]
+        count[cols] += 1
+        current = depth[slot, cols]
+        mean = np.where(count[cols] == 1, volume, current + (volume - current) / count[cols])
+        depth[slot, cols] = depth[slot + self.capacity, cols] = mean
+        touched = self._touched[slot][side]
+        self._touched[slot][side] = cols if touched is None else np.union1d(touched, cols)
+
+    def update(self, time, bid, ask):
+        """
+        Write a snapshot
+        :param time:
+        :param bid: levels of [price, volume, ...] from the best price
+        :param ask: levels of [price, volume, ...] from the best price
+        :return:
+        """
+        bid = np.asarray(bid, dtype=np.float64).reshape(len(bid), -1) if len(bid) > 0 else np.empty((0, 2))
+        ask = np.asarray(ask, dtype=np.float64).reshape(len(ask), -1) if len(ask) > 0 else np.empty((0, 2))
+        if self.prices is None:
+            best = np.concatenate([bid[:1, 0], ask[:1, 0]])
+            if len(best) == 0:
+                return
+            mid = np.round(best.mean() / self.tick_size) * self.tick_size
+            self._set_axis(mid - self.tick_size * (self.n_ticks // 2), self.n_ticks)
+
+        time = pd.Timestamp(time).to_datetime64()
+        if self.freq is not None:
+            bucket = (time.astype(np.int64) // self.freq * self.freq).astype('datetime64[ns]')
+        else:
+            bucket = time
+        if self.freq is None or self._bucket is None or bucket != self._bucket:
+            slot = self._new_row(bucket)
+        else:
+            slot = (self.n - 1) % self.capacity
+        self._write(slot, 0, self.bid, self._bid_count, bid)
+        self._write(slot, 1, self.ask, self._ask_count, ask)
+        if len(bid) > 0:
+            self.best_bid[slot] = self.best_bid[slot + self.capacity] = bid[0, 0]
+        if len(ask) > 0:
+            self.best_ask[slot] = self.best_ask[slot + self.capacity] = ask[0, 0]
+
+    def update_with_pandas(self, orderbook_df: pd.DataFrame):
+        """
+        Write the snapshots of the orderbook records with svr_recv_time_bid, svr_recv_time_ask, Bid and Ask
+        """
+        orderbook_df = orderbook_df.assign(time_key=orderbook_time(orderbook_df)).dropna(subset=['time_key'])
+        for time, bid, ask in zip(orderbook_df['time_key'].values, orderbook_df['Bid'].values,
+                                  orderbook_df['Ask'].values):
+            self.update(time, bid, ask)
+
+    def window(self, num: int = None) -> dict:
+        """
+        Views of the last num rows in time order
+        :param num: all the rows kept if None
+        :return: time, price, bid, ask (time x price), best_bid, best_ask
+        """
+        kept = min(self.n, self.capacity)
+        num = kept if num is None else min(num, kept)
+        end = (self.n - 1) % self.capacity + 1 + self.capacity if self.n > 0 else self.capacity
+        rows = slice(end - num, end)
+        return {'time': self.time[rows], 'price': self.prices, 'bid': self.bid[rows], 'ask': self.ask[rows],
+                'best_bid': self.best_bid[rows], 'best_ask': self.best_ask[rows]}
+
+    @classmethod
+    def from_columns(cls, columns: dict, tick_size: float = None, freq: str = None):
+        """
+        Grid holding all the snapshots of the orderbook columns (OrderbookStore.slice), made in one pass
+        """
+        price = np.asarray(columns['price'])
+        if tick_size is None:
+            tick_size = infer_tick_size(price)
+        side = np.asarray(columns['side'])
+        snapshot = np.asarray(columns['snapshot'])
+        first = np.r_[True, snapshot[1:] != snapshot[:-1]]
+        time = np.asarray(columns['time'])
+        if freq is not None:
+            step = pd.Timedelta(freq).value
+            time = (time.astype(np.int64) // step * step).astype('datetime64[ns]')
+            first = first & np.r_[True, time[1:] != time[:-1]]
+        row = np.cumsum(first) - 1
+        n_row = int(row[-1]) + 1 if len(row) > 0 else 0
+
+        # the rows of the empty snapshots only make their grid rows
+        has_price = side != EMPTY
+        if not has_price.any():
+            return cls(tick_size, capacity=max(n_row, 1), freq=freq)
+        grid = cls(tick_size, price[has_price].min(), price[has_price].max(), capacity=max(n_row, 1), freq=freq)
+        n_price = len(grid.prices)
+        col = np.zeros(len(price), dtype=np.int64)
+        col[has_price] = np.rint((price[has_price] - grid.price_min) / tick_size)
+        level = np.asarray(columns['level'])
+        volume = np.asarray(columns['volume'])
+        for s, depth, count in [(BID, grid.bid, grid._bid_count), (ASK, grid.ask, grid._ask_count)]:
+            mask = side == s
+            key = row[mask] * n_price + col[mask]
+            total = np.bincount(key, weights=volume[mask], minlength=n_row * n_price)
+            snapshots = np.bincount(key, minlength=n_row * n_price)
+            with np.errstate(invalid='ignore'):
+                mean = np.where(snapshots > 0, total / snapshots, np.nan).reshape(n_row, n_price)
+            depth[:n_row] = depth[n_row:] = mean
+            # columns written in each row, and the counts of the last row for the incremental updates
+            written = np.unique(key)
+            bounds = np.searchsorted(written, np.arange(1, n_row) * n_price)
+            for touched, cols in zip(grid._touched, np.split(written % n_price, bounds)):
+                touched[s] = cols
+            count[:] = snapshots.reshape(n_row, n_price)[-1]
+
+            # best price of the last snapshot of each row
+            best = np.flatnonzero(mask & (level == 0))
+            last = len(best) - 1 - np.unique(row[best][::-1], return_index=True)[1]
+            best_price = grid.best_bid if s == BID else grid.best_ask
+            best_price[row[best[last]]] = best_price[row[best[last]] + n_row] = price[best[last]]
+        grid.time[:n_row] = grid.time[n_row:] = time[first]
+        grid.n = n_row
+        grid._bucket = time[-1]
+        return grid
+
+    @classmethod
+    def from_orderbook_df(cls, orderbook_df: pd.DataFrame, tick_size: float = None, freq: str = None):
+        """
+        Grid holding all the snapshots of the records, the axis covers all the prices
+        """
+        prices = np.concatenate([np.asarray(levels, dtype=np.float64)[:, 0]
+                                 for levels in np.concatenate([orderbook_df['Bid'].values, orderbook_df['Ask'].values])
+                                 if len(levels) > 0])
+        if tick_size is None:
+            tick_size = infer_tick_size(prices)
+        times = orderbook_time(orderbook_df)
+        if freq is None:
+            capacity = len(orderbook_df)
+        else:
+            capacity = len(times.dropna().dt.floor(freq).unique())
+        grid = cls(tick_size, prices.min(), prices.max(), capacity=max(capacity, 1), freq=freq)
+        grid.update_with_pandas(orderbook_df)
+        return grid
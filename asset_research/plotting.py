@@ -9,6 +9,8 @@ from plotly.subplots import make_subplots
 
 from graph.bar_component import candlestick
 from graph.indicator_component import sar_graph, macd_graph
+from asset_research.orderbook import OrderbookGrid, infer_tick_size
+from asset_research.footprint import Footprint
 from technical_analysis.momentum import *
 from technical_analysis.pattern import *
 from technical_analysis.volume import *
@@ -74,70 +76,61 @@ def orderbook_plot(orderbook):
     return fig
 
 
-def orderbook_heatmap(orderbook_df, code=None, freq='1T', zmax=10):
-    if code is not None:
-        orderbook_df = orderbook_df[orderbook_df['code'] == code]
-    orderbook_df['svr_recv_time_ask'] = pd.to_datetime(orderbook_df['svr_recv_time_ask'])
-    orderbook_df['svr_recv_time_bid'] = pd.to_datetime(orderbook_df['svr_recv_time_bid'])
-    orderbook_df = orderbook_df.dropna(subset=['svr_recv_time_ask', 'svr_recv_time_bid'])  # type:pd.DataFrame
-    # how to aggregate the map
-    orderbook_df['time_key'] = np.where(orderbook_df['svr_recv_time_ask'] > orderbook_df['svr_recv_time_bid'],
-                                        orderbook_df['svr_recv_time_ask'], orderbook_df['svr_recv_time_bid'])
-    orderbook_df = orderbook_df[['time_key', 'Bid', 'Ask']]
-    orderbook_df.set_index('time_key', inplace=True)
-
-    prices = np.array(orderbook_df["Bid"].agg(lambda x: np.array(x)[:, 0]).to_list()).flatten()
-    prices = np.append(prices, np.array(orderbook_df["Ask"].agg(lambda x: np.array(x)[:, 0]).to_list()).flatten())
-    prices = np.unique(prices)
-    if freq is not None:
-        grouped = orderbook_df.groupby(pd.Grouper(freq=freq))['Bid', 'Ask'].agg(lambda x: np.sum(x))
-        grouped = grouped[grouped['Bid'] != 0]
-        grouped = grouped[grouped['Ask'] != 0]
-    else:
-        grouped = orderbook_df
-
-    def col_func(x):
-        a = np.array(x)
-        count, value = np.histogram(a[:, 0], bins=prices, weights=a[:, 1])
-        count2, value = np.histogram(a[:, 0], bins=prices)
-        count = np.where(count == 0, np.NAN, count / count2)
-        return count
-
-    grouped['Bid'] = grouped['Bid'].apply(lambda x: col_func(x))
-    grouped['Ask'] = grouped['Ask'].apply(lambda x: col_func(x))
-
-    # print(grouped['Ask'].index)
+def orderbook_grid_heatmap(grid: OrderbookGrid, num=None, zmax=10, colorscale=('Greens', 'Reds')):
+    """
+    Heatmap of the last num rows of the orderbook grid
+    """
+    window = grid.window(num)
     bid = go.Heatmap(
-        z=np.array(grouped['Bid'].to_list()), zmin=0, zmax=zmax,
-        x=grouped['Bid'].index,
-        y=prices, transpose=True,
-        colorscale='Greens', showscale=False)
+        z=window['bid'], zmin=0, zmax=zmax,
+        x=window['time'],
+        y=window['price'], transpose=True,
+        colorscale=colorscale[0], showscale=False)
 
     ask = go.Heatmap(
-        z=np.array(grouped['Ask'].to_list()), zmin=0, zmax=zmax,
-        x=grouped['Ask'].index,
-        y=prices, transpose=True,
-        colorscale='Reds', showscale=False, )
+        z=window['ask'], zmin=0, zmax=zmax,
+        x=window['time'],
+        y=window['price'], transpose=True,
+        colorscale=colorscale[1], showscale=False, )
 
     fig = go.Figure([bid, ask])
     fig.update_layout(template='plotly_dark', yaxis_tickformat='g')
+    return fig
+
+
+def orderbook_heatmap(orderbook_df, code=None, freq='1T', zmax=10, tick_size=None):
+    """
+    Heatmap of the mean depth of each time bucket on the fixed-tick price axis
+    :param orderbook_df: orderbook records with code, svr_recv_time_bid, svr_recv_time_ask, Bid and Ask,
+        or the columns of OrderbookStore.slice of one code
+    :param code: code of the records, the columns are selected by OrderbookStore.slice
+    :param freq: time bucket, a row per snapshot if None
+    :param zmax:
+    :param tick_size: inferred from the prices if None
+    :return:
+    """
+    if isinstance(orderbook_df, dict):
+        if code is not None:
+            raise ValueError('the columns have the code positions, pass OrderbookStore.slice(start, end, code)')
+        if len(np.unique(orderbook_df['code'])) > 1:
+            raise ValueError('the columns have more than one code, pass OrderbookStore.slice(start, end, code)')
+        grid = OrderbookGrid.from_columns(orderbook_df, tick_size=tick_size, freq=freq)
+    else:
+        if code is not None:
+            orderbook_df = orderbook_df[orderbook_df['code'] == code]
+        grid = OrderbookGrid.from_orderbook_df(orderbook_df, tick_size=tick_size, freq=freq)
     # fig.show()
 
-    return fig
+    return orderbook_grid_heatmap(grid, zmax=zmax)
 
 
 def tick_plot(tick_df, freq='1T'):
-    def order_flow(x):
-        if x['ticker_direction'] == 'BUY':
-            return x['price'] * x['volume']
-        elif x['ticker_direction'] == 'SELL':
-            return - x['price'] * x['volume']
-        elif x['ticker_direction'] == 'NEUTRAL':
-            return 0
-
-    tick_df['order_flow'] = tick_df.apply(order_flow, axis=1)
-    agg = tick_df.groupby('time').agg({'order_flow': 'sum', 'price': 'last'})
-    agg = agg.groupby(pd.Grouper(freq=freq)).agg({'order_flow': 'sum', 'price': 'last'})
+    if isinstance(tick_df, Footprint):
+        footprint = tick_df
+    else:
+        footprint = Footprint(infer_tick_size(tick_df['price'].values), freq)
+        footprint.update(tick_df)
+    agg = footprint.order_flow()
     fig = make_subplots(specs=[[{"secondary_y": True}]])
     vol_bar = go.Bar(x=agg.index, y=agg['order_flow'])
     price_line = go.Scatter(x=agg.index, y=agg['price'], mode='lines')
@@ -185,45 +178,16 @@ def cumulative_volume(rt_df):
     return fig
 
 
-def order_flow_plot(tick_df, freq='1T', zmax=10):
-    # template = 'plotly_dark'
-
-    # fig.add_trace(go.Violin(x=df['day'][df['smoker'] == 'Yes'],
-    #                         y=df['total_bill'][df['smoker'] == 'Yes'],
-    #                         legendgroup='Yes', scalegroup='Yes', name='Yes',
-    #                         side='negative',
-    #                         line_color='blue')
-    #               )
-
-    vol_df = tick_df.groupby(['time', 'ticker_direction', 'price']).agg({'volume': 'sum'})
-    sell_to_bid = vol_df.loc[(slice(None), ['SELL']), :]
-    sell_to_bid = sell_to_bid.unstack()
-    sell_to_bid = sell_to_bid.groupby(pd.Grouper(freq=freq, level=0)).sum()
-    sell_to_bid = - sell_to_bid
-    sell_to_bid['ticker_direction'] = 'SELL'
-
-    buy_by_ask = vol_df.loc[(slice(None), ['BUY']), :]
-    buy_by_ask = buy_by_ask.unstack()
-    buy_by_ask = buy_by_ask.groupby(pd.Grouper(freq=freq, level=0)).sum()
-    buy_by_ask['ticker_direction'] = 'BUY'
-
-    orderflow_table = buy_by_ask.append(sell_to_bid).replace(np.NAN, 0)
-    orderflow_table = orderflow_table.set_index('ticker_direction', append=True).sort_index()
-
-    v = orderflow_table.values
-    a = np.empty(v.shape, dtype='bool')
-    for i in range(len(v)):
-        nonzero_idx = np.nonzero(v[i])[0]
-        c = v[i] != 0
-        try:
-            c[nonzero_idx[0]: nonzero_idx[-1]] = True
-        except:
-            pass
-        a[i] = c
-
-    orderflow_table.where(a, None, inplace=True)
-    orderflow_table = orderflow_table.T.droplevel(0).sort_index(ascending=False).sort_index(axis=1,
-                                                                                            ascending=[True, False])
+def order_flow_plot(tick_df, freq='1T', zmax=10, tick_size=None):
+    """
+    Footprint heatmap of the ticks
+    :param tick_df: ticks with time, ticker_direction, price and volume, or a Footprint updated by the live ticks
+    :param freq: time bucket
+    :param zmax:
+    :param tick_size: inferred from the prices if None
+    :return:
+    """
+    orderflow_table = order_flow_table(tick_df, freq, tick_size)
     colorscale = [[0, '#CE0000'],
                   [0.1, '#EA0000'],
                   [0.2, '#FF2D2D'],
@@ -245,12 +209,6 @@ def order_flow_plot(tick_df, freq='1T', zmax=10):
         x=x,
         y=orderflow_table.index,
         colorscale=colorscale, showscale=False)
-    # fig = ff.create_annotated_heatmap(z=orderflow_table.values,
-    #                                   x=x,
-    #                                   y=orderflow_table.index.to_list(),
-    #                                   annotation_text=annotation_text,
-    #                                   colorscale=colorscale, showscale=False, zmin=-10, zmax=10,
-    #                                   )
 
     fig = go.Figure(of_heatmap)
     tick_value = [x[i] for i in range(0, len(x), 10)]
@@ -261,36 +219,17 @@ def order_flow_plot(tick_df, freq='1T', zmax=10):
     return fig
 
 
-def order_flow_table(tick_df, freq='1T'):
-    vol_df = tick_df.groupby(['time', 'ticker_direction', 'price']).agg({'volume': 'sum'})
-    sell_to_bid = vol_df.loc[(slice(None), ['SELL']), :]
-    sell_to_bid = sell_to_bid.unstack()
-    sell_to_bid = sell_to_bid.groupby(pd.Grouper(freq=freq, level=0)).sum()
-    sell_to_bid = - sell_to_bid
-    sell_to_bid['ticker_direction'] = 'SELL'
-
-    buy_by_ask = vol_df.loc[(slice(None), ['BUY']), :]
-    buy_by_ask = buy_by_ask.unstack()
-    buy_by_ask = buy_by_ask.groupby(pd.Grouper(freq=freq, level=0)).sum()
-    buy_by_ask['ticker_direction'] = 'BUY'
-
-    orderflow_table = buy_by_ask.append(sell_to_bid).replace(np.NAN, 0)
-    orderflow_table = orderflow_table.set_index('ticker_direction', append=True).sort_index()
-
-    v = orderflow_table.values
-    a = np.empty(v.shape, dtype='bool')
-    for i in range(len(v)):
-        nonzero_idx = np.nonzero(v[i])[0]
-        c = v[i] != 0
-        try:
-            c[nonzero_idx[0]: nonzero_idx[-1]] = True
-        except:
-            pass
-        a[i] = c
-
-    orderflow_table.where(a, None, inplace=True)
-    orderflow_table = orderflow_table.T.droplevel(0).sort_index(ascending=False).sort_index(axis=1,
-                                                                                            ascending=[True, False])
+def order_flow_table(tick_df, freq='1T', tick_size=None):
+    """
+    Footprint table, price levels x (time bucket, SELL / BUY), see Footprint.table
+    """
+    if isinstance(tick_df, Footprint):
+        return tick_df.table()
+    if tick_size is None:
+        tick_size = infer_tick_size(tick_df['price'].values)
+    footprint = Footprint(tick_size, freq)
+    footprint.update(tick_df)
+    return footprint.table()
 
 
 def bid_ask_plot():
@@ -70,12 +70,10 @@ class VectorizedBacktesting(BacktestingBase):
         Infer all the timestamp from the data input.
         :return:
         """
-        self.time_list = np.empty(0, dtype='datetime64')
-        for symbol, subs in self.data.items():
-            for v in subs.values():
-                self.time_list = np.append(self.time_list, v.index.values)
-        self.time_list = np.unique(self.time_list)
-        self.time_list.sort()
+        # sorted union of the timestamps of all the symbols and k_types
+        times = pd.to_datetime(pd.Index(np.concatenate([v.index.values for subs in self.data.values()
+                                                        for v in subs.values()]))).values
+        self.time_list = np.unique(times[~np.isnat(times)])
 
     # @njit
     def generate_bar_manager_state(self, bar_manager: BarManager, size):
@@ -202,6 +200,7 @@ class VectorizedBacktesting(BacktestingBase):
             if updated is False:
                 pass
                 # print('skip kline for look back')
+        self.strategy.close_log()
         self.calculate_result()
 
 class TickBarVectorizedBacktesting(VectorizedBacktesting):
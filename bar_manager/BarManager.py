@@ -39,16 +39,16 @@ class BarManager:
             raise ValueError('This method has to initial with pandas object')
 
         if time_key is None:
-            self.time = np.array(data.index[:self.size], dtype='datetime64')
+            self.time = np.array(data.index[-self.size:], dtype='datetime64')
         else:
-            self.time = np.array(data[time_key][:self.size], dtype='datetime64')
+            self.time = np.array(data[time_key][-self.size:], dtype='datetime64')
 
-        self.open = data[ohlcv_key[0]].values[-self.size:]
-        self.high = data[ohlcv_key[1]].values[-self.size:]
-        self.low = data[ohlcv_key[2]].values[-self.size:]
-        self.close = data[ohlcv_key[3]].values[-self.size:]
+        self.open = np.array(data[ohlcv_key[0]].values[-self.size:], dtype=np.float64)
+        self.high = np.array(data[ohlcv_key[1]].values[-self.size:], dtype=np.float64)
+        self.low = np.array(data[ohlcv_key[2]].values[-self.size:], dtype=np.float64)
+        self.close = np.array(data[ohlcv_key[3]].values[-self.size:], dtype=np.float64)
         try:
-            self.volume = data[ohlcv_key[4]].values[-self.size:]
+            self.volume = np.array(data[ohlcv_key[4]].values[-self.size:], dtype=np.float64)
         except:
             print('no volume in the columns')
         self.inited = True
@@ -66,8 +66,28 @@ class BarManager:
         else:
             time = np.array(row[time_key], dtype='datetime64')
 
+        try:
+            volume = row[ohlcv_key[4]].values[-1]
+        except:
+            print('no volume in the columns')
+            volume = None
+        self.update_bar(time[-1], row[ohlcv_key[0]].values[-1], row[ohlcv_key[1]].values[-1],
+                        row[ohlcv_key[2]].values[-1], row[ohlcv_key[3]].values[-1], volume)
+
+    def update_bar(self, time, open, high, low, close, volume=None):
+        """
+        Update with the scalars of a bar, no pandas object is needed
+        :param time: bar time, the last bar is replaced if it is not later than the last bar (uncompleted bar)
+        :param open:
+        :param high:
+        :param low:
+        :param close:
+        :param volume: the last volume is kept if None
+        :return:
+        """
+        time = np.datetime64(time)
         # to support uncompleted bar
-        if time[-1] > self.time[-1]:
+        if time > self.time[-1]:
             # new bar coming in, move the nparray for the new bar
             self.time[0: self.size - 1] = self.time[1: self.size]
             self.open[0: self.size - 1] = self.open[1: self.size]
@@ -75,18 +95,31 @@ class BarManager:
             self.low[0: self.size - 1] = self.low[1: self.size]
             self.close[0: self.size - 1] = self.close[1: self.size]
             self.volume[0: self.size - 1] = self.volume[1: self.size]
-            self.time[-1] = time[-1]
-
-        self.open[-1] = row[ohlcv_key[0]].values[-1]
-        self.high[-1] = row[ohlcv_key[1]].values[-1]
-        self.low[-1] = row[ohlcv_key[2]].values[-1]
-        self.close[-1] = row[ohlcv_key[3]].values[-1]
-        try:
-            self.volume[-1] = row[ohlcv_key[4]].values[-1]
-        except:
-            print('no volume in the columns')
+            self.time[-1] = time
+
+        self.open[-1] = open
+        self.high[-1] = high
+        self.low[-1] = low
+        self.close[-1] = close
+        if volume is not None:
+            self.volume[-1] = volume
         self._calculate_ta()
 
+    def update_with_array(self, time, ohlcv):
+        """
+        Update with the NumPy rows of bars in time order
+        :param time: datetime64 array, or a scalar for a single row
+        :param ohlcv: array of shape (n, 5) or (n, 4) without volume, or a single row
+        :return:
+        """
+        time = np.atleast_1d(np.asarray(time, dtype='datetime64[ns]'))
+        ohlcv = np.atleast_2d(ohlcv)
+        has_volume = ohlcv.shape[1] > 4
+        for i in range(len(time)):
+            values = ohlcv[i]
+            self.update_bar(time[i], values[0], values[1], values[2], values[3],
+                            values[4] if has_volume else None)
+
     def _set_technical_indicator(self, ta_parameter):
         if ta_parameter is None:
             return
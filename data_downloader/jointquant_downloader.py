@@ -5,7 +5,7 @@ from jqdatasdk import query
 import os
 import tqdm
 import datetime
-from alpha_research.factor_zoo.utils import get_nth_weekday_of_month, next_trading_date_dict
+from alpha_research.factor_zoo.utils import get_nth_weekday_of_month, TradingCalendar
 
 jqdatasdk.auth('17713571453', '')
 
@@ -102,7 +102,7 @@ def get_csi300_history_component(end_year, trading_date:list):
     # 日。
 
     # generate renew dates
-    next_trading_date = next_trading_date_dict(trading_date)
+    calendar = TradingCalendar(trading_date)
     renew_datetimes = [start]
     today = datetime.datetime.now()
     for year in range(2005, end_year+1):
@@ -110,7 +110,7 @@ def get_csi300_history_component(end_year, trading_date:list):
             date = get_nth_weekday_of_month(year, month, 4, 2)
             if date > today:
                 continue
-            next = next_trading_date[pd.to_datetime(date)].strftime('%Y-%m-%d')
+            next = calendar.next(date).strftime('%Y-%m-%d')
             renew_datetimes.append(next)
 
     print(renew_datetimes)
@@ -1,6 +1,301 @@
 import os
 import pandas as pd
 import numpy as np
+import numba
+
+
+@numba.njit
+def cumulative_bar_kernel(values: np.ndarray, threshold: float, cum: float):
+    """
+    Close a bar at the tick where the running sum of values reaches the threshold, then reset the sum.
+    Tick, volume and dollar bars are values of 1, volume and price * volume.
+    :param values:
+    :param threshold:
+    :param cum: running sum of the open bar from the last chunk
+    :return: (bool array, True at the last tick of each bar, running sum of the open bar)
+    """
+    closes = np.zeros(len(values), dtype=np.bool_)
+    for i in range(len(values)):
+        cum += values[i]
+        if cum >= threshold:
+            closes[i] = True
+            cum = 0.
+    return closes, cum
+
+
+@numba.njit
+def imbalance_bar_kernel(price: np.ndarray, state: np.ndarray, alpha: float, default_T: int, run: bool,
+                         min_T: float, max_T: float):
+    """
+    Tick imbalance bar closes when |#buy - #sell| >= E[T] * |2 * P[buy] - 1|,
+    tick run bar closes when max(#buy, #sell) >= E[T] * max(P[buy], 1 - P[buy]).
+    The tick is buy (sell) if the price goes up (down), otherwise the side of the last tick.
+    E[T] and P[buy] are the EWMA (weight alpha) of the bar length and the buy ratio of the closed bars,
+    and the first bar is default_T ticks. E[T] is clipped to [min_T, max_T], because on the symmetric tick sides
+    the threshold decays to a bar per tick.
+    :param price:
+    :param state: float array updated in place, last price, last side, #buy, #sell, #tick, E[T], P[buy]
+    :param alpha:
+    :param default_T:
+    :param run: run bar if True, otherwise imbalance bar
+    :param min_T:
+    :param max_T:
+    :return: bool array, True at the last tick of each bar
+    """
+    closes = np.zeros(len(price), dtype=np.bool_)
+    for i in range(len(price)):
+        side = 0.
+        if not np.isnan(state[0]):
+            side = np.sign(price[i] - state[0]) if price[i] != state[0] else state[1]
+        state[0] = price[i]
+        state[1] = side
+        if side > 0:
+            state[2] += 1
+        elif side < 0:
+            state[3] += 1
+        state[4] += 1
+
+        if np.isnan(state[5]):
+            close = state[4] >= default_T
+        elif run:
+            close = max(state[2], state[3]) >= max(state[5] * max(state[6], 1 - state[6]), 1.)
+        else:
+            close = abs(state[2] - state[3]) >= max(state[5] * abs(2 * state[6] - 1), 1.)
+
+        if close:
+            buy_ratio = state[2] / state[4]
+            if np.isnan(state[5]):
+                state[5] = state[4]
+                state[6] = buy_ratio
+            else:
+                state[5] = alpha * state[4] + (1 - alpha) * state[5]
+                state[6] = alpha * buy_ratio + (1 - alpha) * state[6]
+            state[5] = min(max(state[5], min_T), max_T)
+            state[2] = 0.
+            state[3] = 0.
+            state[4] = 0.
+            closes[i] = True
+    return closes
+
+
+def _aggregate_bars(key: np.ndarray, time: np.ndarray, price: np.ndarray, volume: np.ndarray or None) -> dict:
+    # OHLC of the runs of the same key
+    starts = np.r_[0, np.nonzero(np.diff(key))[0] + 1]
+    ends = np.r_[starts[1:], len(key)]
+    bars = {'key': key[starts],
+            'date_start': time[starts],
+            'date': time[ends - 1],
+            'open': price[starts],
+            'high': np.maximum.reduceat(price, starts),
+            'low': np.minimum.reduceat(price, starts),
+            'close': price[ends - 1],
+            'tickqty': ends - starts}
+    if volume is not None:
+        bars['volume'] = np.add.reduceat(volume, starts)
+    return bars
+
+
+class StreamBarMaker:
+    """
+    Build the bars chunk by chunk, the state of the open bar and of the threshold kernels is carried across the
+    chunks, so the ticks of any size are consumed in constant memory and give the same bars as one chunk.
+    bar_type is one of time, tick, volume, dollar, tick_imbalance and tick_run.
+    """
+    bar_types = ('time', 'tick', 'volume', 'dollar', 'tick_imbalance', 'tick_run')
+
+    def __init__(self, bar_type: str = 'tick', threshold: float = None, interval: str = None,
+                 alpha: float = 0.1, default_T: int = 100, min_T: float = 0, max_T: float = np.inf):
+        """
+        :param bar_type:
+        :param threshold: number of ticks, volume or dollar of the tick, volume and dollar bar
+        :param interval: pandas frequency of the time bar, e.g. '1T'
+        :param alpha: EWMA weight of the expected bar length and buy ratio of the imbalance and run bar
+        :param default_T: number of ticks of the first imbalance and run bar
+        :param min_T: lower bound of the expected number of ticks of the imbalance and run bar
+        :param max_T: upper bound of the expected number of ticks of the imbalance and run bar
+        """
+        if bar_type not in self.bar_types:
+            raise ValueError('bar_type must be one of {}, but got {}'.format(self.bar_types, bar_type))
+        if bar_type == 'time':
+            if interval is None:
+                raise ValueError('interval is required for time bar')
+            self.interval = pd.Timedelta(interval).value
+        elif bar_type in ('tick', 'volume', 'dollar') and threshold is None:
+            raise ValueError('threshold is required for {} bar'.format(bar_type))
+        self.bar_type = bar_type
+        self.threshold = threshold
+        self.alpha = alpha
+        self.default_T = default_T
+        self.min_T = min_T
+        self.max_T = max_T
+        self.reset()
+
+    def reset(self):
+        self.cum = 0.
+        self.state = np.array([np.nan, 0., 0., 0., 0., np.nan, np.nan])
+        self.bar_count = 0
+        self.open_bar = None
+
+    def _bar_key(self, time: np.ndarray, price: np.ndarray, volume: np.ndarray or None):
+        # bar key of every tick, and whether the last bar is closed
+        if self.bar_type == 'time':
+            return time.view(np.int64) // self.interval, False
+
+        if self.bar_type == 'tick':
+            closes, self.cum = cumulative_bar_kernel(np.ones(len(price)), float(self.threshold), self.cum)
+        elif self.bar_type in ('volume', 'dollar'):
+            if volume is None:
+                raise KeyError('volume is required for {} bar'.format(self.bar_type))
+            values = volume if self.bar_type == 'volume' else price * volume
+            closes, self.cum = cumulative_bar_kernel(values, float(self.threshold), self.cum)
+        else:
+            closes = imbalance_bar_kernel(price, self.state, float(self.alpha), int(self.default_T),
+                                          self.bar_type == 'tick_run', float(self.min_T), float(self.max_T))
+        key = self.bar_count + np.cumsum(closes) - closes
+        self.bar_count += int(closes.sum())
+        return key, bool(closes[-1])
+
+    def _to_frame(self, bars: dict or None) -> pd.DataFrame:
+        columns = ['open', 'high', 'low', 'close', 'tickqty', 'date_start']
+        if bars is None:
+            return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='date'))
+        if 'volume' in bars:
+            columns.insert(5, 'volume')
+        if self.bar_type == 'time':
+            # labeled by the right edge of the interval like make_time_bar
+            date = ((bars['key'] + 1) * self.interval).astype('datetime64[ns]')
+        else:
+            date = bars['date']
+        return pd.DataFrame({col: bars[col] for col in columns}, index=pd.DatetimeIndex(date, name='date'))
+
+    def update(self, time, price, volume=None) -> pd.DataFrame:
+        """
+        Feed a chunk of the ticks in time order
+        :param time: datetime array
+        :param price: price array
+        :param volume: volume array, required by the volume and dollar bar
+        :return: the bars closed in this chunk, date is the time of the last tick (the interval end of the time bar)
+        """
+        time = np.asarray(time, dtype='datetime64[ns]')
+        price = np.asarray(price, dtype=np.float64)
+        volume = None if volume is None else np.asarray(volume, dtype=np.float64)
+        if len(price) == 0:
+            return self._to_frame(None)
+
+        key, last_closed = self._bar_key(time, price, volume)
+        bars = _aggregate_bars(key, time, price, volume)
+        open_bar = self.open_bar
+        if open_bar is not None and open_bar['key'][0] == bars['key'][0]:
+            # the open bar of the last chunk goes on
+            bars['date_start'][0] = open_bar['date_start'][0]
+            bars['open'][0] = open_bar['open'][0]
+            bars['high'][0] = max(bars['high'][0], open_bar['high'][0])
+            bars['low'][0] = min(bars['low'][0], open_bar['low'][0])
+            bars['tickqty'][0] += open_bar['tickqty'][0]
+            if volume is not None:
+                bars['volume'][0] += open_bar['volume'][0]
+        elif open_bar is not None:
+            # the open bar of the last chunk is closed by the first tick of this chunk
+            bars = {col: np.r_[open_bar[col], bars[col]] for col in bars}
+
+        if last_closed:
+            self.open_bar = None
+        else:
+            self.open_bar = {col: bars[col][-1:].copy() for col in bars}
+            bars = {col: bars[col][:-1] for col in bars}
+        return self._to_frame(bars)
+
+    def flush(self) -> pd.DataFrame:
+        """
+        Close the open bar at the end of the ticks
+        :return:
+        """
+        bars = self.open_bar
+        self.open_bar = None
+        return self._to_frame(bars) if bars is not None else self._to_frame(None)
+
+    def make_bars(self, chunks):
+        """
+        :param chunks: iterable of (time, price, volume), e.g. read_tick_chunks
+        :return: generator of the bars closed by each chunk, the last one is the open bar at the end
+        """
+        for time, price, volume in chunks:
+            bars = self.update(time, price, volume)
+            if len(bars) > 0:
+                yield bars
+        bars = self.flush()
+        if len(bars) > 0:
+            yield bars
+
+
+def read_tick_chunks(path: str, chunksize: int = 1000000,
+                     time_key='DateTime',
+                     bid_key='Bid',
+                     ask_key='Ask',
+                     volume_key=None,
+                     last_price=None,
+                     mp_key=None,
+                     time_key_format='%m/%d/%Y %H:%M:%S.%f'):
+    """
+    Read the tick csv or parquet file chunk by chunk, the price is last_price, mp_key or the mid of bid and ask
+    like TickBarMaker
+    :return: generator of (time, price, volume)
+    """
+    if last_price is not None:
+        price_columns = [last_price]
+    elif mp_key is not None:
+        price_columns = [mp_key]
+    else:
+        price_columns = [bid_key, ask_key]
+    columns = [time_key] + price_columns + ([volume_key] if volume_key is not None else [])
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in
+                  pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+    for chunk in chunks:
+        time = pd.to_datetime(chunk[time_key], format=time_key_format).values
+        if len(price_columns) == 1:
+            price = chunk[price_columns[0]].values
+        else:
+            price = (chunk[bid_key].values + chunk[ask_key].values) / 2
+        volume = chunk[volume_key].values if volume_key is not None else None
+        yield time, price, volume
+
+
+def stream_bars(path: str, bar_maker: StreamBarMaker, save_path: str = None, chunksize: int = 1000000,
+                **kwargs) -> pd.DataFrame or None:
+    """
+    Make the bars of a tick file in constant memory
+    :param path: tick csv or parquet file
+    :param bar_maker:
+    :param save_path: csv or parquet file the bars are appended to chunk by chunk, the bars are returned if None
+    :param chunksize: number of ticks of a chunk
+    :param kwargs: the columns of read_tick_chunks
+    :return:
+    """
+    chunks = read_tick_chunks(path, chunksize, **kwargs)
+    if save_path is None:
+        return pd.concat(list(bar_maker.make_bars(chunks)) or [bar_maker.flush()])
+
+    writer = None
+    try:
+        for i, bars in enumerate(bar_maker.make_bars(chunks)):
+            if save_path.endswith('.parquet'):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(bars)
+                if writer is None:
+                    writer = pq.ParquetWriter(save_path, table.schema)
+                writer.write_table(table)
+            else:
+                bars.to_csv(save_path, mode='w' if i == 0 else 'a', header=i == 0)
+    finally:
+        if writer is not None:
+            writer.close()
 
 
 class BarMaker:
@@ -16,13 +311,13 @@ class BarMaker:
     def make_volume_bar(self, vol: int):
         pass
 
-    def make_dollar_bar(self):
+    def make_dollar_bar(self, dollar: float):
         pass
 
     def make_imbalanced_bar(self, alpha: float):
         pass
 
-    def make_run_bar(self):
+    def make_run_bar(self, alpha: float):
         pass
 
     def make_customized_bar(self):
@@ -96,70 +391,28 @@ class TickBarMaker(BarMaker):
         count_bar.index.name = 'date'
         return count_bar
 
-    def make_imbalanced_bar(self, alpha: float, default_T: int = 10):
-        # todo possible wrong implementation
-        T = []
-        bar_sampled_event = [self.tick_data.index[0]]
-        pro_b1_bar_list = []
-
-        df = self.tick_data.copy()
-        df['bt'] = df['mp'].diff()
-        df['bt'] = df['bt'].abs() / df['bt']
-        df['bt'] = np.where(df['bt'] == 0, df['bt'].shift(1), df['bt'])
-        df['bt'] = df['bt'].fillna(0)
-        df['group'] = 0
-        group = 0
-
-        cur = default_T
-        while cur < len(self.tick_data) - 1:
-            # break_condition = False
-            if group == 0:
-                b1_count = np.sum(np.where(df['bt'].values[:default_T] == 1, 1, 0)) + df['bt'].values[default_T - 1]
-                pro_b1 = b1_count / default_T
-                bar_sampled_event.append(self.tick_data.index[default_T])
-                T.append(default_T)
-                pro_b1_bar_list.append(pro_b1)
-                df['group'].loc[bar_sampled_event[-2]:bar_sampled_event[-1]] = group
-                group += 1
-            else:
-                expected_T = (T[-1] - T[-2]) * alpha + T[-2] if len(T) > 1 else T[-1]
-                expected_pro_b1 = (pro_b1_bar_list[-1] - pro_b1_bar_list[-2]) * alpha + pro_b1_bar_list[-2] \
-                    if len(pro_b1_bar_list) > 1 else pro_b1_bar_list[-1]
-                theta = 0
-                b1_count = 0
-                t_temple = 0
-                cur = sum(T)
-                threshold = expected_T * abs(2 * expected_pro_b1 - 1)
-
-                while abs(theta) < threshold and cur < len(self.tick_data) - 1:
-                    b = df['bt'].values[cur]
-                    theta += b
-                    if b == 1:
-                        b1_count += 1
-                    cur += 1
-                    t_temple += 1
-                T.append(t_temple)
-                bar_sampled_event.append(self.tick_data.index[cur])
-                pro_b1 = b1_count / t_temple
-                pro_b1_bar_list.append(pro_b1)
-                df['group'].loc[bar_sampled_event[-2]:bar_sampled_event[-1]] = group
-                group += 1
+    def _make_stream_bar(self, bar_maker: StreamBarMaker):
+        volume = self.tick_data[self.volume_key].values if self.volume_key is not None else None
+        bars = bar_maker.update(self.tick_data.index.values, self.tick_data[self.price_key].values, volume)
+        return pd.concat([bars, bar_maker.flush()])
 
-        agg_dict = {self.price_key: 'ohlc',
-                    self.time_key: 'last'
-                    }
+    def make_volume_bar(self, vol: int):
+        if self.volume_key is None:
+            raise KeyError('volume_key is required for volume bar')
+        return self._make_stream_bar(StreamBarMaker('volume', threshold=vol))
 
-        grouper = df.reset_index().groupby('group')
-        bar_data = grouper.agg(agg_dict)
+    def make_dollar_bar(self, dollar: float):
+        if self.volume_key is None:
+            raise KeyError('volume_key is required for dollar bar')
+        return self._make_stream_bar(StreamBarMaker('dollar', threshold=dollar))
 
-        bar_data.columns = bar_data.columns.get_level_values(1)
-        bar_data['count'] = grouper.agg({self.price_key: 'count'})
-        if self.volume_key is not None:
-            bar_data[self.volume_key] = grouper.agg({self.volume_key: 'sum'})
-        return bar_data
+    def make_imbalanced_bar(self, alpha: float, default_T: int = 10, min_T: float = 0, max_T: float = np.inf):
+        return self._make_stream_bar(StreamBarMaker('tick_imbalance', alpha=alpha, default_T=default_T,
+                                                    min_T=min_T, max_T=max_T))
 
-    def make_run_bar(self):
-        pass
+    def make_run_bar(self, alpha: float = 0.1, default_T: int = 10, min_T: float = 0, max_T: float = np.inf):
+        return self._make_stream_bar(StreamBarMaker('tick_run', alpha=alpha, default_T=default_T,
+                                                    min_T=min_T, max_T=max_T))
 
 
 class BarBarMaker(BarMaker):
@@ -227,15 +480,8 @@ class BarBarMaker(BarMaker):
                     }
         if self.volume_key is not None:
             agg_dict[self.volume_key] = 'sum'
-        count_bar['group'] = len(self.bar_data)
-        bar_sample = 0
-        cum_tick = 0
-        for index, value in count_bar.iterrows():
-            cum_tick += value[self.tickqty]
-            count_bar['group'].loc[index] = bar_sample
-            if cum_tick >= count:
-                cum_tick = 0
-                bar_sample += 1
+        closes, _ = cumulative_bar_kernel(count_bar[self.tickqty].values.astype(np.float64), float(count), 0.)
+        count_bar['group'] = np.cumsum(closes) - closes
 
         count_bar = count_bar.reset_index().groupby('group').agg(agg_dict)
 
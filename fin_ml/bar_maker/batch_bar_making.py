@@ -1,40 +1,206 @@
 import os
+import json
+import hashlib
 import pandas as pd
-import threading
+import numpy as np
 import tqdm
-from fin_ml.bar_maker.BarMaker import BarBarMaker, TickBarMaker
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fin_ml.bar_maker.BarMaker import StreamBarMaker, stream_bars, cumulative_bar_kernel
 
+"""
+Batch bar making of the monthly tick files, e.g. EURUSD_2016_1.csv
 
-def tick_1min_count_bar(tick_csv_path: str, count: int, save_folder: str, name: str):
-    tick_df = pd.read_csv(tick_csv_path)
+tick file -> 1 minute time bar (save_folder/1min, one process per file) -> count bar (save_folder, in month order)
 
-    bm = TickBarMaker(tick_df)
+The outputs are parquet files written atomically, and the manifest.json in save_folder records the tick files they
+are made from, so the files are skipped if the output is up to date. The count bar not closed at the end of a month
+is carried to the next month (save_folder/state), so the monthly count bars stitch together without partial bars.
+The manifest also records the hash of the state of the month before, so a month is rebuilt if that state changed.
+"""
 
-    time_bar = bm.make_time_bar('1T')
-    time_bar.reset_index(inplace=True)
+MANIFEST = 'manifest.json'
 
-    bm2 = BarBarMaker(time_bar, time_key='date', ohlc_key=['open', 'high', 'low', 'close'],
-                      time_key_format='%Y-%m-%d %H:%M:%S', bid_prefix=None, ask_prefix=None)
-    count_bar = bm2.make_count_bar(count)
-    count_bar['code'] = name.split('_')[0]
-    count_bar['k_type'] = 'K_' + str(count) + 'count'
-    count_bar.to_csv(os.path.join(save_folder, name),float_format='%.5f')
 
+def atomic_to_parquet(df: pd.DataFrame, path: str):
+    """
+    Write to a temporary file in the same folder then rename, so an interrupted write never leaves a broken output
+    """
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
 
-def batch_barbar_making(tick_data_folder, count, save_folder, year=None):
-    if os.path.exists(save_folder) is False:
-        os.makedirs(save_folder)
 
-    tick_paths = os.listdir(tick_data_folder)
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_signature(path: str, with_hash: bool = False) -> dict:
+    stat = os.stat(path)
+    signature = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if with_hash:
+        signature['sha1'] = file_hash(path)
+    return signature
+
+
+def is_up_to_date(source: str, output: str, record: dict or None) -> bool:
+    """
+    The output is up to date if it exists and the source has the same mtime and size as recorded,
+    or the same content hash if only the mtime changes
+    """
+    if record is None or not os.path.exists(output):
+        return False
+    signature = file_signature(source)
+    if signature['size'] != record['size']:
+        return False
+    if signature['mtime'] == record['mtime']:
+        return True
+    return 'sha1' in record and file_hash(source) == record['sha1']
+
+
+def load_manifest(save_folder: str) -> dict:
+    path = os.path.join(save_folder, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'minute': {}, 'count': {}}
+
+
+def save_manifest(manifest: dict, save_folder: str):
+    path = os.path.join(save_folder, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def file_month(name: str) -> tuple:
+    # EURUSD_2016_1.csv -> (2016, 1)
+    parts = os.path.splitext(name)[0].split('_')
+    return int(parts[1]), int(parts[2])
+
+
+def tick_to_minute_bar(tick_path: str, save_path: str, chunksize: int = 1000000, **kwargs) -> dict:
+    """
+    1 minute time bar of a tick file, made in constant memory by stream_bars
+    :return: signature of the tick file
+    """
+    signature = file_signature(tick_path, with_hash=True)
+    minute_bar = stream_bars(tick_path, StreamBarMaker('time', interval='1T'), chunksize=chunksize, **kwargs)
+    atomic_to_parquet(minute_bar, save_path)
+    return signature
+
+
+def count_bar_with_state(minute_bar: pd.DataFrame, count: int, carried: pd.DataFrame or None):
+    """
+    Count bar of the minute bars following the carried minute bars of the last unclosed count bar
+    :param minute_bar: open, high, low, close, tickqty, date_start, index is date
+    :param count: number of ticks of a count bar
+    :param carried: the minute bars of the unclosed count bar of the last month
+    :return: (count bar, the minute bars of the unclosed count bar)
+    """
+    if carried is not None and len(carried) > 0:
+        minute_bar = pd.concat([carried, minute_bar])
+    closes, _ = cumulative_bar_kernel(minute_bar['tickqty'].values.astype(np.float64), float(count), 0.)
+    group = np.cumsum(closes) - closes
+    closed = group < closes.sum()
+
+    count_bar = minute_bar[closed].rename_axis('date').reset_index().groupby(group[closed]).agg(
+        {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'date_start': 'min', 'date': 'max',
+         'tickqty': 'sum'})
+    return count_bar.set_index('date'), minute_bar[~closed]
+
+
+def batch_barbar_making(tick_data_folder, count, save_folder, year=None, max_workers: int = None,
+                        chunksize: int = 1000000, **kwargs):
+    """
+    Make the count bars of the monthly tick files, see the module doc
+    :param tick_data_folder: folder of the monthly tick files
+    :param count: number of ticks of a count bar
+    :param save_folder:
+    :param year: only the files of the year
+    :param max_workers: number of processes of the 1 minute bars
+    :param chunksize: number of ticks read at once
+    :param kwargs: the columns of read_tick_chunks
+    :return:
+    """
+    minute_folder = os.path.join(save_folder, '1min')
+    state_folder = os.path.join(save_folder, 'state')
+    for folder in [save_folder, minute_folder, state_folder]:
+        if os.path.exists(folder) is False:
+            os.makedirs(folder)
+
+    all_paths = sorted(os.listdir(tick_data_folder), key=file_month)
+    tick_paths = all_paths
     if year is not None:
-        tick_paths = [p for p in tick_paths if filter_year(p, year)]
+        tick_paths = [p for p in all_paths if filter_year(p, year)]
+    manifest = load_manifest(save_folder)
 
+    def output_name(path):
+        return os.path.splitext(path)[0] + '.parquet'
 
+    # 1 minute bars, one process per file
+    todo = []
+    for p in tick_paths:
+        source = os.path.join(tick_data_folder, p)
+        if is_up_to_date(source, os.path.join(minute_folder, output_name(p)), manifest['minute'].get(p)):
+            # the same content, the hash is not checked again next time
+            manifest['minute'][p]['mtime'] = os.stat(source).st_mtime
+        else:
+            todo.append(p)
+    save_manifest(manifest, save_folder)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(tick_to_minute_bar, os.path.join(tick_data_folder, p),
+                                   os.path.join(minute_folder, output_name(p)), chunksize, **kwargs): p
+                   for p in todo}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            path = futures[future]
+            manifest['minute'][path] = future.result()
+            # save as soon as a file is done, so an interrupted run resumes from the rest
+            save_manifest(manifest, save_folder)
+            print('finish...', path)
+
+    # count bars in month order, rebuilt from the first month changed since the last run
+    k_type = 'K_' + str(count) + 'count'
+    rebuild = False
+    carried = None
     for path in tqdm.tqdm(tick_paths):
-        tick_1min_count_bar(os.path.join(tick_data_folder, path), count, save_folder, path)
-        print('finish...', path)
+        name = output_name(path)
+        record = manifest['count'].get(path)
+        output = os.path.join(save_folder, name)
+        state = os.path.join(state_folder, name)
+        # the state of the month before, also for the first month of a year filtered run, its hash is recorded so the
+        # month is rebuilt if the month before was rebuilt by another run
+        previous = None
+        if all_paths.index(path) > 0:
+            previous = os.path.join(state_folder, output_name(all_paths[all_paths.index(path) - 1]))
+        previous_sha1 = file_hash(previous) if previous is not None and os.path.exists(previous) else None
+        rebuild = rebuild or path in todo or record is None or record.get('count') != count or \
+            record.get('sha1') != manifest['minute'][path]['sha1'] or not os.path.exists(output) or \
+            not os.path.exists(state) or record.get('state_sha1') != previous_sha1
+        if not rebuild:
+            carried = None
+            continue
+        if carried is None and previous is not None:
+            if previous_sha1 is not None:
+                carried = pd.read_parquet(previous)
+            else:
+                print('no count bar state of', all_paths[all_paths.index(path) - 1], ', start', path, 'without it')
+
+        minute_bar = pd.read_parquet(os.path.join(minute_folder, name))
+        count_bar, carried = count_bar_with_state(minute_bar, count, carried)
+        count_bar['code'] = path.split('_')[0]
+        count_bar['k_type'] = k_type
+        atomic_to_parquet(count_bar, output)
+        atomic_to_parquet(carried, state)
+        manifest['count'][path] = {'count': count, 'sha1': manifest['minute'][path]['sha1'],
+                                   'state_sha1': previous_sha1}
+        save_manifest(manifest, save_folder)
     print('finish')
 
+
 def filter_year(name, year):
     y = int(name.split('_')[1])
     if y == year:
@@ -1,40 +1,169 @@
 # TRIPLE - BARRIER LABELING METHOD
 import pandas as pd
 import numpy as np
-import tqdm
+import numba
 from collections import Counter
 
+from fin_ml.utils import mpPandasObj
+
 
 def getDailyVol(df, span0=100):
     # return
-    df['return'] = df.groupby(['code'])['close'].apply(lambda x: x / x.shift(1) - 1)
-    # estimated volatility
-    sigma = df.groupby(['code'])['return'].apply(lambda x: x.ewm(span=span0).std())
-    return sigma
+    df['return'] = df['close'] / df.groupby(['code'])['close'].shift(1) - 1
+    # estimated volatility, one groupby ewm over all the codes
+    sigma = df.groupby(['code'])['return'].ewm(span=span0).std().reset_index(level=0, drop=True)
+    return sigma.reindex(df.index)
 
 
-def TBL(df, barrier, width):
+def volatility_barrier(df: pd.DataFrame, width: tuple = (1., 1.), right: int = 10, span0: int = 100,
+                       event: pd.DataFrame or None = None) -> pd.DataFrame:
+    """
+    Per event barriers from the EWM volatility of the code, the upper barrier is close * (1 + upwidth * sigma),
+    the lower barrier is close * (1 - downwidth * sigma), and the vertical barrier is right bars later of the same code.
+    The events without the volatility or the vertical barrier are dropped.
+    :param df: panel of the bars, has code, time_key and close
+    :param width: (upwidth, downwidth), the barrier is ignored if the width is not positive
+    :param right: number of bars to the vertical barrier
+    :param span0: span of the EWM volatility
+    :param event: code and time_key of the events, all the bars by default
+    :return: code, time_key, vb, trgt (the volatility), upper, lower
+    """
     upwidth, downwidth = width
-    barrier_ = barrier
-    result = barrier_[['code', 'time_key', 'vb']].copy(deep=True)
-    if upwidth > 0:
-        barrier_['ub'] = upwidth * barrier_['volume']
-    else:
-        barrier_['ub'] = np.nan
-    if downwidth > 0:
-        barrier_['db'] = -downwidth * barrier_['volume']
+    df = df.sort_values(['code', 'time_key'], kind='mergesort').reset_index(drop=True)
+    sigma = getDailyVol(df[['code', 'close']].copy(), span0).values
+    codes = df['code'].values
+    # last bar position of the code of every bar
+    code_last = np.r_[codes[1:] != codes[:-1], True].nonzero()[0]
+    code_last = code_last[np.r_[0, np.cumsum(codes[1:] != codes[:-1])]]
+
+    if event is None:
+        position = np.arange(len(df))
     else:
-        barrier_['db'] = np.nan
-    for code in barrier_.code.unique():
-        barrier0 = barrier_[barrier_.code == code]
-        print(barrier0)
-        for col, time_key, vb in barrier_[['time_key', 'vb']].itertuples():
-            df0 = df[(df.time_key > time_key) & (df.time_key < vb)]
-            df0['return'] = df0['close'] / df[df.time_key == time_key]['close'].iloc[0] - 1
-            result.loc[result.index[(result.time_key == time_key) & (result.code == code)], 'ut'] = \
-                df0[df0['return'] > barrier0[barrier0.time_key == time_key]['ub'].iloc[0]]['time_key'].min()
-            result.loc[result.index[(result.time_key == time_key) & (result.code == code)], 'dt'] = \
-                df0[df0['return'] < barrier0[barrier0.time_key == time_key]['db'].iloc[0]]['time_key'].min()
+        position = pd.MultiIndex.from_frame(df[['code', 'time_key']]).get_indexer(
+            pd.MultiIndex.from_frame(event[['code', 'time_key']]))
+        position = position[position >= 0]
+    end = position + right
+    position = position[(end <= code_last[position]) & ~np.isnan(sigma[position])]
+
+    close = df['close'].values[position]
+    trgt = sigma[position]
+    return pd.DataFrame({'code': codes[position],
+                         'time_key': df['time_key'].values[position],
+                         'vb': df['time_key'].values[position + right],
+                         'trgt': trgt,
+                         'upper': close * (1 + upwidth * trgt) if upwidth > 0 else np.nan,
+                         'lower': close * (1 - downwidth * trgt) if downwidth > 0 else np.nan})
+
+
+def panel_triple_barrier_label(df: pd.DataFrame, barrier: pd.DataFrame) -> pd.DataFrame:
+    """
+    Triple barrier label of the events of many codes in one call of barrier_touch, see triple_barrier_label.
+    :param df: panel of the bars, has code, time_key, high, low and close
+    :param barrier: code, time_key, vb, upper, lower, e.g. the output of volatility_barrier
+    :return: barrier with label, touch_time and return
+    """
+    df = df.sort_values(['code', 'time_key'], kind='mergesort').reset_index(drop=True)
+    bars = pd.MultiIndex.from_frame(df[['code', 'time_key']])
+    start = bars.get_indexer(pd.MultiIndex.from_arrays([barrier['code'].values, barrier['time_key'].values]))
+    end = bars.get_indexer(pd.MultiIndex.from_arrays([barrier['code'].values, barrier['vb'].values]))
+    if (start < 0).any() or (end < 0).any():
+        raise ValueError('the event and the vertical barrier must be bars of the code')
+
+    close = df['close'].values.astype(np.float64)
+    up, down = barrier_touch(df['high'].values.astype(np.float64), df['low'].values.astype(np.float64),
+                             start.astype(np.int64), end.astype(np.int64),
+                             barrier['upper'].values.astype(np.float64), barrier['lower'].values.astype(np.float64))
+    label, touch = first_touch_label(up, down, end)
+    result = barrier.copy()
+    result['label'] = label
+    result['touch_time'] = df['time_key'].values[touch]
+    result['return'] = close[touch] / close[start] - 1
+    return result
+
+
+@numba.njit(parallel=True, nogil=True)
+def barrier_touch(high: np.ndarray, low: np.ndarray, start: np.ndarray, end: np.ndarray,
+                  upper: np.ndarray, lower: np.ndarray, first_only: bool = True):
+    """
+    Compiled search of the first bar touching the barriers of every event, parallel across the events.
+    The bars of event i are high[start[i]: end[i] + 1], a nan barrier is never touched.
+    :param high: high price of the bars
+    :param low: low price of the bars
+    :param start: first bar position of the events
+    :param end: last bar position (vertical barrier) of the events, inclusive
+    :param upper: upper price barrier of the events
+    :param lower: lower price barrier of the events
+    :param first_only: stop at the first bar touching any barrier, otherwise look for both barriers to the end
+    :return: (position of the first bar with high >= upper, position of the first bar with low <= lower), -1 if never
+    """
+    n = len(start)
+    up = np.full(n, -1, dtype=np.int64)
+    down = np.full(n, -1, dtype=np.int64)
+    for i in numba.prange(n):
+        for j in range(start[i], end[i] + 1):
+            if up[i] < 0 and high[j] >= upper[i]:
+                up[i] = j
+            if down[i] < 0 and low[j] <= lower[i]:
+                down[i] = j
+            if (up[i] >= 0 or down[i] >= 0) and first_only:
+                break
+            if up[i] >= 0 and down[i] >= 0:
+                break
+    return up, down
+
+
+def first_touch_label(up: np.ndarray, down: np.ndarray, end: np.ndarray):
+    """
+    label 2 touch up first, 0 touch low first, 3 touch both in the same bar, 1 touch none before the vertical barrier
+    :param up: output of barrier_touch
+    :param down: output of barrier_touch
+    :param end: last bar position of the events
+    :return: (label, position of the touch bar)
+    """
+    up_first = (up >= 0) & ((down < 0) | (up < down))
+    down_first = (down >= 0) & ((up < 0) | (down < up))
+    both = (up >= 0) & (up == down)
+    label = np.select([up_first, down_first, both], [2, 0, 3], default=1)
+    touch = np.select([up_first | both, down_first], [up, down], default=end)
+    return label, touch
+
+
+def TBL(df, barrier, width):
+    """
+    Time of the first up (ut) and down (dt) touch of the close return between time_key and vb, both exclusive.
+    The barriers are width * barrier['volume'].
+    :param df: code, time_key, close
+    :param barrier: code, time_key, vb, volume
+    :param width: (upwidth, downwidth), the barrier is ignored if the width is not positive
+    :return:
+    """
+    upwidth, downwidth = width
+    result = barrier[['code', 'time_key', 'vb']].copy(deep=True)
+    result['ut'] = pd.NaT
+    result['dt'] = pd.NaT
+    df = df.sort_values(['code', 'time_key'], kind='mergesort')
+    for code, event in result.groupby('code'):
+        bars = df[df.code == code]
+        time = bars['time_key'].values
+        close = bars['close'].values.astype(np.float64)
+        event_time = event['time_key'].values
+        # the event must be a bar of the code
+        position = np.searchsorted(time, event_time)
+        exist = position < len(time)
+        exist[exist] = time[position[exist]] == event_time[exist]
+        position = np.where(exist, position, 0)
+        base = np.where(exist, close[position], np.nan)
+
+        start = position + 1
+        end = np.searchsorted(time, event['vb'].values, side='left') - 1
+        target = barrier.loc[event.index, 'volume'].values.astype(np.float64)
+        upper = base * (1 + upwidth * target) if upwidth > 0 else np.full(len(event), np.nan)
+        lower = base * (1 - downwidth * target) if downwidth > 0 else np.full(len(event), np.nan)
+        # strictly above or below the barrier
+        up, down = barrier_touch(close, close, start.astype(np.int64), end.astype(np.int64),
+                                 np.nextafter(upper, np.inf), np.nextafter(lower, -np.inf), False)
+        result.loc[event.index[up >= 0], 'ut'] = time[up[up >= 0]]
+        result.loc[event.index[down >= 0], 'dt'] = time[down[down >= 0]]
     return result
 
 
@@ -58,72 +187,92 @@ def triple_barrier_label(candles: pd.DataFrame,
                          upper: float or list or np.array,
                          lower: float or list or np.array,
                          right: int or list or np.array,
-                         event: list or np.array or None = None) -> pd.Series:
+                         event: list or np.array or None = None) -> pd.DataFrame:
+    """
+    Triple barrier label of the events, label 2 touch up first, 0 touch low first, 3 touch both in the same bar,
+    1 touch none before the vertical barrier. The bars from the event to the vertical barrier (both inclusive)
+    are searched by the compiled barrier_touch.
+    :param candles: index is time, sorted, has high, low and close
+    :param upper: float is the width to the close of the event, list is the price barrier of every event
+    :param lower: float is the width to the close of the event, list is the price barrier of every event
+    :param right: int is the number of bars to the vertical barrier, list of int is that of every event,
+                  list of time is the vertical barrier of every event
+    :param event: time of the events, all the bars by default
+    :return: label, touch_time and return (close of the touch bar / close of the event - 1), index is event.
+             The events without a vertical barrier inside the candles are dropped.
+    """
     if event is None:
         event = candles.index.values
+    event = np.asarray(event)
+    close = candles['close'].values.astype(np.float64)
+    start = candles.index.get_indexer(event)
+    if (start < 0).any():
+        raise ValueError('event must be in the index of candles')
     # check if legal
     if isinstance(upper, float) is False:
         if len(upper) != len(event):
             raise ValueError(
                 'upper list must have same length with event, but upper has lenght of {}, event has length of {}'.format(
                     len(upper), len(event)))
+        upper = np.asarray(upper, dtype=np.float64)
     else:
-        upper = candles.loc[event]['close'] * (1 + upper)
+        upper = close[start] * (1 + upper)
 
     if isinstance(lower, float) is False:
         if len(lower) != len(event):
             raise ValueError(
                 'lower list must have same length with event, but lower has lenght of {}, event has length of {}'.format(
                     len(lower), len(event)))
+        lower = np.asarray(lower, dtype=np.float64)
     else:
-        lower = candles.loc[event]['close'] * (1 - lower)
+        lower = close[start] * (1 - lower)
 
-    if isinstance(right, int) is False:
+    if isinstance(right, (int, np.integer)) is False:
         if len(right) != len(event):
             raise ValueError(
                 'right list must have same length with event, but right has lenght of {}, event has length of {}'.format(
-                    len(lower), len(event)))
-        if isinstance(right[0], (int, np.int64, np.int, np.int32, np.int16)):
-            r = []
-            for i in range(len(event)):
-                future = candles.loc[event[i]:]
-                try:
-                    future = future.iloc[right[i]].name
-                    r.append(future)
-                except:
-                    pass
-            right = np.array(r)
-        elif isinstance(right[0], pd.Timestamp):
-            right_is_future = np.all(right > event)
-            if right_is_future is False:
+                    len(right), len(event)))
+        right = np.asarray(right)
+        if np.issubdtype(right.dtype, np.integer):
+            end = start + right
+        else:
+            right = pd.to_datetime(right).values
+            if not np.all(right > event):
                 raise ValueError('right larger than event date')
+            end = np.searchsorted(candles.index.values, right, side='right') - 1
     else:
-        right = pd.Series(candles.index, index=candles.index).shift(-right)[event].dropna().values
-    label = []
-    for i in tqdm.tqdm(range(0, len(right))):
-        label_data = candles.loc[event[i]: right[i]]
-        counter = 0
-        for idx, row in label_data.iterrows():
-            upper_barrier = upper[i]
-            lower_barrier = lower[i]
-
-            if row['high'] >= upper_barrier:
-                if row['low'] <= lower_barrier:
-                    # touch both and same time, label 3
-                    # print(row, upper_barrier, lower_barrier)
-                    label.append(3)
-                else:
-                    # touch up, label 2
-                    label.append(2)
-                break
-            elif row['low'] <= lower_barrier:
-                # touch low, label0
-                label.append(0)
-                break
-            elif counter == len(label_data) - 1:
-                # no touch the whole period
-                label.append(1)
-            counter += 1
+        end = start + right
+    # the vertical barrier must be inside the candles
+    valid = end < len(candles)
+    event, start, end, upper, lower = event[valid], start[valid], end[valid], upper[valid], lower[valid]
+
+    up, down = barrier_touch(candles['high'].values.astype(np.float64), candles['low'].values.astype(np.float64),
+                             start.astype(np.int64), end.astype(np.int64), upper, lower)
+    label, touch = first_touch_label(up, down, end)
+    print('\nfinish labelling, result: ', Counter(label.tolist()))
+    return pd.DataFrame({'label': label, 'touch_time': candles.index.values[touch],
+                         'return': close[touch] / close[start] - 1}, index=event)
+
+
+def mp_panel_triple_barrier_label(df: pd.DataFrame, barrier: pd.DataFrame, molecule) -> pd.DataFrame:
+    """
+    panel_triple_barrier_label of the codes in molecule
+    """
+    return panel_triple_barrier_label(df[df['code'].isin(molecule)], barrier[barrier['code'].isin(molecule)])
+
 
-    print('\nfinish labelling, result: ', Counter(label))
-    return pd.Series(label, index=event[:len(right)], name='label')
+def parallel_triple_barrier_label(df: pd.DataFrame, barrier: pd.DataFrame, numThreads: int = 4,
+                                  backend: str = 'thread', **kargs) -> pd.DataFrame:
+    """
+    panel_triple_barrier_label split by code and run by mpPandasObj.
+    barrier_touch releases the GIL, so the thread backend shares df and barrier without copying them.
+    :param df: panel of the bars, has code, time_key, high, low and close
+    :param barrier: code, time_key, vb, upper, lower, e.g. the output of volatility_barrier
+    :param numThreads:
+    :param backend: backend of mpPandasObj
+    :param kargs: progress, numParts of mpPandasObj
+    :return:
+    """
+    codes = np.sort(barrier['code'].unique())
+    return mpPandasObj(mp_panel_triple_barrier_label, ('molecule', codes), numThreads, backend=backend,
+                       df=df, barrier=barrier, **kargs)
@@ -1,5 +1,8 @@
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+
+from fin_ml.utils import mpPandasObj
 
 
 # The codes in this file are directly copied from the implementation in the book "Advances in financial machine learning"
@@ -18,6 +21,8 @@ def mpNumCoEvents(closeIdx, t1, molecule):
 
     Any event that starts before t1[modelcule].max() impacts the count.
 
+    The events are mapped to bar positions by searchsorted and counted with a difference array, O(bars + events).
+
     :param closeIdx: index of close data
     :param t1: events time series. index is time of start, value is time of end
     :param molecule: molecule is a list of events you want to compute the number of concurrent events
@@ -30,12 +35,48 @@ def mpNumCoEvents(closeIdx, t1, molecule):
     t1 = t1.loc[:t1[molecule].max()]  # events that start at or before t1[molecule].max()
     # 2) count events spanning a bar
     iloc = closeIdx.searchsorted(np.array([t1.index[0], t1.max()]))
-    count = pd.Series(0, index=closeIdx[iloc[0]:iloc[1] + 1])
-    for tIn, tOut in t1.iteritems():
-        count.loc[tIn:tOut] += 1.
+    start, end = event_span(closeIdx[iloc[0]:iloc[1] + 1], t1)
+    count = pd.Series(concurrency(start, end, iloc[1] + 1 - iloc[0]), index=closeIdx[iloc[0]:iloc[1] + 1])
     return count.loc[molecule[0]:t1[molecule].max()]
 
 
+def event_span(closeIdx, t1):
+    """
+    Bar positions of the events, the event covers closeIdx[start: end], the same bars as closeIdx.loc[tIn:tOut]
+    :param closeIdx: index of close data
+    :param t1: events time series. index is time of start, value is time of end, nan is till the last bar
+    :return: (start, end)
+    """
+    start = closeIdx.searchsorted(t1.index.values, side='left')
+    end = closeIdx.searchsorted(t1.fillna(closeIdx[-1]).values, side='right')
+    return start, np.maximum(end, start)
+
+
+def concurrency(start, end, numBars):
+    """
+    Number of events covering each bar by the difference array of the event spans
+    :param start: output of event_span
+    :param end: output of event_span
+    :param numBars:
+    :return: array of the counts
+    """
+    diff = np.bincount(np.minimum(start, numBars), minlength=numBars + 1) - \
+        np.bincount(np.minimum(end, numBars), minlength=numBars + 1)
+    return np.cumsum(diff[:numBars]).astype(float)
+
+
+def span_sum(values, start, end):
+    """
+    Sum of values[start: end] of every span by the prefix sum
+    :param values: array
+    :param start: array
+    :param end: array
+    :return:
+    """
+    cumsum = np.r_[0., np.cumsum(values)]
+    return cumsum[end] - cumsum[start]
+
+
 def mpSampleTW(t1, numCoEvents, molecule):
     """
 
@@ -45,10 +86,38 @@ def mpSampleTW(t1, numCoEvents, molecule):
     :return:
     """
     # Derive avg. uniqueness over the events lifespan
-    wght = pd.Series(index=molecule)
-    for tIn, tOut in t1.loc[wght.index].iteritems():
-        wght.loc[tIn] = (1. / numCoEvents.loc[tIn:tOut]).mean()
-    return wght
+    start, end = event_span(numCoEvents.index, t1.loc[molecule])
+    # the bars without any event are not in the span of any event
+    uniqueness = np.where(numCoEvents.values > 0, 1. / np.where(numCoEvents.values > 0, numCoEvents.values, 1), 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wght = span_sum(uniqueness, start, end) / (end - start)
+    return pd.Series(wght, index=molecule)
+
+
+def getNumCoEvents(closeIdx, t1, numThreads=24, **kargs):
+    """
+    Number of concurrent events of every bar by mpPandasObj [4.1]
+    :param closeIdx: index of close data
+    :param t1: events time series. index is time of start, value is time of end
+    :param numThreads:
+    :param kargs: backend, progress, numParts of mpPandasObj
+    :return: reindexed to closeIdx, 0 for the bars without any event
+    """
+    numCoEvents = mpPandasObj(mpNumCoEvents, ('molecule', t1.index), numThreads, closeIdx=closeIdx, t1=t1, **kargs)
+    numCoEvents = numCoEvents.loc[~numCoEvents.index.duplicated(keep='last')]
+    return numCoEvents.reindex(closeIdx).fillna(0)
+
+
+def getSampleTW(t1, numCoEvents, numThreads=24, **kargs):
+    """
+    Average uniqueness of every event by mpPandasObj [4.2]
+    :param t1: events time series. index is time of start, value is time of end
+    :param numCoEvents: output of function getNumCoEvents
+    :param numThreads:
+    :param kargs: backend, progress, numParts of mpPandasObj
+    :return:
+    """
+    return mpPandasObj(mpSampleTW, ('molecule', t1.index), numThreads, t1=t1, numCoEvents=numCoEvents, **kargs)
 
 
 # =======================================================
@@ -56,35 +125,81 @@ def mpSampleTW(t1, numCoEvents, molecule):
 ## Build Indicator Matrix [4.3]
 def getIndMatrix(barIx, t1):
     # Get Indicator matrix
-    indM = (pd.DataFrame(0, index=barIx, columns=range(t1.shape[0])))
-    for i, (t0, t1) in enumerate(t1.iteritems()):
-        indM.loc[t0:t1, i] = 1.
+    indM = pd.DataFrame(getIndMatrixSparse(barIx, t1).toarray(), index=barIx, columns=range(t1.shape[0]))
     return indM
 
 
+def getIndMatrixSparse(barIx, t1):
+    """
+    Indicator matrix as a bars x events CSR matrix, built from the event spans without the dense matrix
+    :param barIx: index of bars
+    :param t1: events time series. index is time of start, value is time of end
+    :return: scipy.sparse.csr_matrix
+    """
+    start, end = event_span(pd.Index(barIx), t1)
+    length = end - start
+    event = np.repeat(np.arange(len(t1)), length)
+    bar = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length) + start[event]
+    return sp.csr_matrix((np.ones(len(bar)), (bar, event)), shape=(len(barIx), len(t1)))
+
+
 # =======================================================
 # Compute average uniqueness [4.4]
 def getAvgUniqueness(indM):
     # Average uniqueness from indicator matrix
+    if sp.issparse(indM):
+        indM = sp.csc_matrix(indM)
+        c = np.asarray(indM.sum(axis=1)).ravel()  # concurrency
+        return _avgUniqueness(indM, c)
     c = indM.sum(axis=1)  # concurrency
     u = indM.div(c, axis=0)  # uniqueness
     avgU = u[u > 0].mean()  # avg. uniqueness
     return avgU
 
 
+def _avgUniqueness(indM, c):
+    # Average of 1 / c over the bars of every event, 0 for the events without any bar
+    span = np.asarray(indM.sum(axis=0)).ravel()
+    inv = np.where(c > 0, 1. / np.where(c > 0, c, 1), 0.)
+    total = indM.T.dot(inv)
+    return np.where(span > 0, total / np.where(span > 0, span, 1), 0.)
+
+
 # =======================================================
 # return sample from sequential bootstrap [4.5]
-def seqBootstrap(indM, sLength=None):
-    # Generate a sample via sequential bootstrap
+def seqBootstrap(indM, sLength=None, random_state=None):
+    """
+    Generate a sample via sequential bootstrap.
+    The concurrency of the drawn events is kept as a running count of every bar, so each draw updates the
+    uniqueness of all the candidates by one sparse matrix vector product instead of rebuilding indM per candidate.
+    :param indM: indicator matrix, DataFrame or scipy sparse matrix of bars x events
+    :param sLength: number of draws, number of events by default
+    :param random_state: seed or np.random.RandomState, the global random state by default
+    :return: list of the drawn columns of indM, positions if indM is sparse
+    """
+    columns = None if sp.issparse(indM) else indM.columns
+    indM = sp.csr_matrix(indM) if sp.issparse(indM) else sp.csr_matrix(indM.values.astype(float))
+    indT = indM.T.tocsr()  # events x bars, the rows of the drawn events are added to the counts
     if sLength is None: sLength = indM.shape[1]
+    if random_state is None:
+        random_state = np.random.mtrand._rand
+    elif not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    span = np.asarray(indM.sum(axis=0)).ravel()
+    c = np.zeros(indM.shape[0])  # concurrency of the drawn events
     phi = []
     while len(phi) < sLength:
-        avgU = pd.Series()
-        for i in indM:
-            indM_ = indM[phi + [i]]  # reduce indM
-            avgU.loc[i] = getAvgUniqueness(indM_).iloc[-1]
+        # uniqueness of every candidate if it is drawn next
+        avgU = indT.dot(1. / (c + 1.))
+        avgU = np.where(span > 0, avgU / np.where(span > 0, span, 1), 0.)
         prob = avgU / avgU.sum()  # draw prob
-        phi += [np.random.choice(indM.columns, p=prob)]
+        i = random_state.choice(len(prob), p=prob)
+        phi += [i]
+        row = indT.getrow(i)
+        c[row.indices] += row.data
+    if columns is not None:
+        return list(columns[phi])
     return phi
 
 
@@ -93,12 +208,29 @@ def seqBootstrap(indM, sLength=None):
 def mpSampleW(t1, numCoEvents, close, molecule):
     # Derive sample weight by return attribution
     ret = np.log(close).diff()  # log-returns, so that they are additive
-    wght = pd.Series(index=molecule)
-    for tIn, tOut in t1.loc[wght.index].iteritems():
-        wght.loc[tIn] = (ret.loc[tIn:tOut] / numCoEvents.loc[tIn:tOut]).sum()
+    attribution = (ret / numCoEvents.reindex(close.index)).values
+    # nan is skipped like Series.sum, the bars without any event are not in the span of any event
+    attribution = np.where(np.isfinite(attribution), attribution, 0.)
+    start, end = event_span(close.index, t1.loc[molecule])
+    wght = pd.Series(span_sum(attribution, start, end), index=molecule)
     return wght.abs()
 
 
+def getSampleW(t1, numCoEvents, close, numThreads=24, **kargs):
+    """
+    Sample weight by return attribution by mpPandasObj, scaled to sum to the number of events [4.10]
+    :param t1: events time series. index is time of start, value is time of end
+    :param numCoEvents: output of function getNumCoEvents
+    :param close: close price series
+    :param numThreads:
+    :param kargs: backend, progress, numParts of mpPandasObj
+    :return:
+    """
+    wght = mpPandasObj(mpSampleW, ('molecule', t1.index), numThreads, t1=t1, numCoEvents=numCoEvents, close=close,
+                       **kargs)
+    return wght * wght.shape[0] / wght.sum()
+
+
 def getTimeDecay(tW, clfLastW=1.):
     # apply piecewise-linear decay to observed uniqueness (tW)
     # newest observation gets weight=1, oldest observation gets weight=clfLastW
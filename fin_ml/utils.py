@@ -1,11 +1,13 @@
 # The codes in this file are directly copied from the implementation in the book "Advances in financial machine learning"
 # All rights are belong to original authors.
 import datetime as dt
+import itertools
 import sys
 import time
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 
 def expandCall(kargs):
@@ -75,39 +77,123 @@ def processJobs_(jobs):
     return out
 
 
-def mpPandasObj(func, pdObj, numThreads=24, mpBatches=1, linMols=True, **kargs):
+# =======================================================
+# Job engine for mpPandasObj
+# The jobs only carry the call id and the (start, end) of their molecule, func, the atoms and kargs are sent to the
+# workers once, inherited by fork if the platform has it, otherwise by the pool initializer.
+# The contexts are keyed by the call id, so concurrent or nested calls do not overwrite each other.
+_jobContexts = {}
+_jobIds = itertools.count()
+
+
+def _initJobContext(callId, context):
+    _jobContexts[callId] = context
+
+
+def _runMolecule(job):
+    callId, start, end = job
+    context = _jobContexts[callId]
+    molecule = {context['name']: context['atoms'][start:end]}
+    return context['func'](**molecule, **context['kargs'])
+
+
+def progressReporter(task):
+    # Default progress callback, report like reportProgress
+    time0 = time.time()
+
+    def callback(jobNum, numJobs):
+        reportProgress(jobNum, numJobs, time0, task)
+
+    return callback
+
+
+def tuneNumParts(func, pdObj, numThreads, mpBatches=1, targetSeconds=.5, kargs=None):
+    """
+    Number of molecules so that one molecule runs about targetSeconds, estimated by timing a small probe molecule,
+    but at least numThreads * mpBatches molecules to keep every worker busy.
+    :return: (number of molecules, probe size, probe output)
+    """
+    numAtoms = len(pdObj[1])
+    probeSize = max(1, min(numAtoms, numAtoms // (numThreads * mpBatches * 16)))
+    time0 = time.time()
+    probe = func(**{pdObj[0]: pdObj[1][:probeSize]}, **(kargs or {}))
+    perAtom = max((time.time() - time0) / probeSize, 1e-9)
+    chunkSize = max(1, int(targetSeconds / perAtom))
+    numParts = max(numThreads * mpBatches, int(np.ceil((numAtoms - probeSize) / chunkSize)))
+    return min(numParts, max(numAtoms - probeSize, 1)), probeSize, probe
+
+
+def concatOutput(out):
+    # Combine the outputs of the molecules in order with a single concat
+    if len(out) > 0 and isinstance(out[0], (pd.DataFrame, pd.Series)):
+        return pd.concat(out).sort_index()
+    return out
+
+
+def mpPandasObj(func, pdObj, numThreads=24, mpBatches=1, linMols=True, backend='process', progress=True,
+                numParts=None, targetSeconds=.5, **kargs):
     '''
     Parallelize jobs, return a dataframe or series
     + func: function to be parallelized. Returns a DataFrame
     + pdObj[0]: Name of argument used to pass the molecule
     + pdObj[1]: List of atoms that will be grouped into molecules
-    + kwds: any other argument needed by func
+    + backend: 'process', 'thread' for the functions releasing the GIL (compiled kernels), or 'serial'
+    + progress: True for reportProgress, False for none, or a callback(jobNum, numJobs)
+    + numParts: number of molecules, None is numThreads * mpBatches, 'auto' tunes it by timing a probe molecule
+    + kwds: any other argument needed by func, sent to each worker once instead of with every job
+
+    The outputs are in the order of the molecules and concatenated once.
 
     Example: df1=mpPandasObj(func,('molecule',df0.index),24,**kwds)
     '''
-    # if linMols:parts=linParts(len(argList[1]),numThreads*mpBatches)
-    # else:parts=nestedParts(len(argList[1]),numThreads*mpBatches)
-    if linMols:
-        parts = linParts(len(pdObj[1]), numThreads * mpBatches)
-    else:
-        parts = nestedParts(len(pdObj[1]), numThreads * mpBatches)
-
-    jobs = []
-    for i in range(1, len(parts)):
-        job = {pdObj[0]: pdObj[1][parts[i - 1]:parts[i]], 'func': func}
-        job.update(kargs)
-        jobs.append(job)
+    numAtoms = len(pdObj[1])
     if numThreads == 1:
-        out = processJobs_(jobs)
+        backend = 'serial'
+    if progress is True:
+        progress = progressReporter(func.__name__)
+
+    offset, out = 0, []
+    if numParts == 'auto':
+        numParts, offset, probe = tuneNumParts(func, pdObj, numThreads, mpBatches, targetSeconds, kargs)
+        out.append(probe)
+    elif numParts is None:
+        numParts = numThreads * mpBatches
+    if linMols:
+        parts = linParts(numAtoms - offset, numParts)
     else:
-        out = processJobs(jobs, numThreads=numThreads)
-    if isinstance(out[0], pd.DataFrame):
-        df0 = pd.DataFrame()
-    elif isinstance(out[0], pd.Series):
-        df0 = pd.Series()
+        parts = nestedParts(numAtoms - offset, numParts)
+    callId = next(_jobIds)
+    bounds = [(callId, offset + parts[i - 1], offset + parts[i]) for i in range(1, len(parts))]
+
+    context = {'func': func, 'name': pdObj[0], 'atoms': pdObj[1], 'kargs': kargs}
+    if backend == 'serial':
+        _initJobContext(callId, context)
+        outputs = map(_runMolecule, bounds)
+    elif backend == 'thread':
+        _initJobContext(callId, context)
+        executor = ThreadPoolExecutor(max_workers=numThreads)
+        outputs = executor.map(_runMolecule, bounds)
+    elif backend == 'process':
+        if 'fork' in mp.get_all_start_methods():
+            # the forked workers inherit the context, nothing but the bounds is pickled
+            _initJobContext(callId, context)
+            pool = mp.get_context('fork').Pool(processes=numThreads)
+        else:
+            pool = mp.Pool(processes=numThreads, initializer=_initJobContext, initargs=(callId, context))
+        outputs = pool.imap(_runMolecule, bounds)
     else:
-        return out
-    for i in out:
-        df0 = df0.append(i)
-    df0 = df0.sort_index()
-    return df0
+        raise ValueError('backend must be process, thread or serial, but got {}'.format(backend))
+
+    try:
+        for i, out_ in enumerate(outputs, 1):
+            out.append(out_)
+            if progress:
+                progress(i, len(bounds))
+    finally:
+        if backend == 'thread':
+            executor.shutdown()
+        elif backend == 'process':
+            pool.close()
+            pool.join()  # this is needed to prevent memory leaks
+        _jobContexts.pop(callId, None)
+    return concatOutput(out)
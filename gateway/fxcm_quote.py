@@ -7,11 +7,134 @@ import time
 from datetime import timedelta
 import pytz
 from collections import defaultdict
+import numpy as np
 import plotly.io as pio
 
 pio.renderers.default = "browser"
 from graph.bar_component import candlestick
 import plotly.graph_objects as go
+from fin_ml.bar_maker.BarMaker import cumulative_bar_kernel
+
+
+class CountBarAggregator:
+    """
+    Incremental count bar of the minute bars.
+    The closed count bars are cached and only grow by appending, the open count bar keeps its running OHLC and
+    tick count, so each update folds in only the minute bars after the last folded one.
+    The newest real minute bar is still forming and the minute bars after it are made of the prices (tickqty 0),
+    they show in the open count bar but are folded once a newer real minute bar comes, with their final values.
+    """
+    columns = ['open', 'high', 'low', 'close', 'date_start', 'tickqty']
+
+    def __init__(self, symbol: str, count: int, count_bar: pd.DataFrame = None):
+        """
+        :param symbol:
+        :param count: number of ticks of a count bar
+        :param count_bar: the count bars made before, the last one is open if its tickqty < count, it may hold
+        forming minute bars so it is made again from its minute bars
+        """
+        self.symbol = symbol
+        self.count = count
+        self.k_type = 'K_' + str(count) + 'count'
+        self.history = pd.DataFrame(columns=self.columns, index=pd.DatetimeIndex([], name='date'))
+        self.open_bar = None
+        self.forming = None
+        self.last_time = None
+        if count_bar is not None and len(count_bar) > 0:
+            count_bar = count_bar[self.columns]
+            if count_bar['tickqty'].iloc[-1] < count:
+                # the minute bars from the start of the open bar are folded again
+                self.last_time = pd.Timestamp(count_bar['date_start'].iloc[-1]) - pd.Timedelta(1, 'ns')
+                count_bar = count_bar.iloc[:-1]
+            else:
+                self.last_time = count_bar.index[-1]
+            self.history = count_bar
+
+    def update(self, m1_bar: pd.DataFrame, last_is_forming: bool = True) -> int:
+        """
+        Fold the new minute bars in
+        :param m1_bar: open, high, low, close, tickqty, index is time
+        :param last_is_forming: the last minute bar is not finished yet
+        :return: number of the count bars closed by this update
+        """
+        if self.last_time is not None:
+            m1_bar = m1_bar[m1_bar.index > self.last_time]
+        self.forming = None
+        if last_is_forming and len(m1_bar) > 0:
+            # from the newest real minute bar on, the rows after it have tickqty 0
+            real = np.flatnonzero(m1_bar['tickqty'].values > 0)
+            split = real[-1] if len(real) > 0 else 0
+            forming = m1_bar.iloc[split:]
+            self.forming = {'open': forming['open'].iloc[0], 'high': forming['high'].max(),
+                            'low': forming['low'].min(), 'close': forming['close'].iloc[-1],
+                            'date_start': forming.index[0], 'tickqty': forming['tickqty'].sum()}
+            self.forming_time = forming.index[-1]
+            m1_bar = m1_bar.iloc[:split]
+        if len(m1_bar) == 0:
+            return 0
+
+        time = m1_bar.index.values
+        tickqty = m1_bar['tickqty'].values.astype(np.float64)
+        cum = float(self.open_bar['tickqty']) if self.open_bar is not None else 0.
+        closes, _ = cumulative_bar_kernel(tickqty, float(self.count), cum)
+        key = np.cumsum(closes) - closes
+        starts = np.r_[0, np.nonzero(np.diff(key))[0] + 1]
+        ends = np.r_[starts[1:], len(key)]
+        bars = pd.DataFrame({'open': m1_bar['open'].values[starts],
+                             'high': np.maximum.reduceat(m1_bar['high'].values, starts),
+                             'low': np.minimum.reduceat(m1_bar['low'].values, starts),
+                             'close': m1_bar['close'].values[ends - 1],
+                             'date_start': time[starts],
+                             'tickqty': np.add.reduceat(m1_bar['tickqty'].values, starts)},
+                            index=pd.DatetimeIndex(time[ends - 1], name='date'))
+        if self.open_bar is not None:
+            # the first group goes on with the open bar
+            bars.iloc[0, bars.columns.get_loc('open')] = self.open_bar['open']
+            bars.iloc[0, bars.columns.get_loc('high')] = max(bars['high'].iloc[0], self.open_bar['high'])
+            bars.iloc[0, bars.columns.get_loc('low')] = min(bars['low'].iloc[0], self.open_bar['low'])
+            bars.iloc[0, bars.columns.get_loc('date_start')] = self.open_bar['date_start']
+            bars.iloc[0, bars.columns.get_loc('tickqty')] += self.open_bar['tickqty']
+
+        n_closed = int(closes.sum())
+        if n_closed < len(bars):
+            row = bars.iloc[-1]
+            self.open_bar = {col: row[col] for col in self.columns}
+            self.open_bar['date'] = bars.index[-1]
+        else:
+            self.open_bar = None
+        if n_closed > 0:
+            self.history = bars.iloc[:n_closed] if len(self.history) == 0 else \
+                pd.concat([self.history, bars.iloc[:n_closed]])
+        self.last_time = time[-1]
+        return n_closed
+
+    def get_count_bar(self, num: int = None) -> pd.DataFrame:
+        """
+        The closed count bars and the open count bar (with the forming minute bars) at the end
+        :param num: number of the last count bars, all by default
+        :return:
+        """
+        history = self.history if num is None else self.history.iloc[-num:]
+        open_bar = None if self.open_bar is None else dict(self.open_bar)
+        if self.forming is not None:
+            if open_bar is None:
+                open_bar = {'open': self.forming['open'], 'high': self.forming['high'], 'low': self.forming['low'],
+                            'date_start': self.forming['date_start'], 'tickqty': 0}
+            open_bar['high'] = max(open_bar['high'], self.forming['high'])
+            open_bar['low'] = min(open_bar['low'], self.forming['low'])
+            open_bar['close'] = self.forming['close']
+            open_bar['tickqty'] += int(self.forming['tickqty'])
+            open_bar['date'] = self.forming_time
+        if open_bar is not None:
+            row = pd.DataFrame({col: [open_bar[col]] for col in self.columns},
+                               index=pd.DatetimeIndex([open_bar['date']], name='date'))
+            history = pd.concat([history, row])
+            if num is not None:
+                history = history.iloc[-num:]
+        count_bar = history.copy()
+        count_bar['code'] = self.symbol
+        count_bar['k_type'] = self.k_type
+        return count_bar
 
 
 class FxcmQuote(QuoteBase):
@@ -33,6 +156,9 @@ class FxcmQuote(QuoteBase):
 
     }
 
+    # the count bar history steps back week by week at most this far, over the holiday weeks without bars
+    count_bar_history_days = 365
+
     fre_dict = {
         KLType.K_1M: '1T',
         KLType.K_5M: '5T',
@@ -58,6 +184,7 @@ class FxcmQuote(QuoteBase):
         super(FxcmQuote, self).__init__()
         self.subscribe_data = defaultdict()
         self.last = None
+        self.count_bar_aggregator = {}  # (symbol, count): CountBarAggregator
         if fxcm is None:
             self.con = fxcmpy.fxcmpy(access_token=access_token, config_file=config_file,
                                      log_file=log_file, log_level=log_level, server=server,
@@ -95,60 +222,50 @@ class FxcmQuote(QuoteBase):
             if start is not None or end is not None:
                 return 0, 'For count bar start and end cannot be specific. '
             count = int(kline_type.replace('K_', '').replace('count', ''))
-            dt = datetime.datetime.now()
-            count_bar = self.get_history_count_bar(symbol, count, dt)
-            while len(count_bar) < num:
-                dt = dt - timedelta(days=7)
-                cb = self.get_history_count_bar(symbol, count, dt)
-                count_bar = cb.append(count_bar)
-            return 1, count_bar[-num:]
+            aggregator = self.count_bar_aggregator.get((symbol, count))
+            if aggregator is None or len(aggregator.history) < num:
+                # collect the minute bars of the weeks back until there are enough ticks, then fold them at once
+                dt = datetime.datetime.now()
+                history_start = dt - timedelta(days=self.count_bar_history_days)
+                weeks = []
+                tickqty = 0
+                while tickqty < (num + 1) * count and dt >= history_start:
+                    _, m1_bar = self.get_specific_week_history_kline(symbol, KLType.K_1M, dt)
+                    dt = dt - timedelta(days=7)
+                    if isinstance(m1_bar, str) or len(m1_bar) == 0:
+                        # a week without bars, e.g. a holiday
+                        continue
+                    weeks.append(m1_bar)
+                    tickqty += m1_bar['tickqty'].sum()
+                aggregator = CountBarAggregator(symbol, count)
+                if len(weeks) > 0:
+                    m1_bar = pd.concat(weeks[::-1])
+                    aggregator.update(m1_bar[~m1_bar.index.duplicated(keep='last')])
+                self.count_bar_aggregator[(symbol, count)] = aggregator
+            else:
+                self._update_count_bar_aggregator(aggregator)
+            return 1, aggregator.get_count_bar(num)
+
+    def _update_count_bar_aggregator(self, aggregator: CountBarAggregator):
+        # only fetch the minute bars since the last folded one
+        num = 500
+        if aggregator.last_time is not None:
+            minutes = (pd.Timestamp(datetime.datetime.utcnow()) - pd.Timestamp(aggregator.last_time)) / \
+                pd.Timedelta(minutes=1)
+            num = int(min(max(np.ceil(minutes) + 2, 2), 10000))
+        _, m1_bar = self.get_cur_kline(aggregator.symbol, num=num, kline_type=KLType.K_1M)
+        return aggregator.update(m1_bar)
 
     def update_count_bar(self, count_bar: pd.DataFrame) -> pd.DataFrame:
         # todo new bar logic should apply to trader part (use date_start to tell, date == date_start)
         symbol = count_bar['code'][0]
-        count_now = count_bar['tickqty'][-1]
-        start = count_bar['date_start'][-1]
         count = int(count_bar['k_type'][-1].replace('K_', '').replace('count', ''))
-
-        _, m1_bar = self.get_cur_kline(symbol, num=500, kline_type=KLType.K_1M)
-        m1_bar = m1_bar[m1_bar.index >= start]
-
-        if count_now < count:
-            count_bar = count_bar[:-1]
-
-        m1_bar.index.name = 'date'
-        m1_bar.reset_index(inplace=True)
-
-        agg_dict = {'open': 'first',
-                    'high': 'max',
-                    'low': 'min',
-                    'close': 'last',
-                    'date': ['min', 'max'],
-                    'tickqty': 'sum'
-                    }
-        m1_bar['group'] = len(count_bar)
-        bar_sample = 0
-        cum_tick = 0
-        for index, value in m1_bar.iterrows():
-            cum_tick += value['tickqty']
-            m1_bar['group'].loc[index] = bar_sample
-            if cum_tick >= count:
-                cum_tick = 0
-                bar_sample += 1
-
-        new_count_bar = m1_bar.reset_index().groupby('group').agg(agg_dict)
-        new_count_bar.columns = ['open',
-                                 'high',
-                                 'low',
-                                 'close',
-                                 'date' + '_start',
-                                 'date',
-                                 'tickqty']
-        new_count_bar.set_index('date', inplace=True)
-        new_count_bar['code'] = symbol
-        new_count_bar['k_type'] = 'K_' + str(count) + 'count'
-        count_bar = count_bar.append(new_count_bar)
-        return count_bar
+        aggregator = self.count_bar_aggregator.get((symbol, count))
+        if aggregator is None:
+            aggregator = CountBarAggregator(symbol, count, count_bar)
+            self.count_bar_aggregator[(symbol, count)] = aggregator
+        self._update_count_bar_aggregator(aggregator)
+        return aggregator.get_count_bar()
 
     def get_symbol_basic_info(self, market, symbol_type, symbol_list=None, *args, **kwargs):
         pass
@@ -228,41 +345,14 @@ class FxcmQuote(QuoteBase):
         return self.get_history_kline(symbol, start, end, kline_type=kline_type, num=10000)
 
     def get_history_count_bar(self, symbol, count: int, dt: datetime.datetime or None = None):
-        agg_dict = {'open': 'first',
-                    'high': 'max',
-                    'low': 'min',
-                    'close': 'last',
-                    'date': ['min', 'max'],
-                    'tickqty': 'sum'
-                    }
         if dt is None:
-            _, count_bar = self.get_specific_week_history_kline(symbol, KLType.K_1M, datetime.datetime.now())
+            _, m1_bar = self.get_specific_week_history_kline(symbol, KLType.K_1M, datetime.datetime.now())
         else:
-            _, count_bar = self.get_specific_week_history_kline(symbol, KLType.K_1M, dt)
-
-        count_bar['group'] = len(count_bar)
-        bar_sample = 0
-        cum_tick = 0
-        for index, value in count_bar.iterrows():
-            cum_tick += value['tickqty']
-            count_bar['group'].loc[index] = bar_sample
-            if cum_tick >= count:
-                cum_tick = 0
-                bar_sample += 1
-
-        count_bar = count_bar.reset_index().groupby('group').agg(agg_dict)
-
-        count_bar.columns = ['open',
-                             'high',
-                             'low',
-                             'close',
-                             'date' + '_start',
-                             'date',
-                             'tickqty']
-        count_bar.set_index('date', inplace=True)
-        count_bar['code'] = symbol
-        count_bar['k_type'] = 'K_' + str(count) + 'count'
-        return count_bar
+            _, m1_bar = self.get_specific_week_history_kline(symbol, KLType.K_1M, dt)
+
+        aggregator = CountBarAggregator(symbol, count)
+        aggregator.update(m1_bar, last_is_forming=False)
+        return aggregator.get_count_bar()
 
     @staticmethod
     def _get_this_week_start_utc_time_of_week(nz: datetime.datetime or None = None):
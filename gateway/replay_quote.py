@@ -0,0 +1,280 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from gateway.quote_base import QuoteBase
+
+"""
+Offline quote of the recorded klines, orderbooks and tickers
+
+The records are pushed in time order to the handlers on a background thread, as the push thread of FutuQuote or
+FxcmQuote does, at real time (speed=1), accelerated (speed=10) or as fast as possible (speed=None). The query methods
+(get_cur_kline, get_order_book, get_market_snapshot, ...) answer with the records up to the replay time, so the live
+engine and the dashboards run on the replay without the broker.
+"""
+
+RET_OK = 0
+
+
+class ReplayHandlerBase:
+    """
+    Handler of the replayed pushes, the same interface as the futu handlers:
+    on_recv_rsp of the subclass calls super().on_recv_rsp(rsp) to get (ret_code, data)
+    """
+
+    def on_recv_rsp(self, rsp):
+        return RET_OK, rsp
+
+
+class ReplayCurKlineHandlerBase(ReplayHandlerBase):
+    pass
+
+
+class ReplayOrderBookHandlerBase(ReplayHandlerBase):
+    pass
+
+
+class ReplayTickerHandlerBase(ReplayHandlerBase):
+    pass
+
+
+def read_table(data, time_key: str) -> pd.DataFrame:
+    """
+    DataFrame indexed by time from a DataFrame or a csv/parquet file,
+    the time is the time_key column if it exists, otherwise the first column of the file
+    """
+    if isinstance(data, str):
+        if os.path.splitext(data)[1] == '.parquet':
+            data = pd.read_parquet(data)
+        else:
+            data = pd.read_csv(data)
+            if time_key not in data.columns:
+                data = data.set_index(data.columns[0])
+    if time_key in data.columns:
+        data = data.set_index(time_key)
+    data.index = pd.to_datetime(data.index)
+    return data.sort_index(kind='mergesort')
+
+
+def group_bounds(times: np.ndarray) -> np.ndarray:
+    # boundaries of the rows of the same time in sorted times
+    if len(times) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.concatenate([[0], np.flatnonzero(times[1:] != times[:-1]) + 1, [len(times)]])
+
+
+class ReplayQuote(QuoteBase):
+    """
+    Replay of the recorded quotes through the handler interface of the gateways, see the module doc
+    """
+    name = 'replay'
+
+    KLINE, ORDER_BOOK, TICKER = 0, 1, 2
+
+    def __init__(self, kline=None, orderbook=None, ticker=None, speed: float or None = None, start=None,
+                 time_key: str = 'time_key'):
+        """
+        :param kline: DataFrame or file of the klines with code and k_type columns,
+            or dict of k_type -> DataFrame or file
+        :param orderbook: records or json lines file of the orderbooks (read_orderbook_json),
+            with code, svr_recv_time_bid, svr_recv_time_ask, Bid and Ask
+        :param ticker: DataFrame or file of the tickers with code and time columns
+        :param speed: 1 for real time, 10 for 10 times faster, None for as fast as possible
+        :param start: the records before start are not pushed, the klines before it are the history
+        :param time_key: time column of the kline files
+        """
+        super(ReplayQuote, self).__init__()
+        self.speed = speed
+        self.handlers = {}
+        self.time = None  # replay time, the records up to it are pushed
+        self._thread = None
+        self._stop = threading.Event()
+
+        # klines sorted by time, the (code, k_type) rows are kept for the queries
+        self.kline = self._load_kline(kline, time_key)
+        self._kline_time = self.kline.index.values
+        self._kline_key = {}
+        for key, rows in self.kline.groupby(['code', 'k_type'], sort=False).indices.items():
+            self._kline_key[key] = (self._kline_time[rows], self.kline.iloc[rows])
+
+        # orderbooks sorted by the later receive time of bid and ask
+        if isinstance(orderbook, str):
+            # asset_research.utils imports the plotting modules, only needed for the recorded files
+            from asset_research.utils import read_orderbook_json
+            orderbook = read_orderbook_json(orderbook)
+        self.orderbook = [] if orderbook is None else orderbook
+        bid_time = pd.to_datetime([r.get('svr_recv_time_bid') for r in self.orderbook])
+        ask_time = pd.to_datetime([r.get('svr_recv_time_ask') for r in self.orderbook])
+        orderbook_time = np.fmax(bid_time.values, ask_time.values)
+        order = np.argsort(orderbook_time, kind='mergesort')
+        self.orderbook = [self.orderbook[i] for i in order]
+        self._orderbook_time = orderbook_time[order]
+        codes = np.array([r.get('code') for r in self.orderbook], dtype=object)
+        # positions of the orderbooks of each code
+        self._orderbook_key = {code: np.flatnonzero(codes == code) for code in pd.unique(codes)}
+
+        self.ticker = read_table(ticker, 'time') if ticker is not None else pd.DataFrame(
+            columns=['code', 'price', 'volume'], index=pd.DatetimeIndex([]))
+        self._ticker_time = self.ticker.index.values
+
+        # the records before start are not pushed
+        self._cursor = {self.KLINE: 0, self.ORDER_BOOK: 0, self.TICKER: 0}
+        if start is not None:
+            start = np.datetime64(pd.Timestamp(start))
+            for source, times in [(self.KLINE, self._kline_time), (self.ORDER_BOOK, self._orderbook_time),
+                                  (self.TICKER, self._ticker_time)]:
+                self._cursor[source] = int(np.searchsorted(times, start))
+        self._events = self._merge_events()
+
+    @staticmethod
+    def _load_kline(kline, time_key) -> pd.DataFrame:
+        if kline is None:
+            return pd.DataFrame(columns=['code', 'k_type', 'open', 'high', 'low', 'close', 'volume'],
+                                index=pd.DatetimeIndex([]))
+        if isinstance(kline, dict):
+            frames = []
+            for k_type, data in kline.items():
+                data = read_table(data, time_key)
+                data['k_type'] = k_type
+                frames.append(data)
+            return pd.concat(frames).sort_index(kind='mergesort')
+        data = read_table(kline, time_key)
+        if 'k_type' not in data.columns:
+            raise ValueError('kline needs the k_type column, or pass a dict of k_type -> kline')
+        return data
+
+    def _merge_events(self):
+        """
+        (time, source, start, end) of the pushes in time order from the cursors, a push is the klines or tickers of
+        the same time or an orderbook
+        """
+        kline_start, orderbook_start, ticker_start = [self._cursor[s] for s in [self.KLINE, self.ORDER_BOOK,
+                                                                                 self.TICKER]]
+        kline_bounds = group_bounds(self._kline_time[kline_start:]) + kline_start
+        ticker_bounds = group_bounds(self._ticker_time[ticker_start:]) + ticker_start
+        orderbook_bounds = np.arange(orderbook_start, len(self.orderbook) + 1)
+        times = np.concatenate([self._kline_time[kline_bounds[:-1]], self._orderbook_time[orderbook_bounds[:-1]],
+                                self._ticker_time[ticker_bounds[:-1]]])
+        source = np.concatenate([np.full(len(kline_bounds) - 1, self.KLINE),
+                                 np.full(len(orderbook_bounds) - 1, self.ORDER_BOOK),
+                                 np.full(len(ticker_bounds) - 1, self.TICKER)])
+        start = np.concatenate([kline_bounds[:-1], orderbook_bounds[:-1], ticker_bounds[:-1]])
+        end = np.concatenate([kline_bounds[1:], orderbook_bounds[1:], ticker_bounds[1:]])
+        # stable, so the klines go first at the same time
+        order = np.argsort(times, kind='mergesort')
+        return times[order], source[order], start[order], end[order]
+
+    def set_handler(self, handler):
+        if isinstance(handler, ReplayCurKlineHandlerBase):
+            self.handlers[self.KLINE] = handler
+        elif isinstance(handler, ReplayOrderBookHandlerBase):
+            self.handlers[self.ORDER_BOOK] = handler
+        elif isinstance(handler, ReplayTickerHandlerBase):
+            self.handlers[self.TICKER] = handler
+
+    def subscribe(self, code_list, subtype_list, *args, **kwargs):
+        return RET_OK, 'subscribe: {} type: {} success'.format(code_list, subtype_list)
+
+    def unsubscribe(self, code_list, subtype_list, *args, **kwargs):
+        return RET_OK, 'unsubscribe: {} type: {} success'.format(code_list, subtype_list)
+
+    def _push(self, source, start, end):
+        self._cursor[source] = end
+        handler = self.handlers.get(source)
+        if handler is None:
+            return
+        if source == self.KLINE:
+            handler.on_recv_rsp(self.kline.iloc[start:end])
+        elif source == self.ORDER_BOOK:
+            handler.on_recv_rsp(self.orderbook[start])
+        else:
+            handler.on_recv_rsp(self.ticker.iloc[start:end])
+
+    def run(self):
+        """
+        Replay on the calling thread until all the records are pushed or stop is called
+        """
+        times, source, start, end = self._events
+        if len(times) == 0:
+            return
+        wall_start = time.perf_counter()
+        for i in range(len(times)):
+            if self._stop.is_set():
+                break
+            if self.speed is not None:
+                delay = (times[i] - times[0]) / np.timedelta64(1, 's') / self.speed - \
+                        (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.time = pd.Timestamp(times[i])
+            self._push(source[i], start[i], end[i])
+
+    def start(self):
+        """
+        Replay on a background thread like the push thread of a gateway
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _kline_until(self, symbol, k_type, num=None, end=None) -> pd.DataFrame or None:
+        if (symbol, k_type) not in self._kline_key:
+            return None
+        times, data = self._kline_key[(symbol, k_type)]
+        # rows up to the kline cursor, the rows of the same time are pushed at once
+        if end is None:
+            end = self._kline_time[self._cursor[self.KLINE] - 1] if self._cursor[self.KLINE] > 0 else None
+            n = 0 if end is None else np.searchsorted(times, end, side='right')
+        else:
+            n = np.searchsorted(times, np.datetime64(end), side='right')
+        return data.iloc[max(0, n - num) if num is not None else 0:n]
+
+    def get_history_kline(self, symbol, start=None, end=None, kline_type=None, num=None, *args, **kwargs):
+        if kline_type is None:
+            return 1, 'kline_type cannot be None'
+        data = self._kline_until(symbol, kline_type, num, end)
+        if data is None:
+            return 1, 'no kline of {} {}'.format(symbol, kline_type)
+        if start is not None:
+            data = data[data.index >= pd.Timestamp(start)]
+        return RET_OK, data
+
+    def get_cur_kline(self, symbol, num, ktype, *args, **kwargs):
+        data = self._kline_until(symbol, ktype, num)
+        if data is None:
+            return 1, 'no kline of {} {}'.format(symbol, ktype)
+        return RET_OK, data
+
+    def get_order_book(self, symbol, *args, **kwargs):
+        if symbol not in self._orderbook_key:
+            return 1, 'no orderbook of {}'.format(symbol)
+        rows = self._orderbook_key[symbol]
+        n = np.searchsorted(rows, self._cursor[self.ORDER_BOOK])
+        if n == 0:
+            return 1, 'no orderbook of {} before {}'.format(symbol, self.time)
+        return RET_OK, self.orderbook[rows[n - 1]]
+
+    def get_market_snapshot(self, symbol_list, *args, **kwargs):
+        """
+        The last pushed kline of each symbol
+        """
+        rows = []
+        for (code, _), (times, data) in self._kline_key.items():
+            if code in symbol_list:
+                row = self._kline_until(code, data['k_type'].iloc[0], 1)
+                if len(row) > 0:
+                    rows.append(row)
+        if len(rows) == 0:
+            return 1, pd.DataFrame()
+        data = pd.concat(rows).sort_index(kind='mergesort')
+        return RET_OK, data.groupby('code', sort=False).tail(1)
@@ -88,20 +88,14 @@ def get_pm_report_dash_app(portfolio: dict = None):
     @app.callback([Output('efficient-frontier', 'figure'),
                    ],
                   [Input('update', 'n_clicks')],
-                  [State('hidden-ret', 'children'),
-                   State('hidden-cov', 'children'),
-                   State('weights', 'children'),
+                  [State('weights', 'children'),
                    State('hidden-weights', 'children'),
                    State('annualized-factor', 'value'),
                    State('efficient-frontier', 'figure')],
                   )
-    def update_efficient_frontier(n_clicks, ret, cov, weights, hidden_weights, factor, ef):
-        ret = pd.read_json(ret)
-        cov_matrix = pd.read_json(cov)
-
-        annualized_ret_mean = int(factor) * ret.mean()
-        annualized_ret_cov = int(factor) * cov_matrix.cov()
-        annualized_ret_std = np.sqrt(factor) * ret.std()
+    def update_efficient_frontier(n_clicks, weights, hidden_weights, factor, ef):
+        # cached by the net values and the factor, shared with the allocation page
+        stats = annualized_stats(net_values, int(factor))
 
         weights_dict = {}
         for w in weights:
@@ -115,7 +109,7 @@ def get_pm_report_dash_app(portfolio: dict = None):
         allocation.columns = ['allocation']
         hidden_allocation = pd.read_json(hidden_weights).apply(lambda x: round(x, 4))
         if ef is None or allocation.to_dict() != hidden_allocation.to_dict():
-            ef = efficient_frontier_plot(annualized_ret_mean, annualized_ret_cov, annualized_ret_std, allocation)
+            ef = efficient_frontier_plot(stats['mean'], stats['cov'], stats['std'], allocation)
         return ef,
 
     @app.callback([Output('portfolio-netvalue', 'figure')],
@@ -1,5 +1,3 @@
-import pandas as pd
-import numpy as np
 import dash_core_components as dcc
 import dash_html_components as html
 import json
@@ -8,16 +6,13 @@ from dash.dependencies import Input, Output, State
 
 from portfolioManager.dash_app.app import app
 from portfolioManager.plotting import efficient_frontier_plot
-from portfolioManager.utils import calculate_max_sharp_weights
+from portfolioManager.utils import annualized_stats
 
 
 def get_layout(net_values):
-    daily_net = net_values.groupby(pd.Grouper(freq='D')).last().fillna(method='ffill')  # type: pd.DataFrame
-    daily_ret = daily_net.pct_change()
-    annualized_ret_mean = 252 * daily_ret.mean()
-    annualized_ret_std = np.sqrt(252) * daily_ret.std()
-    annualized_ret_cov = 252 * daily_ret.cov()
-    allocations = calculate_max_sharp_weights(annualized_ret_mean, annualized_ret_cov)
+    # cached by the net values, the page renders without resampling and optimizing again
+    stats = annualized_stats(net_values)
+    allocations = stats['max_sharpe']
     allocations_dict = allocations.to_dict()
     # ef = efficient_frontier_plot(annualized_ret_mean, annualized_ret_std)
 
@@ -35,8 +30,6 @@ def get_layout(net_values):
         dcc.Graph(id='efficient-frontier'),
         dcc.Graph(id='portfolio-netvalue'),
         html.Div(children=net_values.to_json(), id='hidden-netvalue', style={'display': 'none'}),
-        html.Div(children=daily_ret.to_json(), id='hidden-ret', style={'display': 'none'}),
-        html.Div(children=daily_ret.to_json(), id='hidden-cov', style={'display': 'none'}),
         html.Div(children=allocations.to_json(), id='hidden-weights', style={'display': 'none'})
 
     ]
@@ -112,7 +112,7 @@ def efficient_frontier_plot(annualized_ret_mean, annualized_ret_cov, annualized_
                                                            annualized_ret_cov)
 
     returns_range = np.linspace(annualized_ret_mean.min(), annualized_ret_mean.max(), 100)
-    frontier = efficient_frontier(annualized_ret_mean, annualized_ret_cov, returns_range)
+    frontier = efficient_frontier(annualized_ret_mean, annualized_ret_cov, returns_range, method='qp')
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=annualized_ret_std, y=annualized_ret_mean, mode='markers', name='assets'))
     fig.add_trace(
@@ -1,9 +1,15 @@
 import pickle
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import scipy.optimize as sco
 
+from alpha_research.utils import ResultCache, data_fingerprint
+
+# annualized statistics of the net values, keyed by (net values fingerprint, columns, annualized factor)
+stats_cache = ResultCache()
+
 
 def load_result_from_pickles(source_path):
     pickle_files = [f for f in os.listdir(source_path) if f.endswith('.pickle')]
@@ -87,38 +93,208 @@ def calculate_min_variance_weights(expected_ret, cov_matrix):
     return weights
 
 
-def efficient_return(mean_returns, cov_matrix, target):
-    num_assets = len(mean_returns)
-    args = (mean_returns, cov_matrix)
+def _portfolio_variance(weights, cov_matrix):
+    return np.dot(weights, np.dot(cov_matrix, weights))
 
-    def portfolio_return(weights):
-        return calculate_portfolio_ret_std(weights, mean_returns, cov_matrix)[0]
 
-    constraints = ({'type': 'eq', 'fun': lambda x: portfolio_return(x) - target},
-                   {'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
-    bounds = tuple((0, 1) for asset in range(num_assets))
-    result = sco.minimize(_portfolio_volatility, num_assets * [1. / num_assets, ], args=args, method='SLSQP',
-                          bounds=bounds, constraints=constraints)
+def _portfolio_variance_jac(weights, cov_matrix):
+    return 2 * np.dot(cov_matrix, weights)
+
+
+def efficient_return(mean_returns, cov_matrix, target, x0=None, long_only=True):
+    """
+    Minimum volatility portfolio of the target return by SLSQP
+    :param mean_returns:
+    :param cov_matrix:
+    :param target: portfolio return
+    :param x0: initial weights, e.g. the solution of the neighbouring target, equal weights if None
+    :param long_only: weights in [0, 1], otherwise the weights are only summed to 1
+    :return: OptimizeResult, fun is the portfolio volatility
+    """
+    num_assets = len(mean_returns)
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    if x0 is None:
+        x0 = num_assets * [1. / num_assets, ]
+
+    constraints = ({'type': 'eq', 'fun': lambda x: np.dot(x, mean_returns) - target, 'jac': lambda x: mean_returns},
+                   {'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: np.ones(num_assets)})
+    bounds = tuple((0, 1) for asset in range(num_assets)) if long_only else None
+    # the variance is smooth at the optimum and has the analytic gradient, it is scaled by the mean asset variance
+    # to be of order 1, since ftol of SLSQP is absolute and the annualized variances are about 1e-4
+    scale = np.mean(np.diag(cov_matrix))
+    scale = scale if scale > 0 else 1.
+    result = sco.minimize(_portfolio_variance, x0, args=(cov_matrix / scale,), jac=_portfolio_variance_jac,
+                          method='SLSQP', bounds=bounds, constraints=constraints,
+                          options={'ftol': 1e-12, 'maxiter': 500})
+    result.fun = np.sqrt(max(result.fun * scale, 0))
     return result
 
 
-def efficient_frontier(mean_returns, cov_matrix, returns_range):
+def unconstrained_frontier_weights(mean_returns, cov_matrix, returns_range) -> np.ndarray:
+    """
+    Closed form minimum variance weights of the target returns, short selling allowed:
+    w = (C * S^-1 mu - A * S^-1 1) / D * target + (B * S^-1 1 - A * S^-1 mu) / D
+    where A = 1' S^-1 mu, B = mu' S^-1 mu, C = 1' S^-1 1, D = B * C - A^2
+    :param mean_returns:
+    :param cov_matrix:
+    :param returns_range: target returns
+    :return: (targets x assets) array
+    """
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    ones = np.ones(len(mean_returns))
+    inv_mu, inv_one = np.linalg.solve(np.asarray(cov_matrix, dtype=np.float64),
+                                      np.column_stack([mean_returns, ones])).T
+    a, b, c = ones.dot(inv_mu), mean_returns.dot(inv_mu), ones.dot(inv_one)
+    d = b * c - a ** 2
+    slope = (c * inv_mu - a * inv_one) / d
+    intercept = (b * inv_one - a * inv_mu) / d
+    return np.outer(np.asarray(returns_range, dtype=np.float64), slope) + intercept
+
+
+def long_only_frontier_weights(mean_returns, cov_matrix, target, free=None, max_iter=None, tol=1e-10):
+    """
+    Minimum variance weights of the target return with weights >= 0, by an active set on the KKT system:
+    the equality constrained problem is solved on the free assets, the most negative weight is fixed to 0,
+    and the fixed asset of the most negative multiplier is freed, until the KKT conditions hold
+    :param mean_returns:
+    :param cov_matrix:
+    :param target: portfolio return
+    :param free: bool array of the initial free assets, e.g. the active set of the neighbouring target
+    :param max_iter: 4 * assets by default
+    :param tol:
+    :return: (weights, free), or (None, None) if it does not converge, e.g. the target is out of the asset returns
+    """
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    num_assets = len(mean_returns)
+    a = np.vstack([mean_returns, np.ones(num_assets)])
+    b = np.array([target, 1.])
+    free = np.ones(num_assets, dtype=bool) if free is None else free.copy()
+    scale = np.abs(cov_matrix).max() + np.abs(mean_returns).max()
+
+    for _ in range(max_iter or 4 * num_assets):
+        idx = np.flatnonzero(free)
+        k = len(idx)
+        kkt = np.zeros((k + 2, k + 2))
+        kkt[:k, :k] = 2 * cov_matrix[np.ix_(idx, idx)]
+        kkt[:k, k:] = a[:, idx].T
+        kkt[k:, :k] = a[:, idx]
+        solution = np.linalg.lstsq(kkt, np.concatenate([np.zeros(k), b]), rcond=None)[0]
+        weights = np.zeros(num_assets)
+        weights[idx] = solution[:k]
+
+        if k > 0 and weights[idx].min() < -tol:
+            free[idx[np.argmin(weights[idx])]] = False
+            continue
+        # multipliers of weights >= 0 of the fixed assets
+        multiplier = 2 * cov_matrix.dot(weights) + a.T.dot(solution[k:])
+        multiplier[free] = np.inf
+        if multiplier.min() < -tol * scale:
+            free[np.argmin(multiplier)] = True
+            continue
+        if np.abs(a.dot(weights) - b).max() > 1e-8 * (1 + abs(target)):
+            break
+        return np.maximum(weights, 0), free
+    return None, None
+
+
+def _frontier_chunk(mean_returns, cov_matrix, returns_range, method, long_only):
+    """
+    Frontier of contiguous targets, each solve starts from the solution of the previous target
+    """
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
     efficients = []
+    if method == 'qp' and not long_only:
+        for weights in unconstrained_frontier_weights(mean_returns, cov_matrix, returns_range):
+            efficients.append(sco.OptimizeResult(x=weights, fun=np.sqrt(_portfolio_variance(weights, cov_matrix)),
+                                                 success=True, status=0, nit=0, message='closed form'))
+        return efficients
+
+    x0, free = None, None
     for ret in returns_range:
-        efficients.append(efficient_return(mean_returns, cov_matrix, ret))
+        result = None
+        if method == 'qp':
+            weights, active = long_only_frontier_weights(mean_returns, cov_matrix, ret, free)
+            if weights is not None:
+                free = active
+                result = sco.OptimizeResult(x=weights, fun=np.sqrt(max(_portfolio_variance(weights, cov_matrix), 0)),
+                                            success=True, status=0, nit=0, message='active set')
+        if result is None:
+            result = efficient_return(mean_returns, cov_matrix, ret, x0=x0, long_only=long_only)
+        if result.success:
+            x0 = result.x
+        efficients.append(result)
     return efficients
 
 
+def efficient_frontier(mean_returns, cov_matrix, returns_range, method: str = 'slsqp', long_only: bool = True,
+                       processes: int = None):
+    """
+    Minimum volatility portfolios of the target returns
+    :param mean_returns:
+    :param cov_matrix:
+    :param returns_range: target returns, in order so the neighbouring solution is the warm start
+    :param method: 'slsqp', or 'qp' for the closed form (long_only=False) and the active set (long_only=True),
+        the targets the active set fails on are solved by SLSQP
+    :param long_only:
+    :param processes: split the targets into contiguous chunks solved in the processes, serial if None
+    :return: list of OptimizeResult in the order of returns_range, x is the weights and fun is the volatility
+    """
+    if method not in ('slsqp', 'qp'):
+        raise ValueError('method must be slsqp or qp')
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    cov_matrix = np.asarray(cov_matrix, dtype=np.float64)
+    returns_range = np.asarray(returns_range, dtype=np.float64)
+    if processes is None or processes <= 1 or len(returns_range) < 2 * processes:
+        return _frontier_chunk(mean_returns, cov_matrix, returns_range, method, long_only)
+
+    efficients = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_frontier_chunk, mean_returns, cov_matrix, chunk, method, long_only)
+                   for chunk in np.array_split(returns_range, processes)]
+        for future in futures:
+            efficients.extend(future.result())
+    return efficients
+
+
+def daily_returns(net_values: pd.DataFrame) -> pd.DataFrame:
+    daily_net = net_values.groupby(pd.Grouper(freq='D')).last().fillna(method='ffill')  # type: pd.DataFrame
+    return daily_net.pct_change()
+
+
+def _annualized_stats(net_values: pd.DataFrame, factor):
+    daily_ret = daily_returns(net_values)
+    annualized_ret_mean = factor * daily_ret.mean()
+    annualized_ret_cov = factor * daily_ret.cov()
+    return {
+        'daily_ret': daily_ret,
+        'mean': annualized_ret_mean,
+        'std': np.sqrt(factor) * daily_ret.std(),
+        'cov': annualized_ret_cov,
+        'max_sharpe': calculate_max_sharp_weights(annualized_ret_mean, annualized_ret_cov),
+    }
+
+
+def annualized_stats(net_values: pd.DataFrame, factor=252) -> dict:
+    """
+    Daily returns, annualized mean, std, covariance and the maximum sharpe weights of the net values,
+    cached by the fingerprint of the net values, so the allocation page renders without computing them again
+    :param net_values: net value of each strategy
+    :param factor: annualized factor
+    :return: dict of daily_ret, mean, std, cov and max_sharpe, do not modify them in place
+    """
+    key = (data_fingerprint(net_values), tuple(net_values.columns), factor)
+    return stats_cache.get_or_compute(key, _annualized_stats, net_values, factor)
+
+
 if __name__ == '__main__':
     portfolio = load_result_from_pickles('sample_data')
     portfolio = normalized_net_value(portfolio)
     net_values = to_net_value_df(portfolio)
     # position = to_position_df(portfolio)
-    daily_net = net_values.groupby(pd.Grouper(freq='D')).last().fillna(method='ffill')  # type: pd.DataFrame
-    daily_ret = daily_net.pct_change()
-    annualized_ret_mean = 252 * daily_ret.mean()
-    annualized_ret_std = np.sqrt(252) * daily_ret.std()
-    annualized_ret_cov = 252 * daily_ret.cov()
-    random_weight = np.random.randn(len(annualized_ret_mean))
-    result = calculate_max_sharp_weights(annualized_ret_mean, annualized_ret_cov)
+    stats = annualized_stats(net_values)
+    random_weight = np.random.randn(len(stats['mean']))
+    result = stats['max_sharpe']
     # weights = result['x']
@@ -31,7 +31,7 @@ class TWAP(Strategy):
         self.strategy_logic(bar[self.traded_code])
 
     def on_order_status_change(self, dealt_list: list):
-        self.write_log_info('Order change, deal: {}'.format(dealt_list))
+        self.write_log_info('Order change, deal: %s', dealt_list)
         if len(dealt_list) > 0:
             for order in dealt_list:
                 if order.order_direction == "LONG":
@@ -69,7 +69,7 @@ class VWAP(Strategy):
         self.strategy_logic(bar[self.traded_code])
 
     def on_order_status_change(self, dealt_list: list):
-        self.write_log_info('Order change, deal: {}'.format(dealt_list))
+        self.write_log_info('Order change, deal: %s', dealt_list)
         if len(dealt_list) > 0:
             for order in dealt_list:
                 if order.order_direction == "LONG":
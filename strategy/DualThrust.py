@@ -44,7 +44,7 @@ class DualThrust(Strategy):
 
 
     def on_order_status_change(self, dealt_list: list):
-        self.write_log_info('Order change, deal: {}'.format(dealt_list))
+        self.write_log_info('Order change, deal: %s', dealt_list)
         if len(dealt_list) > 0:
             for order in dealt_list:
                 if order.order_direction == "LONG":
@@ -7,10 +7,22 @@ from bar_manager.BarManager import BarManager
 from gateway.brokerage_base import BrokerageBase
 from gateway.fxcm_quote import FxcmQuote
 from gateway.quote_base import QuoteBase
+from strategy.strategy_log import EventLog, start_queue_logging, stop_queue_logging
 
 
 class Strategy:
     backtesting = True
+    # k_type -> name of the callback of the bars
+    kline_callback = {'K_1M': 'on_1min_bar', 'K_5M': 'on_5min_bar', 'K_15M': 'on_15min_bar',
+                      'K_30M': 'on_30min_bar', 'K_60M': 'on_60min_bar', 'K_4H': 'on_4h_bar', 'K_8H': 'on_8h_bar',
+                      'K_DAY': 'on_day_bar'}
+    # columns of the pushed kline, the time is the index if kline_time_key is None
+    kline_time_key = None
+    kline_ohlcv_key = ['open', 'high', 'low', 'close', 'volume']
+    # records below the level are dropped at the call
+    log_level = logging.DEBUG
+    # backtesting keeps the order events in the columnar EventLog instead of the text log
+    event_log = False
 
     def __init__(self):
         # strategy basic description
@@ -19,13 +31,11 @@ class Strategy:
         self.strategy_version = ''
         self.strategy_description = ''
 
-        # logger setting
-        log_filename = dt.datetime.now().strftime('../logs/' + type(self).__name__ + "_%Y-%m-%d_%H_%M_%S.log")
-        logging.basicConfig(level=logging.DEBUG,
-                            format='|%(levelname)s|%(asctime)s|%(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=log_filename)
-        self.logger = logging.getLogger(type(self).__name__ + '_backtesting' if self.backtesting else '_real')
+        # logger setting, the records are written by a background thread
+        self.log_filename = dt.datetime.now().strftime('../logs/' + type(self).__name__ + "_%Y-%m-%d_%H_%M_%S.log")
+        self.logger = logging.getLogger(type(self).__name__ + ('_backtesting' if self.backtesting else '_real'))
+        self.log_listener = start_queue_logging(self.logger, self.log_filename, level=self.log_level)
+        self.events = EventLog() if self.backtesting and self.event_log else None
 
         # K_line setting
         self.symbols = []
@@ -54,6 +64,7 @@ class Strategy:
         self.position = 0
         self.same_bar_traded = False
         self.last_bar = {}
+        self.kline_dispatch = {}  # k_type -> (BarManager dict, callback)
         self.traded_list = list()
 
         self.start = None
@@ -71,7 +82,7 @@ class Strategy:
     def init_kline_object(self):
         self.symbols = self.subscribe.keys()
         for key, value in self.subscribe.items():
-            self.write_log_info('subscribe {}:{}'.format(key, value))
+            self.write_log_info('subscribe %s:%s', key, value)
             self._quote_ctx.subscribe([key], value)
             for sub_type in value:
                 sub_type_lower = sub_type.lower()
@@ -80,6 +91,7 @@ class Strategy:
                         self.__dict__[sub_type_lower] = dict()
                     self.__dict__[sub_type_lower][key] = BarManager(sub_type, self.lookback_period[key][sub_type],
                                                                     self.ta_parameters[key])
+                    self._register_kline(sub_type)
                 elif sub_type == 'TICKER':
                     pass
                 elif sub_type == 'QUOTE':
@@ -103,7 +115,7 @@ class Strategy:
                 df = f.read()
                 f.close()
                 self.strategy_parameters = json.loads(df)
-        self.write_log_info('Setting loaded. Setting: {}'.format(self.strategy_parameters))
+        self.write_log_info('Setting loaded. Setting: %s', self.strategy_parameters)
         d = self.__dict__
         for key in d.keys():
             if key in self.strategy_parameters.keys():
@@ -115,75 +127,69 @@ class Strategy:
             if self.backtesting:
                 for sub in sub_types:
                     num = self.lookback_period[symbol][sub]
-                    self.write_log_info('load data: {}:{} number:{}'.format(symbol, sub, num))
+                    self.write_log_info('load data: %s:%s number:%s', symbol, sub, num)
                     _, data = self._quote_ctx.get_history_kline(symbol, kline_type=sub, num=num)
                     self.__dict__[sub.lower()][symbol].init_with_pandas(data)
             else:
                 # self.write_log_info('load history data: {}:{}:{}:{}')
                 for sub in sub_types:
                     num = self.lookback_period[symbol][sub]
-                    self.write_log_info('load data: {}:{} number:{}'.format(symbol, sub, num))
+                    self.write_log_info('load data: %s:%s number:%s', symbol, sub, num)
                     _, data = self._quote_ctx.get_history_kline(symbol, kline_type=sub, num=num)
                     self.__dict__[sub.lower()][symbol].init_with_pandas(data)
 
+    def _register_kline(self, k_type):
+        callback = self.kline_callback.get(k_type)
+        self.kline_dispatch[k_type] = (self.__dict__[k_type.lower()],
+                                       None if callback is None else getattr(self, callback))
+        self.last_bar.setdefault(k_type, None)
+
     def process_kline(self, data):
-        for ix, row in data.iterrows():
-            code = row['code']
-            if row['k_type'] == 'K_1M':
-                if self.last_bar['K_1M'] < ix:  # new bar comes in
-                    self.last_bar['K_1M'] = ix
-                    self.k_1m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_1min_bar(self.k_1m)
-                else:
-                    self.k_1m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_1min_bar(self.k_1m)
-            elif row['k_type'] == 'K_5M':
-                if self.last_bar['K_5M'] < ix:  # new bar comes in
-                    # self.same_bar_traded = False
-                    self.last_bar['K_5M'] = ix
-                    self.k_5m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_5min_bar(self.k_5m)
-                else:
-                    self.k_5m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_5min_bar(self.k_5m)
-            elif row['k_type'] == 'K_15M':
-                if self.last_bar['K_15M'] < ix:  # new bar comes in
-                    # self.same_bar_traded = False
-                    self.last_bar['K_15M'] = ix
-                    self.k_15m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_15min_bar(self.k_15m)
-                else:
-                    self.k_15m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_15min_bar(self.k_15m)
-            elif row['k_type'] == 'K_30M':
-                if self.last_bar['K_30M'] < ix:  # new bar comes in
-                    # self.same_bar_traded = False
-                    self.last_bar['K_30M'] = ix
-                    self.k_30m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_30min_bar(self.k_30m)
-                else:
-                    self.k_30m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_30min_bar(self.k_30m)
-            elif row['k_type'] == 'K_60M':
-                if self.last_bar['K_60M'] < ix:  # new bar comes in
-                    # self.same_bar_traded = False
-                    self.last_bar['K_60M'] = ix
-                    self.k_60m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_60min_bar(self.k_60m)
-                else:
-                    self.k_60m[code].update_with_pandas(row, time_key='time_key')
-                    self.on_60min_bar(self.k_60m)
-            self.logger.info('process_kline for {} {}'.format(ix, code))
+        """
+        Update the BarManager of the pushed klines and call the callback of each k_type once per push
+        :param data: DataFrame with code, k_type and ohlcv columns, time in the index or kline_time_key column
+        :return:
+        """
+        if self.kline_time_key is None:
+            time = data.index.values
+        else:
+            time = data[self.kline_time_key].values
+        codes = data['code'].values
+        k_types = data['k_type'].values
+        columns = [key for key in self.kline_ohlcv_key if key in data.columns]
+        ohlcv = data[columns].values
+
+        updated = []
+        for i in range(len(data)):
+            k_type = k_types[i]
+            dispatch = self.kline_dispatch.get(k_type)
+            if dispatch is None:
+                continue
+            bar_manager = dispatch[0].get(codes[i])
+            if bar_manager is None:
+                continue
+            bar_manager.update_with_array(time[i], ohlcv[i])
+            if self.last_bar[k_type] is None or self.last_bar[k_type] < time[i]:  # new bar comes in
+                self.last_bar[k_type] = time[i]
+            if k_type not in updated:
+                updated.append(k_type)
+
+        for k_type in updated:
+            bar_managers, callback = self.kline_dispatch[k_type]
+            if callback is not None:
+                callback(bar_managers)
+        self.logger.debug('process_kline %d rows of %s', len(data), updated)
 
     def strategy_logic(self, data):
         pass
 
     def on_strategy_init(self, datetime):
-        self.write_log_info(
-            'start to initial strategy {} {} at time {}'.format(self.strategy_name, self.strategy_version, datetime))
+        self.write_log_info('start to initial strategy %s %s at time %s', self.strategy_name, self.strategy_version,
+                            datetime)
 
-        self.write_log_info('strategy current mode:{}, Exchange:{}, brokerage:{}'.format(
-            'backtesting' if self.backtesting else 'real', self._brokerage_ctx.exchange_name, self._brokerage_ctx.name))
+        self.write_log_info('strategy current mode:%s, Exchange:%s, brokerage:%s',
+                            'backtesting' if self.backtesting else 'real', self._brokerage_ctx.exchange_name,
+                            self._brokerage_ctx.name)
         self.init_kline_object()
         self.load_history_data()
         self.write_log_info('finish initiation.')
@@ -228,22 +234,24 @@ class Strategy:
         pass
 
     def buy(self, symbol, price, vol, order_type, *args, **kwargs):
-        self.write_log_info('Buy {} at {}, amount {}'.format(symbol, price, str(vol)))
+        self._log_order('BUY', symbol, price, vol)
         self._brokerage_ctx.place_order(price, vol, symbol, 'LONG', order_type=order_type)
 
     def sell(self, symbol, price, vol, order_type, *args, **kwargs):
-        self.write_log_info('Sell {} at {}, amount {}'.format(symbol, price, str(vol)))
+        self._log_order('SELL', symbol, price, vol)
         self._brokerage_ctx.place_order(price, vol, symbol, 'SHORT', order_type=order_type)
 
     def short(self, symbol, price, vol, order_type, *args, **kwargs):
-        self.write_log_info('Short {} at {}, amount {}'.format(symbol, price, str(vol)))
+        self._log_order('SHORT', symbol, price, vol)
         self._brokerage_ctx.place_order(price, vol, symbol, 'SHORT', order_type=order_type)
 
     def cover(self, symbol, price, vol, order_type, *args, **kwargs):
-        self.write_log_info('Cover {} at {}, amount {}'.format(symbol, price, str(vol)))
+        self._log_order('COVER', symbol, price, vol)
         self._brokerage_ctx.place_order(price, vol, symbol, 'LONG', order_type=order_type)
 
     def cancel_all(self):
+        if self.events is not None:
+            self.events.record(getattr(self._brokerage_ctx, 'time', None), 'CANCEL_ALL')
         self._brokerage_ctx.cancel_all_order()
 
     def modified_order(self, order_id):
@@ -255,16 +263,34 @@ class Strategy:
     def _update_indicators(self, all=True):
         pass
 
-    def write_log_info(self, content):
-        self.logger.info(content)
+    def _log_order(self, event, symbol, price, vol):
+        if self.events is not None:
+            self.events.record(getattr(self._brokerage_ctx, 'time', None), event, symbol, price, vol)
+        else:
+            self.logger.info('%s %s at %s, amount %s', event.capitalize(), symbol, price, vol)
+
+    def write_log_info(self, content, *args):
+        self.logger.info(content, *args)
 
-    def write_log_error(self, content):
-        self.logger.error(content)
+    def write_log_error(self, content, *args):
+        self.logger.error(content, *args)
 
-    def write_log_debug(self, content):
-        self.logger.debug(content)
+    def write_log_debug(self, content, *args):
+        self.logger.debug(content, *args)
+
+    def close_log(self):
+        """
+        Flush the log and save the event log next to the text log
+        :return:
+        """
+        stop_queue_logging(self.log_listener)
+        if self.events is not None:
+            self.events.save(self.log_filename.replace('.log', '_events.npz'))
 
 class TickBarStrategy(Strategy):
+    kline_callback = {'K_1000count': 'on_count1000_bar', 'K_2000count': 'on_count2000_bar',
+                      'K_3000count': 'on_count3000_bar'}
+
     def __init__(self):
         super(TickBarStrategy, self).__init__()
         self.k_1000count = None
@@ -287,13 +313,13 @@ class TickBarStrategy(Strategy):
             if self.backtesting:
                 for sub in sub_types:
                     num = self.lookback_period[symbol][sub]
-                    self.write_log_info('load data: {}:{} number:{}'.format(symbol, sub, num))
+                    self.write_log_info('load data: %s:%s number:%s', symbol, sub, num)
                     _, data = self._quote_ctx.get_history_kline(symbol, kline_type=sub, num=num)
                     self.__dict__[sub.lower()][symbol].init_with_pandas(data)
             else:
                 for sub in sub_types:
                     num = self.count_num[symbol][sub]
-                    self.write_log_info('load data: {}:{} number:{}'.format(symbol, sub, num))
+                    self.write_log_info('load data: %s:%s number:%s', symbol, sub, num)
                     _, data = self._quote_ctx.get_history_count_bar(symbol, num)
                     self.__dict__[sub.lower()][symbol].init_with_pandas(data)
 
@@ -307,39 +333,6 @@ class TickBarStrategy(Strategy):
         pass
 
 
-    def process_kline(self, data):
-        # todo real time generate data
-        for ix, row in data.iterrows():
-            code = row['code']
-            if row['k_type'] == 'K_1000count':
-                if self.last_bar['K_1000count'] < ix:  # new bar comes in
-                    self.last_bar['K_1000count'] = ix
-                    self.k_1000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count1000_bar(self.k_1000count)
-                else:
-                    self.k_1000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count1000_bar(self.k_1000count)
-            elif row['k_type'] == 'K_2000count':
-                if self.last_bar['K_3000count'] < ix:  # new bar comes in
-                    self.last_bar['K_2000count'] = ix
-                    self.k_2000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count2000_bar(self.k_2000count)
-                else:
-                    self.k_2000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count2000_bar(self.on_count2000_bar)
-            elif row['k_type'] == 'K_3000count':
-                if self.last_bar['K_3000count'] < ix:  # new bar comes in
-                    self.last_bar['K_3000count'] = ix
-                    self.k_3000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count3000_bar(self.k_1m)
-                else:
-                    self.k_3000count[code].update_with_pandas(row, time_key='date')
-                    self.on_count3000_bar(self.k_1m)
-
-            self.logger.info('process_kline for {} {}'.format(ix, code))
-
-
-
 class DayTradeStrategy(Strategy):
     def __init__(self):
         super(DayTradeStrategy, self).__init__()
@@ -0,0 +1,149 @@
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+import numpy as np
+import pandas as pd
+
+"""
+Strategy logging off the strategy thread
+
+The logger only puts the records into a queue, a background thread of QueueListener formats and writes them to the
+file. The messages are formatted lazily ('Buy %s at %s', symbol, price), so the records below the logger level cost
+only the level check and the records above it are formatted by the writer thread.
+
+In backtesting, the order events can be kept in the columnar EventLog and saved as npz instead of text lines.
+"""
+
+LOG_FORMAT = '|%(levelname)s|%(asctime)s|%(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# the running listener of each logger name, a new strategy instance of the same class replaces the listener
+_listeners = {}
+_listeners_lock = threading.Lock()
+_atexit_registered = False
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler formats the message before enqueue, this one leaves it to the handler of the writer thread.
+    The arguments are referenced by the record, so pass a snapshot of the mutable objects.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_queue_logging(logger: logging.Logger, filename: str, level=logging.DEBUG, fmt: str = LOG_FORMAT,
+                        datefmt: str = LOG_DATE_FORMAT) -> QueueListener:
+    """
+    Log to the file through an unbounded queue and a background writer thread, so logging never blocks the caller
+    :param logger:
+    :param filename: log file
+    :param level: records below the level are dropped at the call
+    :param fmt:
+    :param datefmt:
+    :return: the listener, stop it by stop_queue_logging to flush the queue
+    """
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(fmt, datefmt))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+
+    global _atexit_registered
+    with _listeners_lock:
+        if not _atexit_registered:
+            atexit.register(_stop_all_queue_logging)
+            _atexit_registered = True
+        # the previous listener of the logger writes its records left and closes its file
+        previous = _listeners.pop(logger.name, None)
+        for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+            logger.removeHandler(handler)
+        logger.addHandler(LazyQueueHandler(log_queue))
+        logger.setLevel(level)
+        logger.propagate = False
+        listener.start()
+        _listeners[logger.name] = listener
+    stop_queue_logging(previous)
+    return listener
+
+
+def stop_queue_logging(listener: QueueListener or None):
+    """
+    Write the records left in the queue and close the file, it is safe to stop more than once
+    """
+    if listener is None or listener._thread is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    with _listeners_lock:
+        for name in [name for name, running in _listeners.items() if running is listener]:
+            del _listeners[name]
+
+
+def _stop_all_queue_logging():
+    with _listeners_lock:
+        listeners = list(_listeners.values())
+    for listener in listeners:
+        stop_queue_logging(listener)
+
+
+class EventLog:
+    """
+    Columnar log of the order events, the columns are NumPy arrays growing by doubling
+    """
+    events = ['BUY', 'SELL', 'SHORT', 'COVER', 'CANCEL_ALL']
+
+    def __init__(self, capacity: int = 1024):
+        self.n = 0
+        self.time = np.empty(capacity, dtype='datetime64[ns]')
+        self.event = np.empty(capacity, dtype=np.int8)
+        self.symbol = np.empty(capacity, dtype=np.int32)
+        self.price = np.empty(capacity, dtype=np.float64)
+        self.qty = np.empty(capacity, dtype=np.float64)
+        self._event_id = {e: i for i, e in enumerate(self.events)}
+        self._symbol_id = {}
+
+    def _grow(self):
+        for name in ['time', 'event', 'symbol', 'price', 'qty']:
+            column = self.__dict__[name]
+            grown = np.empty(2 * len(column), dtype=column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.__dict__[name] = grown
+
+    def record(self, time, event: str, symbol: str = None, price: float = np.nan, qty: float = np.nan):
+        if self.n == len(self.time):
+            self._grow()
+        i = self.n
+        self.time[i] = np.datetime64('NaT') if time is None else np.datetime64(time, 'ns')
+        self.event[i] = self._event_id[event]
+        self.symbol[i] = -1 if symbol is None else self._symbol_id.setdefault(symbol, len(self._symbol_id))
+        self.price[i] = np.nan if price is None else price
+        self.qty[i] = np.nan if qty is None else qty
+        self.n += 1
+
+    def to_pandas(self) -> pd.DataFrame:
+        symbols = np.array(list(self._symbol_id) + [None], dtype=object)
+        return pd.DataFrame({'time': self.time[:self.n],
+                             'event': pd.Categorical.from_codes(self.event[:self.n], self.events),
+                             'symbol': symbols[self.symbol[:self.n]],
+                             'price': self.price[:self.n],
+                             'qty': self.qty[:self.n]})
+
+    def save(self, path: str):
+        np.savez_compressed(path, time=self.time[:self.n], event=self.event[:self.n], symbol=self.symbol[:self.n],
+                            price=self.price[:self.n], qty=self.qty[:self.n], event_names=np.array(self.events),
+                            symbol_names=np.array(list(self._symbol_id), dtype=str))
+
+    @staticmethod
+    def load(path: str) -> pd.DataFrame:
+        with np.load(path) as f:
+            symbols = np.array(list(f['symbol_names']) + [None], dtype=object)
+            return pd.DataFrame({'time': f['time'],
+                                 'event': pd.Categorical.from_codes(f['event'], list(f['event_names'])),
+                                 'symbol': symbols[f['symbol']],
+                                 'price': f['price'],
+                                 'qty': f['qty']})
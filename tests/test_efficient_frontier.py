@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from portfolioManager.utils import efficient_frontier, unconstrained_frontier_weights, long_only_frontier_weights
+
+
+def random_stats(seed, num_assets):
+    # annualized mean and covariance of daily returns with 0.5% - 2% volatility
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(size=(num_assets, 3)) * 0.005
+    daily_cov = loadings.dot(loadings.T) + np.diag(rng.uniform(0.005, 0.02, num_assets) ** 2)
+    return 252 * rng.normal(0.0003, 0.0005, num_assets), 252 * daily_cov
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_slsqp_frontier_matches_closed_form(seed):
+    mean, cov = random_stats(seed, 2 + seed % 8)
+    returns_range = np.linspace(mean.min(), mean.max(), 30)
+    frontier = efficient_frontier(mean, cov, returns_range, long_only=False)
+    expected = [np.sqrt(w.dot(cov).dot(w)) for w in unconstrained_frontier_weights(mean, cov, returns_range)]
+    assert all(p.success for p in frontier)
+    np.testing.assert_allclose([p.fun for p in frontier], expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_slsqp_frontier_matches_active_set(seed):
+    mean, cov = random_stats(seed, 2 + seed % 8)
+    returns_range = np.linspace(mean.min(), mean.max(), 30)
+    frontier = efficient_frontier(mean, cov, returns_range)
+    qp = efficient_frontier(mean, cov, returns_range, method='qp')
+    assert all(p.success for p in frontier)
+    np.testing.assert_allclose([p.fun for p in frontier], [p.fun for p in qp], rtol=1e-6)
+    for p, target in zip(qp, returns_range):
+        assert p.x.min() >= 0
+        assert p.x.sum() == pytest.approx(1)
+        assert p.x.dot(mean) == pytest.approx(target)
+
+
+def test_active_set_out_of_range_target():
+    mean, cov = random_stats(0, 4)
+    weights, free = long_only_frontier_weights(mean, cov, mean.max() + 1)
+    assert weights is None and free is None
+
+
+def test_parallel_frontier_matches_serial():
+    mean, cov = random_stats(1, 6)
+    returns_range = np.linspace(mean.min(), mean.max(), 40)
+    serial = efficient_frontier(mean, cov, returns_range)
+    parallel = efficient_frontier(mean, cov, returns_range, processes=2)
+    np.testing.assert_allclose([p.fun for p in parallel], [p.fun for p in serial], rtol=1e-6)
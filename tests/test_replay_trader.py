@@ -0,0 +1,127 @@
+import importlib
+import sys
+import threading
+import types
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('futu')
+
+
+def stub_module(name):
+    # talib and fxcmpy are imported on the way to the engine but not used by the replay
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__getattr__ = lambda attr: mock.MagicMock(name=name + '.' + attr)
+        sys.modules[name] = module
+
+
+stub_module('talib')
+stub_module('fxcmpy')
+
+from gateway.brokerage_base import BrokerageBase
+from gateway.replay_quote import ReplayQuote
+from strategy.StrategyBase import Strategy
+from trader.TradeEngine import ReplayTrader
+
+
+class Brokerage(BrokerageBase):
+    exchange_name = 'replay'
+    name = 'replay'
+
+
+class BarStrategy(Strategy):
+    kline_callback = {'K_1M': 'on_1min_bar'}
+
+    def __init__(self):
+        super().__init__()
+        self.bars = []
+        self.orders = []
+        self.threads = set()
+
+    def on_1min_bar(self, bar):
+        self.threads.add(threading.get_ident())
+        self.bars.append((bar['A'].time[-1], bar['A'].close[-1], bar['B'].close[-1]))
+
+    def on_order_send(self, data):
+        self.orders.append(data)
+
+
+@pytest.fixture
+def kline():
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2021-01-01 09:30', periods=100, freq='T')
+    frames = []
+    for code in ['A', 'B']:
+        frame = pd.DataFrame(rng.random((len(index), 5)), index=index,
+                             columns=['open', 'high', 'low', 'close', 'volume'])
+        frame['code'] = code
+        frame['k_type'] = 'K_1M'
+        frames.append(frame)
+    return pd.concat(frames).sort_index(kind='mergesort')
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    # the strategy logs to ../logs
+    (tmp_path / 'logs').mkdir()
+    (tmp_path / 'run').mkdir()
+    monkeypatch.chdir(tmp_path / 'run')
+
+
+def test_replay_drives_the_engine(kline, log_dir):
+    parameter = {'subscribe': {'A': ['K_1M'], 'B': ['K_1M']},
+                 'lookback_period': {'A': {'K_1M': 50}, 'B': {'K_1M': 50}},
+                 'ta_parameters': {'A': None, 'B': None}}
+    # the first 50 minutes are the history, the last 50 are pushed
+    quote = ReplayQuote(kline, start=kline.index[100])
+    strategy = BarStrategy()
+    trader = ReplayTrader(quote, Brokerage(), strategy, parameter)
+    # the events before the loop starts are kept
+    trader.on_order('order before run')
+
+    def drive():
+        while ReplayQuote.KLINE not in quote.handlers:
+            threading.Event().wait(0.01)
+        quote.start()
+        quote.join()
+        trader.stop()
+
+    driver = threading.Thread(target=drive)
+    driver.start()
+    trader.run()
+    driver.join()
+    strategy.close_log()
+
+    pushed = kline.index.unique()[50:]
+    assert [bar[0] for bar in strategy.bars] == list(pushed.values)
+    assert strategy.orders == ['order before run']
+    assert trader.counters['dropped'] == 0 and trader.counters['error'] == 0
+    assert strategy.threads == {threading.get_ident()}
+    for code, position in [('A', 1), ('B', 2)]:
+        close = kline[kline['code'] == code]['close'].values
+        assert strategy.k_1m[code].close[-1] == close[-1]
+        assert [bar[position] for bar in strategy.bars] == list(close[50:])
+        np.testing.assert_array_equal(strategy.k_1m[code].close, close[-50:])
+
+
+def test_stop_before_run():
+    trader = ReplayTrader(ReplayQuote(), Brokerage(), None, {})
+    trader.stop()
+    trader.on_kline(pd.DataFrame(columns=['code', 'k_type']))
+    assert trader.loop is None and len(trader._early) == 2
+
+
+def test_events_after_run_are_dropped(log_dir):
+    trader = ReplayTrader(ReplayQuote(), Brokerage(), BarStrategy(), {'subscribe': {}})
+    trader.stop()
+    trader.run()
+    trader.strategy.close_log()
+    trader.on_order('order after run')
+    trader.on_kline(pd.DataFrame(columns=['code', 'k_type']))
+    assert trader.loop is None and len(trader._early) == 0
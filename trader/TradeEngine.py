@@ -1,4 +1,9 @@
 import json
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import datetime
 from futu import CurKlineHandlerBase, RET_OK, TradeOrderHandlerBase, TradeDealHandlerBase
@@ -7,6 +12,7 @@ from gateway.brokerage_base import BrokerageBase
 from gateway.futu_brokerage import FutuBrokerage
 from gateway.futu_quote import FutuQuote
 from gateway.quote_base import QuoteBase
+from gateway.replay_quote import ReplayCurKlineHandlerBase, ReplayHandlerBase
 from strategy.StrategyBase import Strategy
 
 
@@ -101,3 +107,232 @@ class FutuTrader(TraderBase):
         self.quote_ctx.set_handler(handler)
         self.brokerage_ctx.set_handler(trade_handler)
         self.brokerage_ctx.set_handler(deal_handler)
+
+
+class LatencyMetrics:
+    """
+    Latency in seconds of the last window events, from the receipt on the gateway thread to the dispatch to the strategy
+    """
+
+    def __init__(self, window=10000):
+        self.latency = np.zeros(window)
+        self.count = 0
+
+    def record(self, latency):
+        self.latency[self.count % len(self.latency)] = latency
+        self.count += 1
+
+    def summary(self) -> dict:
+        latency = self.latency[:min(self.count, len(self.latency))]
+        if len(latency) == 0:
+            return {'count': 0, 'mean': np.nan, 'p50': np.nan, 'p99': np.nan, 'max': np.nan}
+        p50, p99 = np.percentile(latency, [50, 99])
+        return {'count': self.count, 'mean': latency.mean(), 'p50': p50, 'p99': p99, 'max': latency.max()}
+
+
+def handler_class(base, callback):
+    """
+    Handler of the gateway which only passes the data of the pushes to the callback
+    """
+
+    class Handler(base):
+        def on_recv_rsp(self, rsp):
+            ret_code, data = super(Handler, self).on_recv_rsp(rsp)
+            if ret_code == RET_OK:
+                callback(data)
+            return ret_code, data
+
+    return Handler
+
+
+class AsyncTrader(TraderBase):
+    """
+    Event driven trader, the gateway callbacks only enqueue the events and a single asyncio loop dispatches them to
+    the strategy in order, so the strategy state is only touched by the loop thread and a slow strategy never stalls
+    the gateway threads.
+
+    The market data queue keeps the latest update of each (code, k_type, time) bar, the stale updates of a bar are
+    coalesced and the oldest bars are dropped if the queue is full, so a strategy slower than the market misses the
+    dropped bars (see counters). The order events are never dropped, they wait if the order queue is full and are
+    dispatched before the market data.
+
+    The events before the loop starts are kept and dispatched when it starts, the events after it stopped are
+    dropped.
+    """
+    kline_handler_base = CurKlineHandlerBase
+    order_handler_base = TradeOrderHandlerBase
+    deal_handler_base = TradeDealHandlerBase
+
+    def __init__(self, quote: QuoteBase, brokerage: BrokerageBase, strategy: Strategy, strategy_parameter,
+                 market_queue_size=1000, order_queue_size=1000):
+        super(AsyncTrader, self).__init__(quote, brokerage, strategy, strategy_parameter)
+        self.market_queue_size = market_queue_size
+        self.order_queue_size = order_queue_size
+        self.loop = None
+        self.metrics = {'kline': LatencyMetrics(), 'order': LatencyMetrics(), 'deal': LatencyMetrics()}
+        self.counters = {'received': 0, 'coalesced': 0, 'dropped': 0, 'dispatched': 0, 'error': 0}
+
+        self._market = OrderedDict()  # (code, k_type, time) -> (row, receipt time)
+        self._order_queue = None
+        self._pending_order = 0  # order events waiting for the full order queue
+        self._wakeup = None
+        self._stopping = False
+        # calls from the gateway threads while the loop is not running
+        self._loop_lock = threading.Lock()
+        self._early = []
+        self._stopped = False
+
+    # gateway threads
+    def _post(self, callback, *args):
+        with self._loop_lock:
+            if self.loop is None:
+                if not self._stopped:
+                    self._early.append((callback, args))
+                return
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_kline(self, data: pd.DataFrame):
+        """
+        :param data: pushed klines with code and k_type columns, indexed by time or with time_key column
+        """
+        self._post(self._put_kline, data, time.perf_counter())
+
+    def on_order(self, data):
+        self._post(self._put_order, ('order', data, time.perf_counter()))
+
+    def on_deal(self, data):
+        self._post(self._put_order, ('deal', data, time.perf_counter()))
+
+    def stop(self):
+        """
+        Stop after the queued events are dispatched, it can be called from any thread, also before run
+        """
+        self._post(self._stop)
+
+    # loop thread
+    def _put_kline(self, data: pd.DataFrame, receipt):
+        if 'time_key' in data.columns:
+            # futu push
+            data = data.set_index(pd.to_datetime(data['time_key'])).drop(columns='time_key')
+        times = data.index.values
+        codes = data['code'].values
+        k_types = data['k_type'].values
+        rows = data.to_dict('records')
+        for i in range(len(rows)):
+            key = (codes[i], k_types[i], times[i])
+            self.counters['received'] += 1
+            if key in self._market:
+                # the pending update of the same bar is stale, the first receipt time is kept for the latency
+                self._market[key] = (rows[i], self._market[key][1])
+                self.counters['coalesced'] += 1
+            else:
+                self._market[key] = (rows[i], receipt)
+                if len(self._market) > self.market_queue_size:
+                    self._market.popitem(last=False)
+                    self.counters['dropped'] += 1
+        self._wakeup.set()
+
+    def _put_order(self, event):
+        if self._order_queue.full():
+            self._pending_order += 1
+            self.loop.create_task(self._wait_put_order(event))
+        else:
+            self._order_queue.put_nowait(event)
+        self._wakeup.set()
+
+    async def _wait_put_order(self, event):
+        await self._order_queue.put(event)
+        self._pending_order -= 1
+        self._wakeup.set()
+
+    def _stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _dispatch_kline(self):
+        # the pending bars of the first time are dispatched at once, the bars of different times are not merged
+        first_time = next(iter(self._market))[2]
+        times, rows = [], []
+        dispatch = time.perf_counter()
+        while len(self._market) > 0 and next(iter(self._market))[2] == first_time:
+            key, (row, receipt) = self._market.popitem(last=False)
+            times.append(key[2])
+            rows.append(row)
+            self.metrics['kline'].record(dispatch - receipt)
+        data = pd.DataFrame(rows, index=pd.DatetimeIndex(times, name='time_key'))
+        self._call(self.strategy.process_kline, data)
+
+    def _dispatch_order(self):
+        channel, data, receipt = self._order_queue.get_nowait()
+        self.metrics[channel].record(time.perf_counter() - receipt)
+        if channel == 'order':
+            self._call(self.strategy.on_order_send, data)
+        else:
+            self._call(self.strategy.on_order_status_change, data)
+
+    def _call(self, func, data):
+        try:
+            func(data)
+            self.counters['dispatched'] += 1
+        except Exception:
+            self.counters['error'] += 1
+            self.strategy.logger.exception('error in %s', func.__name__)
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while not self._order_queue.empty() or len(self._market) > 0:
+                while not self._order_queue.empty():
+                    self._dispatch_order()
+                if len(self._market) > 0:
+                    self._dispatch_kline()
+                # let the events of the gateway threads in between the dispatches
+                await asyncio.sleep(0)
+            if self._stopping and self._pending_order == 0:
+                break
+
+    def _set_handlers(self):
+        self.quote_ctx.set_handler(handler_class(self.kline_handler_base, self.on_kline)())
+        self.brokerage_ctx.set_handler(handler_class(self.order_handler_base, self.on_order)())
+        self.brokerage_ctx.set_handler(handler_class(self.deal_handler_base, self.on_deal)())
+
+    async def run_async(self):
+        self._order_queue = asyncio.Queue(self.order_queue_size)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        with self._loop_lock:
+            self.loop = asyncio.get_running_loop()
+            self._stopped = False
+            early, self._early = self._early, []
+        for callback, args in early:
+            callback(*args)
+        super(AsyncTrader, self).run()
+        self._set_handlers()
+        try:
+            await self._dispatch_loop()
+        finally:
+            with self._loop_lock:
+                self.loop = None
+                self._stopped = True
+
+    def run(self):
+        """
+        Run the event loop until stop is called
+        """
+        asyncio.run(self.run_async())
+
+    def get_metrics(self) -> pd.DataFrame:
+        """
+        Latency summary of the event types, see counters for the number of the market data events
+        """
+        return pd.DataFrame({k: v.summary() for k, v in self.metrics.items()}).T
+
+
+class ReplayTrader(AsyncTrader):
+    """
+    AsyncTrader driven by the ReplayQuote, e.g. to test a strategy with the live engine without the broker
+    """
+    kline_handler_base = ReplayCurKlineHandlerBase
+    order_handler_base = ReplayHandlerBase
+    deal_handler_base = ReplayHandlerBase
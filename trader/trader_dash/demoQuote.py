@@ -1,123 +1,78 @@
-from gateway.quote_base import QuoteBase
+from gateway.replay_quote import ReplayQuote, RET_OK
 import yfinance as yf
 import pandas as pd
-import threading
 import numpy as np
-import time
 
+INTERVAL = {"K_1M": '1m', "K_5M": '5m', "K_15M": '15m', "K_30M": '30m'}
 
-class DemoQuote(QuoteBase):
 
-    def __init__(self):
-        super().__init__()
-        tickers = ['^HSI']
-        self.data = pd.DataFrame()
-        for code in tickers:
-            ticker = yf.Ticker(code)
-            data = ticker.history(period='7d', interval='1m')
-            data['code'] = code
-            data['sub_type'] = "K_1M"
+def download_kline(tickers: list, sub_types: list) -> pd.DataFrame:
+    frames = []
+    for code in tickers:
+        ticker = yf.Ticker(code)
+        for sub_type in sub_types:
+            data = ticker.history(period='7d', interval=INTERVAL[sub_type])
+            if len(data) == 0:
+                continue
             data.columns = [c.lower() for c in data.columns]
-            self.data = self.data.append(data)
-        self.data.index = self.data.index.tz_localize(None)
-        self.data.reset_index(inplace=True)
-        self.data.set_index(['Datetime', 'code'], inplace=True)
-        self.time_ = self.data.index.get_level_values(0).unique().to_list()
-        self.cur_data = None
-
-        quote = self
-
-        class myThread(threading.Thread):
-            def __init__(self):
-                threading.Thread.__init__(self)
-                self.time_list = None
-                self.count = 100
-                self.time = None
-
-            def run(self):
-
-                self.time_list = quote.time_
-                while self.count < len(self.time_list):
-                    self.time = self.time_list[:self.count]
-                    self.count += 1
-                    # print(self.count)
-                    quote.cur_data = quote.data.loc[(self.time, slice(None)), :].sort_index(ascending=True)
-                    time.sleep(3)
-                    # print(quote.cur_data)
-
-        my_thred = myThread()
-        my_thred.start()
+            data['code'] = code
+            data['k_type'] = sub_type
+            data.index = data.index.tz_localize(None)
+            frames.append(data)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames).sort_index(kind='mergesort')
+
+
+class DemoQuote(ReplayQuote):
+    """
+    Replay of the last 7 days of yfinance klines, one minute in 3 seconds after the first 100 minutes
+    """
+
+    def __init__(self, tickers: list = None, sub_types: list = None, speed=20):
+        if tickers is None:
+            tickers = ['^HSI']
+        if sub_types is None:
+            sub_types = ['K_1M']
+        kline = download_kline(tickers, sub_types)
+        times = kline.index.unique()
+        self.start_time = times[min(100, len(times) - 1)]
+        super().__init__(kline, speed=speed, start=self.start_time)
+        self.start()
 
     def subscribe(self, code_list, subtype_list, *args, **kwargs):
-        for code in code_list:
-            ticker = yf.Ticker(code)
-            for subtype in subtype_list:
-                # "K_1M", "K_3M", "K_5M", "K_15M",
-                # "K_30M", "K_60M", "K_DAY", "K_WEEK",
-                # "K_MON", "K_QUARTER", "K_YEAR"
-                if subtype == "K_1M":
-                    data = ticker.history(period='7d', interval='1m')
-                elif subtype == "K_5M":
-                    data = ticker.history(period='7d', interval='5m')
-                elif subtype == "K_15M":
-                    data = ticker.history(period='7d', interval='15m')
-                elif subtype == "K_30M":
-                    data = ticker.history(period='7d', interval='30m')
-                data['sub_type'] = subtype
-                data['code'] = code
-                data.columns = [c.lower() for c in data.columns]
-                data.index = data.index.tz_localize(None)
-                data.reset_index(inplace=True)
-                data.set_index(['Datetime', 'code'], inplace=True)
-                self.data = self.data.append(data)
-                print(code, subtype)
-        self.time_ = self.data.index.get_level_values(0).unique().to_list()
-
-        return 0, 'subscribe: {} type: {} success'.format(code_list, subtype_list)
-
-
-    def unsubscribe(self, code_list, subtype_list, *args, **kwargs):
-        return 0, 'unsubscribe: {} type: {} success'.format(code_list, subtype_list)
-
-
-    def get_trading_date(self, market, start, end, *args, **kwargs):
-        super().get_trading_date(market, start, end, *args, **kwargs)
-
-
-    def get_history_kline(self, symbol, start=None, end=None, kline_type=None, num=None, *args, **kwargs):
-        time = self.cur_data.index.get_level_values(0).unique().to_list()[-num:]
-        if kline_type is None:
-            return 1, 'kline_type cannot be None'
-
-        if start is None and end is None:
-            if num is None:
-                return 1, 'start, end and num cannot all be None'
-            else:
-                data = self.cur_data.loc[(time, [symbol]), :]
-                data = data[data['sub_type'] == kline_type]
-                data.index = data.index.droplevel(1)
-                data['code'] = symbol
-                return 0, data
-        elif start is None and end is not None:
-            raise NotImplementedError
-        elif start is not None and end is None:
-            raise NotImplementedError
-        elif start is not None and end is not None:
-            raise NotImplementedError
-
-
-    def get_cur_kline(self, symbol, num, ktype, *args, **kwargs):
-        time = self.cur_data.index.get_level_values(0).unique().to_list()[-num:]
-        data = self.cur_data.loc[(time, [symbol]), :]
-        data = data[data['sub_type'] == ktype]
-        data.index = data.index.droplevel(1)
-        data['code'] = symbol
-        return 0, data
+        """
+        Download the klines not in the replay yet, and restart the replay with them from the replay time
+        """
+        unknown = [s for s in subtype_list if s not in INTERVAL]
+        if unknown:
+            return 1, 'unsupported sub type: {}'.format(unknown)
+        missing = {code: [s for s in subtype_list if (code, s) not in self._kline_key] for code in code_list}
+        missing = {code: sub_types for code, sub_types in missing.items() if sub_types}
+        if not missing:
+            return super().subscribe(code_list, subtype_list)
+
+        kline = pd.concat([download_kline([code], sub_types) for code, sub_types in missing.items()])
+        loaded = set(zip(kline['code'], kline['k_type'])) if len(kline) > 0 else set()
+        not_found = [(code, s) for code, sub_types in missing.items() for s in sub_types if (code, s) not in loaded]
+        if not_found:
+            return 1, 'no kline of {}'.format(not_found)
+
+        self.stop()
+        self.join()
+        # the klines before the replay time are the history of the new codes,
+        # the klines of the replay time are pushed again
+        handlers = self.handlers
+        start = self.time if self.time is not None else self.start_time
+        super().__init__(pd.concat([self.kline, kline]).sort_index(kind='mergesort'), speed=self.speed, start=start)
+        self.handlers = handlers
+        self.start()
+        return super().subscribe(code_list, subtype_list)
 
     def get_order_book(self, symbol, *args, **kwargs):
-        if symbol not in self.cur_data.index.get_level_values(1):
+        ret, data = self.get_market_snapshot([symbol])
+        if ret != RET_OK:
             return 1, pd.DataFrame()
-        data = self.cur_data.loc[(slice(None), [symbol]), :]
         close = data['close'][-1]
         bid = round(close - (np.random.randint(0, 10) / 100), 2)
         ask = round(close + (np.random.randint(0, 10) / 100), 2)
@@ -133,15 +88,6 @@ class DemoQuote(QuoteBase):
         }
         return 0, pd.DataFrame([ret])
 
-    def get_market_snapshot(self, symbol_list, *args, **kwargs):
-        time = self.cur_data.index.get_level_values(0).unique().to_list()[-1]
-        # print(time)
-        data = self.cur_data.loc[(time, symbol_list), :]
-        data.reset_index(level=1, inplace=True)
-        return 0, data
-
-
-
 
 if __name__ == '__main__':
     quote = DemoQuote()
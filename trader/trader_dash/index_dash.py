@@ -186,6 +186,8 @@ def get_live_dash_app(quote: QuoteBase, brokerage: BrokerageBase = None, holding
             return go.Figure()
         # print(sub, code)
         ret, data = quote.get_cur_kline(code, 100, sub)
+        if ret != 0:
+            return go.Figure()
         # print(data)
         bar = candlestick(data, symbol=code)
         volume_c = volume(data, )
@@ -315,6 +317,6 @@ if __name__ == '__main__':
         }
 
     }
-    quote = DemoQuote()
+    quote = DemoQuote(list(sub.keys()), ['K_1M'])
     app_ = get_live_dash_app(quote, init_subscribe=sub, holding=holding)
     app_.run_server(host='localhost', port=8055)